@@ -1,8 +1,10 @@
+import gc
+import inspect
 import math
-import random
 import networkx as nx
 import numpy as np
-from scipy.stats import pareto
+
+from RandomStreams import default_rng
 
 
 class Agent:
@@ -36,19 +38,61 @@ class Agent:
 
 
     def get_total_portfolio_value(self, market):
-        value = self.budget
-        for coin, amount in self.holdings.items():
-            value += market.get_coin_price(coin) * amount
-
-        return value
-
-
-    def act(self, market, coin):
-        pass
-
-    def get_type(self):
-        pass
-
+        return self.budget + float(market.portfolios.holdings[self.id] @ market.coin_registry.prices())
+
+    @classmethod
+    def draw_parameters(cls, count, rng, **agent_kwargs):
+        """
+        Draws the random parameters of count new agents at once, with the same distributions the constructor uses for
+        parameters left as None
+        :return: dict of constructor keyword to an array of count values, only for parameters not in agent_kwargs
+        """
+        return {}
+
+    @classmethod
+    def create_many(cls, ids, budgets, rng, **agent_kwargs):
+        """
+        Builds one agent per id and budget, drawing all their random parameters in vectorized form through
+        draw_parameters. Only the first agent goes through the constructor, the others are copies of its attributes with
+        their own id, budget, drawn parameters and fresh empty containers. Subclasses with their own constructor but no
+        draw_parameters are built one by one, so their constructor draws what it needs
+        """
+        owner = next(klass for klass in cls.__mro__ if '__init__' in vars(klass))
+        # The rng only goes to constructors that take it (or any keyword)
+        parameters = inspect.signature(cls).parameters
+        takes_rng = 'rng' in parameters or any(parameter.kind == parameter.VAR_KEYWORD
+                                               for parameter in parameters.values())
+        constructor_kwargs = {**agent_kwargs, 'rng': rng} if takes_rng else agent_kwargs
+        if 'draw_parameters' not in vars(owner) or not len(ids):
+            return [cls(id, budget=budget, **constructor_kwargs) for id, budget in zip(ids, budgets)]
+        drawn = cls.draw_parameters(len(ids), rng, **agent_kwargs)
+        names = list(drawn)
+        columns = [drawn[name].tolist() for name in names]
+        first = cls(ids[0], budget=budgets[0], **constructor_kwargs,
+                    **{name: column[0] for name, column in zip(names, columns)})
+
+        template = dict(vars(first))
+        containers = [(name, type(value)) for name, value in template.items() if isinstance(value, (dict, set, list))]
+        agents = [first]
+        new = object.__new__
+        # Nothing built here can be garbage, pausing the collector saves it from rescanning the growing list of agents
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            for id, budget, *row in zip(ids[1:], budgets[1:], *(column[1:] for column in columns)):
+                attributes = template.copy()
+                attributes['id'] = id
+                attributes['budget'] = budget
+                attributes.update(zip(names, row))
+                for name, container in containers:
+                    attributes[name] = container()
+                agent = new(cls)
+                agent.__dict__ = attributes
+                agents.append(agent)
+        finally:
+            if collecting:
+                gc.enable()
+        return agents
 
 
 class RationalAgent(Agent):
@@ -60,19 +104,25 @@ class RationalAgent(Agent):
     They sell meme coins immediately as they believe them to have no intrinsic value
     """
 
-    def __init__(self, id, budget, fair_value_growth_enabled=False, fair_value_growth_rate=0.01):
+    def __init__(self, id, budget, fair_value_growth_enabled=False, fair_value_growth_rate=0.01, value_bias=None,
+                 rng=None):
         super().__init__(id, budget)
+        rng = rng if rng is not None else default_rng()
         self.fair_values = {}
         self.fair_value_growth_enabled = fair_value_growth_enabled
         self.fair_value_growth_rate = fair_value_growth_rate
-        self.value_bias = random.uniform(0.05, 0.2)
+        self.value_bias = value_bias if value_bias is not None else rng.uniform(0.05, 0.2)
+
+    @classmethod
+    def draw_parameters(cls, count, rng, value_bias=None, **agent_kwargs):
+        return {} if value_bias is not None else {'value_bias': rng.uniforms(0.05, 0.2, count)}
 
-    def determine_fair_value(self, coin):
-        self.fair_values[coin.name] = np.random.normal(coin.initial_price, self.value_bias* coin.initial_price)
+    def determine_fair_value(self, coin, rng):
+        self.fair_values[coin.name] = rng.normal(coin.initial_price, self.value_bias* coin.initial_price)
 
     def act(self, market, coin):
         if coin.name not in self.fair_values:
-            self.determine_fair_value(coin)
+            self.determine_fair_value(coin, market.rng)
 
         # Update the fair value based on the growth rate if enabled
         if self.fair_value_growth_enabled:
@@ -87,13 +137,13 @@ class RationalAgent(Agent):
         if coin.price < self.fair_values[coin.name]:
             max_affordable = self.budget // coin.price
             try:
-                buy_amount = random.randint(1, int(max(max_affordable, 1) * 0.2))
+                buy_amount = market.rng.randint(1, int(max(max_affordable, 1) * 0.2))
             except ValueError:
                 buy_amount = 0
             self.buy(coin, buy_amount)
         elif coin.price > self.fair_values[coin.name] and self.holdings.get(coin.name, 0) > 0:
             try:
-                sell_amount = random.randint(1, int(self.holdings[coin.name]))
+                sell_amount = market.rng.randint(1, int(self.holdings[coin.name]))
             except ValueError:
                 sell_amount=0
             self.sell(coin, sell_amount)
@@ -109,28 +159,34 @@ class LinearHerdingAgent(Agent):
     Will sell for sentiment
     """
     def __init__(self, id, budget, threshold=None, price_sensitivity=None,
-                 negative_sentiment_threshold=None):
+                 negative_sentiment_threshold=None, initial_buy_proportion=None, max_multiple=None, rng=None):
         super().__init__(id, budget)
-        self.threshold = threshold if threshold is not None else random.uniform(0.5, 0.7)
-        self.price_sensitivity = price_sensitivity if price_sensitivity is not None else random.uniform(0.5, 1.5)
-        self.negative_sentiment_threshold = negative_sentiment_threshold if negative_sentiment_threshold is not None else random.uniform(
+        rng = rng if rng is not None else default_rng()
+        self.threshold = threshold if threshold is not None else rng.uniform(0.5, 0.7)
+        self.price_sensitivity = price_sensitivity if price_sensitivity is not None else rng.uniform(0.5, 1.5)
+        self.negative_sentiment_threshold = negative_sentiment_threshold if negative_sentiment_threshold is not None else rng.uniform(
             0.5, 0.8)
-        self.initial_buy_proportion = random.uniform(0.05, 0.2)
-        self.max_multiple = pareto.rvs(3, scale=10) #TODO look into a better distribution
+        self.initial_buy_proportion = initial_buy_proportion if initial_buy_proportion is not None else rng.uniform(0.05, 0.2)
+        self.max_multiple = max_multiple if max_multiple is not None else rng.pareto(3, scale=10) #TODO look into a better distribution
 
-
-    def act(self, market, coin):
-        if isinstance(market.network, nx.DiGraph):
-            neighbors = list(market.network.predecessors(self.id))
-        else:
-            neighbors = list(market.network[self.id])
+    @classmethod
+    def draw_parameters(cls, count, rng, **agent_kwargs):
+        distributions = {
+            'threshold': lambda: rng.uniforms(0.5, 0.7, count),
+            'price_sensitivity': lambda: rng.uniforms(0.5, 1.5, count),
+            'negative_sentiment_threshold': lambda: rng.uniforms(0.5, 0.8, count),
+            'initial_buy_proportion': lambda: rng.uniforms(0.05, 0.2, count),
+            'max_multiple': lambda: rng.paretos(3, 10, count),
+        }
+        return {name: draw() for name, draw in distributions.items() if agent_kwargs.get(name) is None}
 
 
-        if not neighbors:
+    def act(self, market, coin):
+        neighborhood = market.aggregates
+        if not neighborhood.num_neighbors(self.id):
             return
 
-        neighbor_holdings_proportion = sum(
-            market.agent_structure.get_agent(neighbor).holdings.get(coin.name, 0) > 0 for neighbor in neighbors) / len(neighbors)
+        neighbor_holdings_proportion = neighborhood.holding_proportion(self.id, coin)
 
         #If this is your first time buying, use your initial buy proportion
         if coin.name not in self.bought and neighbor_holdings_proportion >= self.threshold:
@@ -138,13 +194,9 @@ class LinearHerdingAgent(Agent):
             buy_amount = int(max_affordable * self.initial_buy_proportion)
             self.buy(coin, buy_amount)
             self.average_buy_prices[coin.name] = coin.price
-            if (coin.name == "DogWifHat"):
-                print(f"initial buying cheese {self.average_buy_prices[coin.name], neighbor_holdings_proportion}")
         #Still buy some if you already own the coin and have some more money. But the amount you are willing to buy
         #decreases exponentially relative to the amount of money you have left
         # elif neighbor_holdings_proportion >= self.threshold:
-        #     # if coin.name=="DogWifHat":
-        #     #     print(neighbor_holdings_proportion)
         #     max_affordable = self.budget // coin.price
         #     current_holdings = self.holdings.get(coin.name, 0)
         # 
@@ -158,8 +210,6 @@ class LinearHerdingAgent(Agent):
         #         self.buy(coin, buy_amount)
         #         self.average_buy_prices[coin.name] = (self.average_buy_prices.get(coin.name,0) * current_holdings + coin.price * buy_amount) / (
         #                                                          current_holdings + buy_amount)
-        #     if (coin.name == "DogWifHat"):
-        #         print(f"buying cheese {self.average_buy_prices[coin.name]}")
 
 
         if self.holdings.get(coin.name, 0) > 0 and coin.name in self.average_buy_prices:
@@ -172,19 +222,13 @@ class LinearHerdingAgent(Agent):
                 # Adjust the base of the exponential function according to your price sensitivity
                 sell_probability = 1 - math.exp(-self.price_sensitivity * (current_profit_ratio - 1))
 
-                if random.random() < sell_probability:
+                if market.rng.random() < sell_probability:
                     self.sell_all(coin)
 
-                    if (coin.name == "DogWifHat"):
-                        print(f"Selling cheese for profit: {coin.price, self.average_buy_prices[coin.name], sell_probability}")
-
 
         if self.holdings.get(coin.name, 0) > 0:
-            negative_sentiment = sum(
-                market.agent_structure.get_agent(neighbor).holdings.get(coin.name, 0) == 0 for neighbor in neighbors) / len(neighbors)
+            negative_sentiment = 1 - neighbor_holdings_proportion
             if negative_sentiment > self.negative_sentiment_threshold:
-                if(coin.name=="DogWifHat"):
-                    print(f"selliong cheese cause of sentiment {self.negative_sentiment_threshold, negative_sentiment, neighbor_holdings_proportion}")
                 self.sell_all(coin)
                 if coin.name in self.average_buy_prices:
                     del self.average_buy_prices[coin.name]
@@ -201,44 +245,47 @@ class BudgetProportionHerdingAgent(Agent):
     """
     def __init__(self, id, budget, buy_threshold=None,
                  price_sensitivity=None,
-                 negative_sentiment_threshold=None):
+                 negative_sentiment_threshold=None, initial_buy_proportion=None, max_multiple=None, rng=None):
         super().__init__(id, budget)
-        self.buy_threshold = buy_threshold if buy_threshold is not None else random.uniform(0.02, 0.1)
-        self.price_sensitivity = price_sensitivity if price_sensitivity is not None else random.uniform(0.5, 1.5)
-        self.negative_sentiment_threshold = negative_sentiment_threshold if negative_sentiment_threshold is not None else random.uniform(
+        rng = rng if rng is not None else default_rng()
+        self.buy_threshold = buy_threshold if buy_threshold is not None else rng.uniform(0.02, 0.1)
+        self.price_sensitivity = price_sensitivity if price_sensitivity is not None else rng.uniform(0.5, 1.5)
+        self.negative_sentiment_threshold = negative_sentiment_threshold if negative_sentiment_threshold is not None else rng.uniform(
             0.5, 0.8)
-        self.initial_buy_proportion = random.uniform(0.05, 0.5)
-        self.max_multiple = pareto.rvs(3, scale=10)  # TODO look into a better distribution
+        self.initial_buy_proportion = initial_buy_proportion if initial_buy_proportion is not None else rng.uniform(0.05, 0.5)
+        self.max_multiple = max_multiple if max_multiple is not None else rng.pareto(3, scale=10)  # TODO look into a better distribution
+        self.debug = False
+
+    @classmethod
+    def draw_parameters(cls, count, rng, **agent_kwargs):
+        distributions = {
+            'buy_threshold': lambda: rng.uniforms(0.02, 0.1, count),
+            'price_sensitivity': lambda: rng.uniforms(0.5, 1.5, count),
+            'negative_sentiment_threshold': lambda: rng.uniforms(0.5, 0.8, count),
+            'initial_buy_proportion': lambda: rng.uniforms(0.05, 0.5, count),
+            'max_multiple': lambda: rng.paretos(3, 10, count),
+        }
+        return {name: draw() for name, draw in distributions.items() if agent_kwargs.get(name) is None}
 
     def act(self, market, coin):
-        if isinstance(market.network, nx.DiGraph):
-            neighbors = list(market.network.predecessors(self.id))
-        else:
-            neighbors = list(market.network[self.id])
-
-        if not neighbors:
+        neighborhood = market.aggregates
+        if not neighborhood.num_neighbors(self.id):
             return
 
         # Calculate the total value of the coin held by all neighbors
-        total_neighbor_coin_value = sum(
-            market.agent_structure.get_agent(neighbor).holdings.get(coin.name, 0) * coin.price for neighbor in neighbors)
+        total_neighbor_coin_value = neighborhood.coin_value(self.id, coin)
 
         # Calculate the total budget of all neighbors
-        total_neighbor_budget = sum(market.agent_structure.get_agent(neighbor).budget for neighbor in neighbors)
+        total_neighbor_budget = neighborhood.cash(self.id)
 
         # Calculate the collective investment proportion of the neighborhood
         neighborhood_investment_proportion = total_neighbor_coin_value / total_neighbor_budget
 
-        if (coin.name == "DogWifHat"):
-            print(f"cheese neighbors {neighborhood_investment_proportion, self.buy_threshold}")
-
         if coin.name not in self.bought and neighborhood_investment_proportion >= self.buy_threshold:
             max_affordable = self.budget // coin.price
             buy_amount = int(max_affordable * self.initial_buy_proportion)
             self.buy(coin, buy_amount)
             self.average_buy_prices[coin.name] = coin.price
-            if (coin.name == "DogWifHat"):
-                print(f"first buying cheese {self.average_buy_prices[coin.name]}")
             # Still buy some if you already own the coin and have some more money. But the amount you are willing to buy
             # decreases exponentially relative to the amount of money you have left
         # elif neighborhood_investment_proportion >= self.buy_threshold:
@@ -256,8 +303,6 @@ class BudgetProportionHerdingAgent(Agent):
         #         self.average_buy_prices[coin.name] = (self.average_buy_prices.get(coin.name,
         #                                                                           0) * current_holdings + coin.price * buy_amount) / (
         #                                                      current_holdings + buy_amount)
-        #         # if (coin.name == "DogWifHat"):
-        #             # print(f"buying cheese {self.average_buy_prices[coin.name]}")
 
         if self.holdings.get(coin.name, 0) > 0 and coin.name in self.average_buy_prices:
             current_profit_ratio = coin.price / self.average_buy_prices[coin.name]
@@ -269,15 +314,14 @@ class BudgetProportionHerdingAgent(Agent):
                 # Adjust the base of the exponential function according to your price sensitivity
                 sell_probability = 1 - math.exp(-self.price_sensitivity * (current_profit_ratio - 1))
 
-                if random.random() < sell_probability:
+                if market.rng.random() < sell_probability:
                     self.sell_all(coin)
 
                     if self.debug:
                         print(f"Selling {coin.name} for profit: {coin.price, self.average_buy_prices[coin.name], sell_probability}")
 
         elif self.holdings.get(coin.name, 0) > 0:
-            negative_sentiment = sum(
-                market.agent_structure.get_agent(neighbor).holdings.get(coin.name, 0) == 0 for neighbor in neighbors) / len(neighbors)
+            negative_sentiment = 1 - neighborhood.holding_proportion(self.id, coin)
             if negative_sentiment > self.negative_sentiment_threshold:
                 self.sell_all(coin)
                 if coin.name in self.average_buy_prices:
@@ -299,37 +343,45 @@ class NeighborhoodProbabilisticInvestor(Agent):
     Will sell for sentiment
     Will sell to cut losses
     """
-    def __init__(self, id, budget, price_sensitivity=None, loss_sensitivity=None):
+    def __init__(self, id, budget, price_sensitivity=None, loss_sensitivity=None, initial_buy_proportion=None,
+                 max_multiple=None, sell_scaling_factor=None, rng=None):
         super().__init__(id, budget)
-        self.price_sensitivity = price_sensitivity if price_sensitivity is not None else random.uniform(0.5, 1.5)
-        self.loss_sensitivity = loss_sensitivity if loss_sensitivity is not None else random.uniform(0.5, 1.5)
-        self.initial_buy_proportion = random.uniform(0.05, 0.5)
-        self.max_multiple = pareto.rvs(8, scale=3)  # TODO look into a better distribution
-        self.sell_scaling_factor = random.uniform(0.05, 0.2)  #TODO is this range good
+        rng = rng if rng is not None else default_rng()
+        self.price_sensitivity = price_sensitivity if price_sensitivity is not None else rng.uniform(0.5, 1.5)
+        self.loss_sensitivity = loss_sensitivity if loss_sensitivity is not None else rng.uniform(0.5, 1.5)
+        self.initial_buy_proportion = initial_buy_proportion if initial_buy_proportion is not None else rng.uniform(0.05, 0.5)
+        self.max_multiple = max_multiple if max_multiple is not None else rng.pareto(8, scale=3)  # TODO look into a better distribution
+        self.sell_scaling_factor = sell_scaling_factor if sell_scaling_factor is not None else rng.uniform(0.05, 0.2)  #TODO is this range good
         self.debug=False
 
-    def act(self, market, coin):
-        if isinstance(market.network, nx.DiGraph):
-            neighbors = list(market.network.predecessors(self.id))
-        else:
-            neighbors = list(market.network[self.id])
+    @classmethod
+    def draw_parameters(cls, count, rng, **agent_kwargs):
+        distributions = {
+            'price_sensitivity': lambda: rng.uniforms(0.5, 1.5, count),
+            'loss_sensitivity': lambda: rng.uniforms(0.5, 1.5, count),
+            'initial_buy_proportion': lambda: rng.uniforms(0.05, 0.5, count),
+            'max_multiple': lambda: rng.paretos(8, 3, count),
+            'sell_scaling_factor': lambda: rng.uniforms(0.05, 0.2, count),
+        }
+        return {name: draw() for name, draw in distributions.items() if agent_kwargs.get(name) is None}
 
-        if not neighbors:
+    def act(self, market, coin):
+        neighborhood = market.aggregates
+        if not neighborhood.num_neighbors(self.id):
             return
 
         # Calculate the total value of the coin held by all neighbors
-        total_neighbor_coin_value = sum(
-            market.agent_structure.get_agent(neighbor).holdings.get(coin.name, 0) * coin.price for neighbor in neighbors)
+        total_neighbor_coin_value = neighborhood.coin_value(self.id, coin)
 
         # Calculate the total portfolio value of all neighbors
-        # total_neighbor_budget = sum(market.agent_structure.get_agent(neighbor).budget for neighbor in neighbors)
-        total_neighbor_budget = sum(market.agent_structure.get_agent(neighbor).get_total_portfolio_value(market) for neighbor in neighbors)
+        # total_neighbor_budget = neighborhood.cash(self.id)
+        total_neighbor_budget = neighborhood.portfolio_value(self.id)
 
         # Calculate the collective investment proportion of the neighborhood
         neighborhood_investment_proportion = total_neighbor_coin_value / total_neighbor_budget
 
 
-        if coin.name not in self.bought and random.random() < neighborhood_investment_proportion:
+        if coin.name not in self.bought and market.rng.random() < neighborhood_investment_proportion:
             max_affordable = self.budget // coin.price
             buy_amount = int(max_affordable * self.initial_buy_proportion)
             self.buy(coin, buy_amount)
@@ -342,7 +394,7 @@ class NeighborhoodProbabilisticInvestor(Agent):
         # Probabilistically sell based on the scaled proportion of wealth not invested
         if self.holdings.get(coin.name, 0) > 0:
             sell_probability = proportion_not_invested * self.sell_scaling_factor
-            if random.random() < sell_probability:
+            if market.rng.random() < sell_probability:
                 self.sell_all(coin)
                 if coin.name in self.average_buy_prices:
                     del self.average_buy_prices[coin.name]
@@ -362,7 +414,7 @@ class NeighborhoodProbabilisticInvestor(Agent):
                 # Adjust the base of the exponential function according to your price sensitivity
                 sell_probability = 1 - math.exp(-self.price_sensitivity * (current_profit_ratio - 1))
 
-                if random.random() < sell_probability:
+                if market.rng.random() < sell_probability:
                     self.sell_all(coin)
                     if coin.name in self.average_buy_prices:
                         del self.average_buy_prices[coin.name]
@@ -379,7 +431,7 @@ class NeighborhoodProbabilisticInvestor(Agent):
             # Adjust the base of the exponential function according to your loss sensitivity
             sell_probability = 1 - math.exp(-self.loss_sensitivity * (current_loss_ratio - 1))
 
-            if random.random() < sell_probability:
+            if market.rng.random() < sell_probability:
                 self.sell_all(coin)
                 if coin.name in self.average_buy_prices:
                     del self.average_buy_prices[coin.name]
@@ -1,28 +1,46 @@
-import random
-
 import numpy as np
 
+from RandomStreams import default_rng
+
 
 class IDGenerator:
-    def __init__(self, num_agents):
-        self.available_ids = list(range(num_agents))
+    """
+    Hands out the ids 0..num_agents-1 in a random order, drawn as one permutation up front
+    """
+    def __init__(self, num_agents, rng):
+        self.order = rng.permutation(num_agents)
+        self.position = 0
 
     def get_next_id(self):
-        if not self.available_ids:
+        return int(self.get_next_ids(1)[0])
+
+    def get_next_ids(self, count):
+        """
+        :return: array of the next count ids
+        """
+        if self.position + count > len(self.order):
             raise Exception("No more IDs available.")
-        chosen_id = random.choice(self.available_ids)
-        self.available_ids.remove(chosen_id)
-        return chosen_id
+        ids = self.order[self.position:self.position + count]
+        self.position += count
+        return ids
 
 
 class AgentStructure:
     """
-    Note do not directly index into agents. Must use the get agent by id function
+    Holds the agents of a market in two views:
+    - agent_table: a dense list indexed by agent id, used for O(1) lookups through get_agent
+    - agents: the activation order. The market shuffles this list in place every step, so positions in it say
+      nothing about ids. Do not directly index into agents, use get_agent instead
+
+    :param num_agents
+    :param rng - SimulationRNG used for ids, budgets and agent parameters. Pass the same one to the market
     """
-    def __init__(self, num_agents):
+    def __init__(self, num_agents, rng=None):
         self.num_agents = num_agents
+        self.rng = rng if rng is not None else default_rng()
         self.agents = []
-        self.id_generator = IDGenerator(self.num_agents)
+        self.agent_table = [None] * num_agents
+        self.id_generator = IDGenerator(self.num_agents, self.rng)
         self.agent_type_string = ""
         self.agent_types = []
 
@@ -30,41 +48,47 @@ class AgentStructure:
         if agent_kwargs is None:
             agent_kwargs = {}
 
-        self.agents += [agent(self.id_generator.get_next_id(), budget=random.randint(1000, 10000), **agent_kwargs) for _ in
-                        range(number)]
+        # Ids, budgets and every random agent parameter are drawn for the whole batch at once
+        ids = self.id_generator.get_next_ids(number).tolist()
+        budgets = self.rng.randints(1000, 10000, number).tolist()
+        new_agents = agent.create_many(ids, budgets, self.rng, **agent_kwargs)
+        for new_agent in new_agents:
+            self.agent_table[new_agent.id] = new_agent
+        self.agents += new_agents
         self.agent_type_string += f"{self.agents[-1].get_type()}: {number}, "
         self.agent_types += [self.agents[-1].get_type()]
 
     def get_agent(self, id):
-        for agent in self.agents:
-            if agent.id == id:
-                return agent
+        return self.agent_table[id]
+
+    def shuffle_activation_order(self, rng):
+        """
+        Randomizes the order in which agents act. Only the activation order is touched, the id table is left as is
+        """
+        rng.shuffle(self.agents)
 
     def budgets_based_on_popularity(self, market, min_budget=1000, max_budget=10_000, scaling_factor=10):
         """
         Initializes agents' budgets based on their degree in the network.
         Agents with higher degrees (influencers) receive larger initial budgets.
         """
-        # Get the degree of each agent in the market network
-        # Get the degree of each agent in the market network
-        degrees = dict(market.network.degree())
+        # Get the degree of each agent in the market network, shared with the airdrops through the market's centrality index
+        degrees = market.centrality.get('degree')
 
         # Calculate the maximum degree
-        max_degree = max(degrees.values())
-
-        # Assign initial budget to agents based on their degree using exponential scaling
-        for agent in self.agents:
-            agent_degree = degrees[agent.id]
-            degree_ratio = agent_degree / max_degree
+        max_degree = degrees.max()
 
-            # Calculate the agent's initial budget using exponential scaling
-            agent_budget = int(min_budget * (scaling_factor ** degree_ratio))
+        # Calculate every agent's initial budget using exponential scaling of its degree ratio
+        degree_ratios = degrees / max_degree
+        budgets = (min_budget * scaling_factor ** degree_ratios).astype(np.int64)
 
-            # Ensure the budget is within the specified range
-            agent_budget = max(min_budget, min(agent_budget, max_budget))
+        # Ensure the budgets are within the specified range
+        budgets = np.clip(budgets, min_budget, max_budget).tolist()
 
-            # Set the agent's budget
-            agent.budget = agent_budget
+        # Set the agents' budgets
+        for agent in self.agent_table:
+            if agent is not None:
+                agent.budget = budgets[agent.id]
 
     def get_descriptor(self):
         return f"{self.num_agents} agents ({self.agent_type_string})"
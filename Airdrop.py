@@ -1,7 +1,11 @@
-import random
 from abc import ABC, abstractmethod
 
 import networkx as nx
+import numpy as np
+from scipy import sparse
+
+from Influence import HerdingCascadeModel, celf, calibrated_edge_probabilities, imm
+from SparseNetwork import csr_row_sums, csr_rows
 
 
 class AirdropStrategy(ABC):
@@ -34,6 +38,81 @@ class AirdropStrategy(ABC):
     def do_airdrop(self, market):
         pass
 
+    def credit(self, market, agent, amount):
+        """
+        Adds amount of the airdropped coin to an agent's holdings and reports the change to the market (neighborhood
+        aggregates and history recorder). All airdrops must go through here
+        """
+        holdings_before = agent.holdings.get(self.coin.name, 0)
+        agent.holdings[self.coin.name] = holdings_before + amount
+        agent.average_buy_prices[self.coin.name] = self.coin.price
+        market.record_trade(agent.id, self.coin, holdings_before, holdings_before + amount, 0)
+
+    def credit_all(self, market, recipients, amounts):
+        """
+        credit for many agents at once, straight on the market's holdings array. Amounts of a recipient listed more than
+        once add up
+        :param recipients - array of agent ids
+        :param amounts - array of amounts aligned with recipients
+        """
+        recipients, position = np.unique(recipients, return_inverse=True)
+        amounts = np.bincount(position, weights=amounts, minlength=len(recipients))
+        column = self.coin.index
+        holdings_before = market.portfolios.holdings[recipients, column]
+        holdings_after = holdings_before + amounts
+        market.portfolios.holdings[recipients, column] = holdings_after
+        market.portfolios.average_buy_prices[recipients, column] = self.coin.price
+        market.record_trades(self.coin, recipients, holdings_before, holdings_after)
+
+    def proportional_top_up(self, market, recipients, threshold):
+        """
+        Units of the coin that bring the coin's share of each recipient's neighborhood portfolio value up to threshold,
+        for all recipients at once. Gives the same amounts as crediting the recipients one by one in order: a recipient
+        that watches earlier recipients sees their top ups, which raise its neighborhood's coin and portfolio value alike,
+        so its own top up shrinks by (1 - threshold) times their value. Recipients are resolved in waves (in topological
+        order), each wave being the ones whose earlier watched recipients are all resolved, so every link is visited
+        once whatever the number of waves
+        :param recipients - array of agent ids, in crediting order
+        :return: array of amounts aligned with recipients
+        """
+        price = self.coin.price
+        gap = (threshold * market.aggregates.portfolio_values(recipients)
+               - market.aggregates.coin_values(recipients, self.coin))
+        # earlier has an entry [a, b] when the recipient at position a watches the one at an earlier position b
+        selection = sparse.csr_array((np.ones(len(recipients)), (np.arange(len(recipients)), recipients)),
+                                     shape=(len(recipients), market.num_agents))
+        earlier = sparse.csr_array(sparse.tril(selection @ market.aggregates.neighbors @ selection.T, k=-1))
+        watchers = sparse.csr_array(earlier.T)
+
+        add = np.zeros(len(recipients))
+        # Number of earlier watched recipients each recipient still waits for
+        waiting = np.diff(earlier.indptr)
+        ready = np.flatnonzero(waiting == 0)
+        while len(ready):
+            indptr, watched = csr_rows(earlier.indptr, earlier.indices, ready)
+            received = csr_row_sums(indptr, add[watched])
+            add[ready] = np.maximum((gap[ready] - (1 - threshold) * price * received) / price, 0)
+            # Only the recipients watching this wave can become ready in the next one
+            watching = csr_rows(watchers.indptr, watchers.indices, ready)[1]
+            np.subtract.at(waiting, watching, 1)
+            watching = np.unique(watching)
+            ready = watching[waiting[watching] == 0]
+        return add
+
+    def proportional_airdrop(self, market, recipients, threshold):
+        """
+        Tops up every recipient with proportional_top_up and credits them in bulk
+        """
+        recipients = np.asarray(recipients, dtype=np.int64)
+        amounts = self.proportional_top_up(market, recipients, threshold)
+        self.credit_all(market, recipients, amounts)
+        total_airdropped = float(amounts.sum())
+        total_value_airdropped = total_airdropped * self.coin.price
+
+        print(
+            f"{self.get_type()} airdropped {total_airdropped} {self.coin.name} for a total of ${total_value_airdropped} at time {self.time} ")
+        self.amount_airdropped = total_value_airdropped
+
 
 class RandomAirdropStrategy(AirdropStrategy):
     """
@@ -49,7 +128,7 @@ class RandomAirdropStrategy(AirdropStrategy):
         self.amount = amount
 
     def select_recipients(self, market):
-        recipients = random.choices(market.agent_structure.agents, k=int(market.num_agents * self.percentage))
+        recipients = market.rng.choices(market.agent_structure.agents, k=int(market.num_agents * self.percentage))
         return [agent.id for agent in recipients]
 
     def do_airdrop(self, market):
@@ -58,8 +137,7 @@ class RandomAirdropStrategy(AirdropStrategy):
         total_value_airdropped = 0
         for id in recipients:
             agent = market.agent_structure.get_agent(id)
-            agent.holdings[self.coin.name] = agent.holdings.get(self.coin.name, 0) + self.amount
-            agent.average_buy_prices[self.coin] = self.coin.price
+            self.credit(market, agent, self.amount)
             total_airdropped += self.amount
             total_value_airdropped += self.amount * self.coin.price
 
@@ -73,10 +151,12 @@ class RandomAirdropStrategy(AirdropStrategy):
 class MoreToLeaders(AirdropStrategy):
     """
     give away a total of total_coins to the top x% percent of people by outdegree. The higher degree, the more coins they get
+    :param centrality - the measure leaders are ranked and weighted by, see CentralityIndex.MEASURES
     """
-    def __init__(self, coin, time, percentage, total_coins):
+    def __init__(self, coin, time, percentage, total_coins, centrality='degree'):
         super().__init__(coin, time, percentage)
         self.total_coin = total_coins
+        self.centrality = centrality
 
     def do_airdrop(self, market):
         total_airdropped = 0
@@ -84,20 +164,19 @@ class MoreToLeaders(AirdropStrategy):
         # Determine the number of leaders to target
         num_leaders = int(len(market.agent_structure.agents) * self.percentage)
 
-        # Get the nodes sorted by their degree (influence)
-        agent_degrees = dict(market.network.degree())
-        agent_degrees = sorted(agent_degrees.items(), key=lambda x: x[1], reverse=True)
-        recipients = agent_degrees[:num_leaders]
+        # Get the most central nodes (influence)
+        centrality = market.centrality.get(self.centrality)
+        leaders = market.centrality.top_k(self.centrality, num_leaders)
+        recipients = zip(leaders.tolist(), centrality[leaders].tolist())
 
-        total_degree = sum([degree for agent,degree in recipients])
+        total_degree = float(centrality[leaders].sum())
 
         for id, degree in recipients:
             agent = market.agent_structure.get_agent(id)
 
-            add = (int(degree)/total_degree) * self.total_coin
+            add = degree / total_degree * self.total_coin
 
-            agent.holdings[self.coin.name] = agent.holdings.get(self.coin.name, 0) + add
-            agent.average_buy_prices[self.coin] = self.coin.price
+            self.credit(market, agent, add)
             total_airdropped += add
             total_value_airdropped += add * self.coin.price
 
@@ -117,52 +196,20 @@ class ProportionalLeaderAirdropStrategy(AirdropStrategy):
     :param time
     :param percentage
     :param threshold
+    :param centrality - the measure leaders are ranked by, see CentralityIndex.MEASURES
     """
-    def __init__(self, coin, time, percentage, threshold):
+    def __init__(self, coin, time, percentage, threshold, centrality='degree'):
         super().__init__(coin, time, percentage)
         self.threshold = threshold
+        self.centrality = centrality
 
     def do_airdrop(self, market):
-        total_airdropped = 0
-        total_value_airdropped = 0
         # Determine the number of leaders to target
         num_leaders = int(len(market.agent_structure.agents) * self.percentage)
 
-        # Get the nodes sorted by their degree (influence)
-        agent_degrees = dict(market.network.degree())
-        agent_degrees = sorted(agent_degrees.items(), key=lambda x: x[1], reverse=True)
-
-        recipients = agent_degrees[:num_leaders]
-
-        for id, degree in recipients:
-            agent = market.agent_structure.get_agent(id)
-
-            if isinstance(market.network, nx.DiGraph):
-                neighbors = list(market.network.predecessors(id))
-            else:
-                neighbors = list(market.network[id])
-
-            total_neighbor_coin_value = sum(
-                market.agent_structure.get_agent(neighbor).holdings.get(self.coin.name, 0) * self.coin.price for
-                neighbor in
-                neighbors)
-
-            total_neighbor_portfolio_value = sum(
-                market.agent_structure.get_agent(neighbor).get_total_portfolio_value(market) for neighbor in neighbors)
-
-            add = (self.threshold * total_neighbor_portfolio_value - total_neighbor_coin_value) / self.coin.price
-            add = max(0, add)
-
-            # print(id, total_neighbor_coin_value, total_neighbor_portfolio_value, add)
-
-            agent.holdings[self.coin.name] = agent.holdings.get(self.coin.name, 0) + add
-            agent.average_buy_prices[self.coin] = self.coin.price
-            total_airdropped += add
-            total_value_airdropped += add * self.coin.price
-
-        print(
-            f"ProportionalLeaderAirdropStrategy airdropped {total_airdropped} {self.coin.name} for a total of ${total_value_airdropped} at time {self.time} ")
-        self.amount_airdropped = total_value_airdropped
+        # Get the most central nodes (influence)
+        recipients = market.centrality.top_k(self.centrality, num_leaders)
+        self.proportional_airdrop(market, recipients, self.threshold)
 
     def select_recipients(self, market):
         pass
@@ -180,74 +227,156 @@ class RandomProportionalAirdropStrategy(AirdropStrategy):
         self.threshold = threshold  # This is the target threshold percentage of crypto to total assets
 
     def do_airdrop(self, market):
-        total_airdropped = 0
-        total_value_airdropped = 0
-
         # Determine the number of leaders to target
-        recipients = random.choices(market.agent_structure.agents, k=int(market.num_agents * self.percentage))
+        recipients = market.rng.choices(market.agent_structure.agents, k=int(market.num_agents * self.percentage))
         recipients = [agent.id for agent in recipients]
+        self.proportional_airdrop(market, recipients, self.threshold)
 
-        for id in recipients:
-            agent = market.agent_structure.get_agent(id)
+    def select_recipients(self, market):
+        pass
 
-            if isinstance(market.network, nx.DiGraph):
-                neighbors = list(market.network.predecessors(id))
-            else:
-                neighbors = list(market.network[id])
+    def get_type(self):
+        return "RandomProportionalAirdropStrategy"
 
-            total_neighbor_coin_value = sum(
-                market.agent_structure.get_agent(neighbor).holdings.get(self.coin.name, 0) * self.coin.price for
-                neighbor in
-                neighbors)
 
-            total_neighbor_portfolio_value = sum(
-                market.agent_structure.get_agent(neighbor).get_total_portfolio_value(market) for neighbor in neighbors)
+class LeaderAirdropStrategy(AirdropStrategy):
+    """
+    Distributes coins to nodes with the highest degrees
+    :param coin
+    :param time
+    :param percentage
+    :param amount
+    :param centrality - the measure leaders are ranked by, see CentralityIndex.MEASURES
+    """
 
-            add = (self.threshold * total_neighbor_portfolio_value - total_neighbor_coin_value) / self.coin.price
-            add = max(0, add)
+    def __init__(self, coin, time, percentage, amount, centrality='degree'):
+        super().__init__(coin, time, percentage)
+        self.amount = amount
+        self.centrality = centrality
 
-            # print(id, total_neighbor_coin_value, total_neighbor_portfolio_value, add)
 
-            agent.holdings[self.coin.name] = agent.holdings.get(self.coin.name, 0) + add
-            agent.average_buy_prices[self.coin] = self.coin.price
-            total_airdropped += add
-            total_value_airdropped += add * self.coin.price
+    def select_recipients(self, market):
+        # Determine the number of leaders to target
+        num_leaders = int(len(market.agent_structure.agents) * self.percentage)
+
+        # Get the most central nodes (influence)
+        return market.centrality.top_k(self.centrality, num_leaders).tolist()
+
+    def do_airdrop(self, market):
+        recipients = self.select_recipients(market)
+        total_airdropped = 0
+        total_value_airdropped = 0
+        for id in recipients:
+            agent = market.agent_structure.get_agent(id)
+            self.credit(market, agent, self.amount)
+            total_airdropped += self.amount
+            total_value_airdropped += self.amount * self.coin.price
 
         print(
             f"{self.get_type()} airdropped {total_airdropped} {self.coin.name} for a total of ${total_value_airdropped} at time {self.time} ")
         self.amount_airdropped = total_value_airdropped
 
-    def select_recipients(self, market):
-        pass
-
     def get_type(self):
-        return "RandomProportionalAirdropStrategy"
+        return "LeaderAirdropStrategy"
 
 
-class LeaderAirdropStrategy(AirdropStrategy):
+class CELFAirdropStrategy(AirdropStrategy):
     """
-    Distributes coins to nodes with the highest degrees
-    :param market
+    Spends a budget of total_coins on the recipients with the largest simulated influence: recipients are picked greedily
+    by the marginal gain in cascade size estimated by a HerdingCascadeModel, using CELF lazy evaluation
     :param coin
-    :param percentage
+    :param time
+    :param total_coins - coin budget, every recipient gets amount of it
     :param amount
+    :param candidates - only the top candidates by candidate_centrality are considered, None for every agent
+    :param candidate_centrality - see CentralityIndex.MEASURES, also decides between recipients of equal gain
+    :param samples - Monte Carlo cascades per spread estimate
+    :param rounds - rounds each cascade runs for
+    :param processes - worker processes used to estimate the spread of every candidate, see celf
+    :param seed - seed of the cascade model, independent of the market's rng
     """
 
-    def __init__(self, market, coin, percentage, amount):
-        super().__init__(market, coin, percentage)
+    def __init__(self, coin, time, total_coins, amount, candidates=200, candidate_centrality='degree', samples=64,
+                 rounds=10, processes=None, seed=0):
+        super().__init__(coin, time, None)
+        self.total_coins = total_coins
         self.amount = amount
-
+        self.candidates = candidates
+        self.candidate_centrality = candidate_centrality
+        self.samples = samples
+        self.rounds = rounds
+        self.processes = processes
+        self.seed = seed
+        self.expected_spread = 0
 
     def select_recipients(self, market):
-        # Determine the number of leaders to target
-        num_leaders = int(len(market.agent_structure.agents) * self.percentage)
+        model = HerdingCascadeModel(market, self.coin, self.amount, rounds=self.rounds, samples=self.samples,
+                                    seed=self.seed)
+        # Highest candidate_centrality first, which is also the order celf breaks ties in
+        num_candidates = market.num_agents if self.candidates is None else self.candidates
+        candidates = market.centrality.top_k(self.candidate_centrality, num_candidates)
+        num_recipients = int(self.total_coins // self.amount)
+        recipients, gains = celf(model, num_recipients, candidates, processes=self.processes)
+        self.percentage = len(recipients) / market.num_agents
+        self.expected_spread = sum(gains)
+        return recipients
+
+    def do_airdrop(self, market):
+        recipients = self.select_recipients(market)
+        total_airdropped = 0
+        total_value_airdropped = 0
+        for id in recipients:
+            agent = market.agent_structure.get_agent(id)
+            self.credit(market, agent, self.amount)
+            total_airdropped += self.amount
+            total_value_airdropped += self.amount * self.coin.price
+
+        print(
+            f"{self.get_type()} airdropped {total_airdropped} {self.coin.name} for a total of ${total_value_airdropped} at time {self.time}, expected spread {self.expected_spread:.1f} ")
+        self.amount_airdropped = total_value_airdropped
+
+    def get_type(self):
+        return "CELFAirdropStrategy"
+
+    def get_descriptor(self):
+        return f"{self.get_type()}({self.coin.name} {self.total_coins} in {self.amount})"
+
+
+class IMMAirdropStrategy(AirdropStrategy):
+    """
+    Spends a budget of total_coins on the recipients chosen by IMM over reverse reachable sets, under an independent
+    cascade calibrated round by round to the herding rules of the market's agents (see calibrated_edge_probabilities).
+    Scales to networks far too big for simulation based greedy selection
+    :param coin
+    :param time
+    :param total_coins - coin budget, every recipient gets amount of it
+    :param amount
+    :param epsilon - approximation error, the seeds are within (1 - 1/e - epsilon) of optimal under the cascade model
+    :param ell - the guarantee holds with probability 1 - n^-ell
+    :param horizon - number of rounds the cascade gets to spread, like the rounds of HerdingCascadeModel
+    :param max_sets - optional cap on the number of RR sets
+    :param seed - seed of the RR set sampling, independent of the market's rng
+    """
 
-        # Get the nodes sorted by their degree (influence)
-        agent_degrees = dict(market.network.degree())
-        agent_degrees = sorted(agent_degrees.items(), key=lambda x: x[1], reverse=True)
+    def __init__(self, coin, time, total_coins, amount, epsilon=0.5, ell=1, horizon=10, max_sets=None, seed=0):
+        super().__init__(coin, time, None)
+        self.total_coins = total_coins
+        self.amount = amount
+        self.epsilon = epsilon
+        self.ell = ell
+        self.horizon = horizon
+        self.max_sets = max_sets
+        self.seed = seed
+        self.expected_spread = 0
 
-        recipients = agent_degrees[:num_leaders]
-        recipients = [agent for agent, degree in recipients]
+    def select_recipients(self, market):
+        probabilities, seed_probabilities = calibrated_edge_probabilities(market, self.coin, self.amount)
+        num_recipients = int(self.total_coins // self.amount)
+        recipients, self.expected_spread = imm(market.aggregates.neighbors, probabilities, num_recipients,
+                                               epsilon=self.epsilon, ell=self.ell,
+                                               rng=np.random.default_rng(self.seed), max_sets=self.max_sets,
+                                               seed_probabilities=seed_probabilities, horizon=self.horizon)
+        self.percentage = len(recipients) / market.num_agents
         return recipients
 
     def do_airdrop(self, market):
@@ -256,17 +385,19 @@ class LeaderAirdropStrategy(AirdropStrategy):
         total_value_airdropped = 0
         for id in recipients:
             agent = market.agent_structure.get_agent(id)
-            agent.holdings[self.coin.name] = agent.holdings.get(self.coin.name, 0) + self.amount
-            agent.average_buy_prices[self.coin] = self.coin.price
+            self.credit(market, agent, self.amount)
             total_airdropped += self.amount
             total_value_airdropped += self.amount * self.coin.price
 
         print(
-            f"{self.get_type()} airdropped {total_airdropped} {self.coin.name} for a total of ${total_value_airdropped} at time {self.time} ")
+            f"{self.get_type()} airdropped {total_airdropped} {self.coin.name} for a total of ${total_value_airdropped} at time {self.time}, expected spread {self.expected_spread:.1f} ")
         self.amount_airdropped = total_value_airdropped
 
     def get_type(self):
-        return "LeaderAirdropStrategy"
+        return "IMMAirdropStrategy"
+
+    def get_descriptor(self):
+        return f"{self.get_type()}({self.coin.name} {self.total_coins} in {self.amount}, epsilon={self.epsilon})"
 
 
 class BiggestHoldersAirdropStrategy(AirdropStrategy):
@@ -301,8 +432,7 @@ class BiggestHoldersAirdropStrategy(AirdropStrategy):
         total_value_airdropped = 0
         for id in recipients:
             agent = market.agent_structure.get_agent(id)
-            agent.holdings[self.coin.name] = agent.holdings.get(self.coin.name, 0) + self.amount
-            agent.average_buy_prices[self.coin] = self.coin.price
+            self.credit(market, agent, self.amount)
             total_airdropped += self.amount
             total_value_airdropped += self.amount * self.coin.price
 
@@ -334,49 +464,15 @@ class ProportionalBiggestHoldersAirdropStrategy(AirdropStrategy):
         self.threshold = threshold
 
     def select_recipients(self, market):
-        sorted_agents = sorted(market.agent_structure.agents,
-                               key=lambda agent: agent.holdings.get(self.existing_coin.name, 0),
-                               reverse=True)
+        # Stable sort on the activation order, so ties are taken in the same order as sorting the agents
+        ids = np.array([agent.id for agent in market.agent_structure.agents], dtype=np.int64)
+        existing_holdings = market.portfolios.holdings[ids, self.existing_coin.index]
         num_recipients = int(market.num_agents * self.percentage)
-        sorted_agents = sorted_agents[:num_recipients]
-        sorted_agents = [agent.id for agent in sorted_agents]
-        return sorted_agents
+        return ids[np.argsort(-existing_holdings, kind='stable')[:num_recipients]]
 
     def do_airdrop(self, market):
-        total_airdropped = 0
-        total_value_airdropped = 0
-
         recipients = self.select_recipients(market)
-
-        for id in recipients:
-            agent = market.agent_structure.get_agent(id)
-
-            if isinstance(market.network, nx.DiGraph):
-                neighbors = list(market.network.predecessors(id))
-            else:
-                neighbors = list(market.network[id])
-
-            total_neighbor_coin_value = sum(
-                market.agent_structure.get_agent(neighbor).holdings.get(self.coin.name, 0) * self.coin.price for
-                neighbor in
-                neighbors)
-
-            total_neighbor_portfolio_value = sum(
-                market.agent_structure.get_agent(neighbor).get_total_portfolio_value(market) for neighbor in neighbors)
-
-            add = (self.threshold * total_neighbor_portfolio_value - total_neighbor_coin_value) / self.coin.price
-            add = max(0, add)
-
-            print(id, total_neighbor_coin_value, total_neighbor_portfolio_value, add)
-
-            agent.holdings[self.coin.name] = agent.holdings.get(self.coin.name, 0) + add
-            agent.average_buy_prices[self.coin] = self.coin.price
-            total_airdropped += add
-            total_value_airdropped += add * self.coin.price
-
-        print(
-            f"{self.get_type()} airdropped {total_airdropped} {self.coin.name} for a total of ${total_value_airdropped} at time {self.time} ")
-        self.amount_airdropped = total_value_airdropped
+        self.proportional_airdrop(market, recipients, self.threshold)
 
     def get_type(self):
         return "ProportionalBiggestHoldersAirdropStrategy"
@@ -0,0 +1,218 @@
+import multiprocessing
+import os
+
+import imageio
+import networkx as nx
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import to_rgba
+from matplotlib.figure import Figure
+from PIL import GifImagePlugin, Image
+
+
+class NetworkAnimator:
+    """
+    Renders the frames of a network animation, one per network state, without redrawing the graph
+
+    Edges (and everything else that never changes) are drawn once into a cached background. A frame restores the
+    background and only draws the nodes, with their colors set from the state, and the title (blitting), then hands the
+    canvas back as an RGB array
+
+    :param network - networkx graph
+    :param positions - dict or (nodes, 2) array of node positions, a spring layout with layout_seed if None
+    :param layout_seed
+    :param with_labels - draw node labels, by default only for networks of up to 100 nodes
+    :param node_size
+    :param colors - (color of nodes not in the state, color of nodes in it)
+    :param figsize
+    :param dpi
+    """
+
+    def __init__(self, network, positions=None, layout_seed=42, with_labels=None, node_size=300,
+                 colors=('grey', 'green'), figsize=(8, 6), dpi=100):
+        nodes = list(network)
+        if positions is None:
+            positions = nx.spring_layout(network, seed=layout_seed)
+        elif not isinstance(positions, dict):
+            positions = dict(zip(nodes, np.asarray(positions)))
+        if with_labels is None:
+            with_labels = len(nodes) <= 100
+        # Frames give the state by node id, nodes are drawn in the graph's order
+        self.order = np.array(nodes)
+        self.palette = np.array([to_rgba(color) for color in colors])
+
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        ax = self.figure.add_subplot()
+        nx.draw_networkx_edges(network, positions, ax=ax, node_size=node_size)
+        self.nodes = nx.draw_networkx_nodes(network, positions, ax=ax, node_size=node_size,
+                                            node_color=[colors[0]] * len(nodes))
+        self.labels = list(nx.draw_networkx_labels(network, positions, ax=ax).values()) if with_labels else []
+        ax.set_axis_off()
+        self.title = ax.set_title(' ')
+        self.ax = ax
+
+        # Everything drawn per frame is left out of the background
+        self.animated = [self.nodes, *self.labels, self.title]
+        for artist in self.animated:
+            artist.set_animated(True)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+
+    def render(self, state, title=''):
+        """
+        :param state - bool array, by node id, of the nodes to color
+        :param title
+        :return: (height, width, 3) uint8 array
+        """
+        self.nodes.set_facecolor(self.palette[np.asarray(state, dtype=bool)[self.order].astype(np.int64)])
+        self.title.set_text(title)
+        self.canvas.restore_region(self.background)
+        for artist in self.animated:
+            self.ax.draw_artist(artist)
+        return np.asarray(self.canvas.buffer_rgba())[:, :, :3].copy()
+
+    def gif_palette(self):
+        """
+        Palette for every frame of a GIF, taken from a frame with half of the nodes in each color so it holds both
+        colors and their blends with the edges and the background. It has at most 255 colors, GifWriter takes the last
+        index for transparency
+        :return: palette 'P' mode PIL image
+        """
+        frame = self.render(np.arange(len(self.order)) % 2 == 0, 'Iteration 0123456789')
+        return Image.fromarray(frame).quantize(colors=255, dither=Image.Dither.NONE)
+
+    def render_indexed(self, state, palette, title=''):
+        """
+        render, mapped onto the colors of palette (see gif_palette)
+        :return: (height, width) uint8 array of palette indices
+        """
+        return np.asarray(Image.fromarray(self.render(state, title)).quantize(palette=palette, dither=Image.Dither.NONE))
+
+
+class GifWriter:
+    """
+    GIF writer for frames already mapped onto one shared palette, which saves the palette search imageio's GIF writer does
+    on every frame. The header and global palette are written with the first frame and every frame is encoded and
+    written as soon as it's appended, so memory doesn't grow with the length of the animation. Like Pillow's own GIF
+    writer, a frame only stores the box around the pixels that changed since the previous one, with the unchanged pixels
+    in it transparent, and is drawn over the previous frame
+    :param path
+    :param fps
+    :param palette - 'P' mode PIL image whose palette the frames index, with at most 255 colors (see gif_palette)
+    """
+
+    def __init__(self, path, fps, palette):
+        self.path = path
+        self.duration = 1000 / fps
+        colors = palette.getpalette()
+        # The first index after the palette's colors is transparent
+        self.transparency = len(colors) // 3
+        if self.transparency > 255:
+            raise ValueError("GifWriter needs a palette with at most 255 colors")
+        self.palette = colors + [0, 0, 0]
+        self.file = None
+        self.previous = None
+
+    def _image(self, pixels):
+        image = Image.frombytes('P', (pixels.shape[1], pixels.shape[0]), np.ascontiguousarray(pixels).tobytes())
+        image.putpalette(self.palette)
+        return image
+
+    def append_data(self, frame):
+        if self.file is None:
+            self.file = open(self.path, 'wb')
+            # Logical screen descriptor, global color table and the looping extension
+            self.file.writelines(GifImagePlugin.getheader(self._image(frame), info={'loop': 0})[0])
+            top, bottom, left, right = 0, frame.shape[0], 0, frame.shape[1]
+        else:
+            changed = frame != self.previous
+            rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+            # An unchanged frame still needs an image, one pixel is the smallest
+            top, bottom, left, right = (rows[0], rows[-1] + 1, cols[0], cols[-1] + 1) if len(rows) else (0, 1, 0, 1)
+        box = frame[top:bottom, left:right]
+        if self.previous is not None:
+            box = np.where(box == self.previous[top:bottom, left:right], np.uint8(self.transparency), box)
+        self.file.writelines(GifImagePlugin.getdata(self._image(box), offset=(int(left), int(top)),
+                                                    duration=self.duration, transparency=self.transparency))
+        self.previous = frame
+
+    def close(self):
+        if self.file is not None:
+            self.file.write(b';')
+            self.file.close()
+            self.file = None
+            self.previous = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_writer(output_filename, fps, animator):
+    """
+    Writer for the animation, a GifWriter for .gif and otherwise anything imageio's ffmpeg plugin can write (e.g. .mp4,
+    which needs the imageio-ffmpeg package)
+    :return: (writer, palette of the frames it takes, None for RGB frames)
+    """
+    if output_filename.lower().endswith('.gif'):
+        palette = animator.gif_palette()
+        return GifWriter(output_filename, fps, palette), palette
+    return imageio.get_writer(output_filename, fps=fps), None
+
+
+# Animator, states and palette the forked render workers inherit, set by render_animation before the pool is created
+_worker = {}
+
+
+def _render_frame(animator, network_states, iteration, palette):
+    if palette is None:
+        return animator.render(network_states[iteration], f'Iteration {iteration}')
+    return animator.render_indexed(network_states[iteration], palette, f'Iteration {iteration}')
+
+
+def _render_chunk(span):
+    start, end = span
+    return np.stack([_render_frame(_worker['animator'], _worker['network_states'], iteration, _worker['palette'])
+                     for iteration in range(start, end)])
+
+
+def render_animation(network, network_states, output_filename, fps=5, positions=None, processes=1, chunk_size=16,
+                     **animator_kwargs):
+    """
+    Writes an animation of the network with one frame per state, handing frames to the writer as they are rendered (no
+    temporary files)
+
+    The graph is drawn once, before any worker starts. With processes > 1, frames are rendered in chunks by forked
+    workers that inherit the drawn figure, and written in order as they come back. GIF frames are mapped onto their
+    palette by whoever renders them, so the writer only has to encode them
+    :param network - networkx graph
+    :param network_states - (iterations, nodes) bool array of the nodes to color at every step, by node id
+    :param output_filename - .gif, or a video format such as .mp4 (see open_writer)
+    :param fps
+    :param positions - node positions, a spring layout if None
+    :param processes - number of render processes, all cores if None
+    :param chunk_size - frames per task of a render process
+    :param animator_kwargs - see NetworkAnimator
+    """
+    animator = NetworkAnimator(network, positions, **animator_kwargs)
+    processes = processes or os.cpu_count() or 1
+    spans = [(start, min(start + chunk_size, len(network_states))) for start in range(0, len(network_states), chunk_size)]
+
+    writer, palette = open_writer(output_filename, fps, animator)
+    with writer:
+        if processes == 1 or len(spans) <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            for iteration in range(len(network_states)):
+                writer.append_data(_render_frame(animator, network_states, iteration, palette))
+            return
+        _worker.update(animator=animator, network_states=network_states, palette=palette)
+        try:
+            context = multiprocessing.get_context('fork')
+            with context.Pool(min(processes, len(spans))) as pool:
+                for frames in pool.imap(_render_chunk, spans):
+                    for frame in frames:
+                        writer.append_data(frame)
+        finally:
+            _worker.clear()
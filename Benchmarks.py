@@ -0,0 +1,298 @@
+"""
+Scaling benchmarks of the simulation, compared against a stored JSON baseline
+
+    python Benchmarks.py                                   # every suite at the default sizes
+    python Benchmarks.py --sizes 300 10000 --suites simulate --engines vectorized
+    python Benchmarks.py --sizes 300 10000 --save-baseline # store the results as the new baseline
+    python Benchmarks.py --baseline benchmarks_baseline.json --tolerance 0.2
+
+Suites:
+- simulate: CryptoMarket.simulate for every network type, agent mix and engine. Reports setup time (population, network
+  and budgets), steps per second, agent activations per second (agents * coins * steps per second) and peak RSS
+- airdrops: do_airdrop of every airdrop strategy on a scale free market
+- networks: every network generator on its own
+
+Every case runs in a fresh forked process, so its peak RSS is its own. Cases bigger than a generator or strategy can
+handle (see SIZE_LIMITS) are skipped. The process exits with status 1 when a metric regressed by more than the
+tolerance against the baseline
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+from Market import *
+from AgentStructure import AgentStructure
+from RandomStreams import SimulationRNG
+
+DEFAULT_SIZES = (300, 10_000, 100_000, 1_000_000)
+
+# Agent type shares of each population
+AGENT_MIXES = {
+    'rational_probabilistic': ((RationalAgent, 0.3), (NeighborhoodProbabilisticInvestor, 0.7)),
+    'herding': ((LinearHerdingAgent, 0.5), (BudgetProportionHerdingAgent, 0.5)),
+    'mixed': ((RationalAgent, 0.25), (LinearHerdingAgent, 0.25), (BudgetProportionHerdingAgent, 0.25),
+              (NeighborhoodProbabilisticInvestor, 0.25)),
+}
+
+ENGINES = ('sequential', 'vectorized')
+
+AIRDROP_STRATEGIES = {
+    'random': lambda coin, existing: RandomAirdropStrategy(coin, 0.0, 0.1, 1000),
+    'more_to_leaders': lambda coin, existing: MoreToLeaders(coin, 0.0, 0.1, 1_000_000),
+    'proportional_leader': lambda coin, existing: ProportionalLeaderAirdropStrategy(coin, 0.0, 0.1, 0.2),
+    'random_proportional': lambda coin, existing: RandomProportionalAirdropStrategy(coin, 0.0, 0.1, 0.2),
+    'leader': lambda coin, existing: LeaderAirdropStrategy(coin, 0.0, 0.1, 1000),
+    'celf': lambda coin, existing: CELFAirdropStrategy(coin, 0.0, 20_000, 1000, processes=1),
+    'imm': lambda coin, existing: IMMAirdropStrategy(coin, 0.0, 20_000, 1000),
+    'biggest_holders': lambda coin, existing: BiggestHoldersAirdropStrategy(coin, 0.0, 0.1, 1000, existing),
+    'proportional_biggest_holders': lambda coin, existing: ProportionalBiggestHoldersAirdropStrategy(coin, 0.0, 0.1, 0.2,
+                                                                                                    existing),
+}
+
+# Largest number of agents each case is run at. The random generators visit every pair of nodes, and the core periphery
+# ones get denser with size at their default parameters. The sequential engine and CELF are simply too slow beyond this
+SIZE_LIMITS = {
+    'network:random': 10_000,
+    'network:directed_random': 10_000,
+    'network:core_periphery': 10_000,
+    'network:directed_core_periphery': 10_000,
+    'network:multiple_core_periphery': 10_000,
+    'network:directed_multiple_core_periphery': 10_000,
+    'engine:sequential': 100_000,
+    'airdrop:celf': 10_000,
+    'airdrop:imm': 100_000,
+}
+
+# Whether a higher value of a metric is better, metrics not listed here are not compared
+METRICS = {
+    'steps_per_second': True,
+    'activations_per_second': True,
+    'setup_seconds': False,
+    'seconds': False,
+    'peak_rss_mb': False,
+}
+
+
+def within_limit(kind, name, num_agents):
+    return num_agents <= SIZE_LIMITS.get(f"{kind}:{name}", float('inf'))
+
+
+def build_market(num_agents, network_type, mix, airdrop_strategy=None, seed=0):
+    """
+    Benchmark scenario: Bitcoin and a meme coin, with a small random airdrop of the meme coin unless another strategy
+    is given
+    """
+    rng = SimulationRNG(seed)
+    btc = Cryptocurrency('Bitcoin', 1.00, ismeme=False)
+    wif = Cryptocurrency('DogWifHat', .25, ismeme=True)
+    agent_structure = AgentStructure(num_agents, rng=rng)
+    remaining = num_agents
+    for k, (agent_class, share) in enumerate(AGENT_MIXES[mix]):
+        number = remaining if k == len(AGENT_MIXES[mix]) - 1 else int(num_agents * share)
+        agent_structure.add_agents(agent_class, number)
+        remaining -= number
+    if airdrop_strategy is None:
+        strategies = [RandomAirdropStrategy(wif, 0.0, 0.05, 1000)]
+    else:
+        strategies = [AIRDROP_STRATEGIES[airdrop_strategy](wif, btc)]
+    market = CryptoMarket(network_type, [btc, wif], strategies, agent_structure, rng=rng, network_seed=seed)
+    agent_structure.budgets_based_on_popularity(market)
+    return market
+
+
+def bench_simulate(num_agents, network_type, mix, engine, steps, sub_steps):
+    start = time.perf_counter()
+    market = build_market(num_agents, network_type, mix)
+    setup = time.perf_counter() - start
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        market.simulate(steps, engine=engine, sub_steps=sub_steps, resolution='step')
+    elapsed = time.perf_counter() - start
+    return {
+        'setup_seconds': setup,
+        'seconds': elapsed,
+        'steps_per_second': steps / elapsed,
+        'activations_per_second': num_agents * len(market.coins) * steps / elapsed,
+    }
+
+
+def bench_airdrop(num_agents, strategy):
+    start = time.perf_counter()
+    market = build_market(num_agents, 'scale_free', 'mixed', airdrop_strategy=strategy)
+    setup = time.perf_counter() - start
+    # Give the biggest holder strategies something to rank
+    holders = np.arange(0, num_agents, 3)
+    market.portfolios.holdings[holders, market.coins[0].index] = holders % 7
+    market.aggregates.rebuild()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        market.airdrop_strategies[0].do_airdrop(market)
+    return {'setup_seconds': setup, 'seconds': time.perf_counter() - start}
+
+
+def bench_network(num_agents, network_type):
+    start = time.perf_counter()
+    adjacency, _ = generate_network(network_type, num_agents, NETWORK_PARAMS[network_type], seed=0)
+    return {'seconds': time.perf_counter() - start, 'edges': int(adjacency.nnz)}
+
+
+def _isolated(connection, function, args):
+    try:
+        result = function(*args)
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+    except Exception as error:
+        result = {'error': f"{type(error).__name__}: {error}"}
+    connection.send(result)
+    connection.close()
+
+
+def run_isolated(function, *args):
+    """
+    Runs one case in a forked process and returns its metrics, or {'error': ...} if it failed or was killed
+    """
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_isolated, args=(sender, function, args))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        result = {'error': f"killed with exit code {process.exitcode}"}
+    elif process.exitcode and 'error' not in result:
+        result = {'error': f"exit code {process.exitcode}"}
+    return result
+
+
+def cases(options):
+    """
+    Yields (name, function, args) of every case selected by the command line options
+    """
+    for num_agents in options.sizes:
+        if 'networks' in options.suites:
+            for network_type in options.network_types:
+                if within_limit('network', network_type, num_agents):
+                    yield f"networks/{network_type}/{num_agents}", bench_network, (num_agents, network_type)
+        if 'simulate' in options.suites:
+            for network_type in options.network_types:
+                for mix in options.mixes:
+                    for engine in options.engines:
+                        if within_limit('network', network_type, num_agents) and within_limit('engine', engine,
+                                                                                              num_agents):
+                            sub_steps = 1 if engine == 'sequential' else options.sub_steps
+                            yield (f"simulate/{network_type}/{mix}/{engine}/{num_agents}", bench_simulate,
+                                   (num_agents, network_type, mix, engine, options.steps, sub_steps))
+        if 'airdrops' in options.suites:
+            for strategy in options.airdrops:
+                if within_limit('airdrop', strategy, num_agents):
+                    yield f"airdrops/{strategy}/{num_agents}", bench_airdrop, (num_agents, strategy)
+
+
+def compare(results, baseline, tolerance, min_seconds=0.05):
+    """
+    :return: list of (case, metric, baseline value, current value, relative change) of the metrics that got worse by
+    more than tolerance. Cases that took less than min_seconds in the baseline are too noisy to compare. A case that
+    fails now but succeeded in the baseline is a regression of metric 'error', with the error as current value and no
+    relative change
+    """
+    regressions = []
+    for name, metrics in results.items():
+        reference = baseline.get(name)
+        if not reference or 'error' in reference:
+            continue
+        if 'error' in metrics:
+            regressions.append((name, 'error', None, metrics['error'], None))
+            continue
+        if reference.get('seconds', 0) < min_seconds:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if metric not in metrics or not reference.get(metric):
+                continue
+            change = metrics[metric] / reference[metric] - 1
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((name, metric, reference[metric], metrics[metric], change))
+    return regressions
+
+
+def format_metrics(metrics):
+    if 'error' in metrics:
+        return f"ERROR {metrics['error']}"
+    return "  ".join(f"{metric}={value:,.3f}" if isinstance(value, float) else f"{metric}={value:,}"
+                     for metric, value in metrics.items())
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Scaling benchmarks of the crypto market simulation")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    parser.add_argument('--suites', nargs='+', default=['networks', 'simulate', 'airdrops'],
+                        choices=['networks', 'simulate', 'airdrops'])
+    parser.add_argument('--network-types', nargs='+', default=list(NETWORK_PARAMS), choices=list(NETWORK_PARAMS))
+    parser.add_argument('--mixes', nargs='+', default=list(AGENT_MIXES), choices=list(AGENT_MIXES))
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--airdrops', nargs='+', default=list(AIRDROP_STRATEGIES), choices=list(AIRDROP_STRATEGIES))
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--sub-steps', type=int, default=10, help="sub steps of the vectorized engine")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', default='benchmarks_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help="merge the results into the baseline file")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="relative change flagged as a regression")
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help="cases faster than this in the baseline are not compared")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_arguments(argv)
+    results = {}
+    for name, function, args in cases(options):
+        results[name] = run_isolated(function, *args)
+        print(f"{name}: {format_metrics(results[name])}", flush=True)
+
+    report = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                        'cpus': os.cpu_count()},
+        'cases': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as file:
+            baseline = json.load(file)['cases']
+
+    regressions = compare(results, baseline, options.tolerance, options.min_seconds)
+    compared = sum(name in baseline for name in results)
+    print(f"\n{compared} of {len(results)} cases compared against {options.baseline}")
+    for name, metric, reference, current, change in regressions:
+        if metric == 'error':
+            print(f"REGRESSION {name} failed: {current}")
+        else:
+            print(f"REGRESSION {name} {metric}: {reference:,.3f} -> {current:,.3f} ({change:+.1%})")
+
+    if options.save_baseline:
+        # Cases that weren't run keep their stored values
+        report['cases'] = {**baseline, **{name: metrics for name, metrics in results.items() if 'error' not in metrics}}
+        with open(options.baseline, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+        print(f"Saved the baseline to {options.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,133 +1,229 @@
-import random
+import inspect
 
 import networkx as nx
+import numpy as np
+from scipy import sparse
 
+from RandomStreams import default_rng
+from SparseNetwork import to_networkx
 
-def create_core_periphery_network(num_agents, core_percent = 0.2, core_connected_prob = 0.5, periphery_connected_prob = 0.1):
-    G = nx.Graph()
-    core_size = int(num_agents * core_percent)  # Let's say 20% of nodes are core nodes
-
-    # Add all agents as nodes
-    G.add_nodes_from(range(num_agents))
-
-    # Connect each core node with other core nodes
-    for i in range(core_size):
-        for j in range(i + 1, core_size):
-            G.add_edge(i, j)
-
-    # Connect core nodes to periphery nodes
-    for i in range(core_size):
-        for j in range(core_size, num_agents):
-            if random.random() < core_connected_prob:  # Randomly connect core to periphery
-                G.add_edge(i, j)
-
-    # Optionally, add some random connections among periphery nodes to increase complexity
-    for i in range(core_size, num_agents):
-        for j in range(i + 1, num_agents):
-            if random.random() < periphery_connected_prob:  # Sparse connectivity among periphery
-                G.add_edge(i, j)
-
-    return G
 
+def sample_block(rng, num_rows, num_cols, probability, row_offset=0, col_offset=0, keep=None):
+    """
+    Samples every (row, col) pair of a num_rows x num_cols block independently with the given probability.
+    Successes are found by geometric skipping, so the cost is proportional to the number of edges rather than pairs
+    :param rng - SimulationRNG
+    :param keep - optional filter on the local (rows, cols) of the sampled pairs, e.g. to drop self loops
+    :return: (rows, cols) of the sampled edges, shifted by the offsets
+    """
+    num_pairs = num_rows * num_cols
+    if num_pairs == 0 or probability <= 0:
+        positions = np.empty(0, dtype=np.int64)
+    elif probability >= 1:
+        positions = np.arange(num_pairs, dtype=np.int64)
+    else:
+        chunks = []
+        position = -1
+        expected = num_pairs * probability
+        while True:
+            # Gaps between successes of a Bernoulli process are geometric
+            batch = int(expected + 5 * np.sqrt(expected) + 16)
+            gaps = rng.generator.geometric(probability, size=batch)
+            chunk = position + np.cumsum(gaps)
+            if chunk[-1] >= num_pairs:
+                chunks.append(chunk[chunk < num_pairs])
+                break
+            chunks.append(chunk)
+            position = chunk[-1]
+            expected = (num_pairs - position) * probability
+        positions = np.concatenate(chunks)
+
+    rows, cols = np.divmod(positions, num_cols)
+    if keep is not None:
+        mask = keep(rows, cols)
+        rows, cols = rows[mask], cols[mask]
+    return rows + row_offset, cols + col_offset
+
+
+def assemble_adjacency(num_agents, blocks, directed):
+    """
+    Builds a CSR adjacency matrix (A[u, v] = 1 for an edge u -> v) from a list of (rows, cols) edge blocks. Undirected
+    edges are mirrored
+    """
+    rows = np.concatenate([block[0] for block in blocks]) if blocks else np.empty(0, dtype=np.int64)
+    cols = np.concatenate([block[1] for block in blocks]) if blocks else np.empty(0, dtype=np.int64)
+    if not directed:
+        rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+    adjacency = sparse.csr_array((np.ones(len(rows)), (rows, cols)), shape=(num_agents, num_agents))
+    adjacency.sum_duplicates()
+    adjacency.data[:] = 1
+    return adjacency
+
+
+def core_periphery_adjacency(num_agents, core_percent=0.2, core_connected_prob=0.5, periphery_connected_prob=0.1,
+                             rng=None, core_core_prob=1):
+    """
+    Undirected core periphery network as a CSR adjacency matrix, see create_core_periphery_network. The core is fully
+    connected unless core_core_prob is below 1
+    """
+    rng = rng if rng is not None else default_rng()
+    core_size = int(num_agents * core_percent)  # Let's say 20% of nodes are core nodes
+    periphery_size = num_agents - core_size
+    upper = lambda rows, cols: rows < cols
+
+    blocks = [
+        # Connect each core node with other core nodes
+        sample_block(rng, core_size, core_size, core_core_prob, keep=upper),
+        # Connect core nodes to periphery nodes
+        sample_block(rng, core_size, periphery_size, core_connected_prob, col_offset=core_size),
+        # Optionally, add some random connections among periphery nodes to increase complexity
+        sample_block(rng, periphery_size, periphery_size, periphery_connected_prob, core_size, core_size, keep=upper),
+    ]
+    return assemble_adjacency(num_agents, blocks, directed=False)
+
+
+def directed_core_periphery_adjacency(num_agents, core_percent=0.2, core_to_core_prob=0.5,
+                                      core_to_periphery_prob=0.5, periphery_to_periphery_prob=0.1,
+                                      periphery_to_core_prob=0.01, rng=None):
+    """
+    Directed core periphery network as a CSR adjacency matrix, see create_directed_core_periphery_network
+    """
+    rng = rng if rng is not None else default_rng()
+    core_size = int(num_agents * core_percent)  # Determine the number of core nodes
+    periphery_size = num_agents - core_size
+    no_self_loops = lambda rows, cols: rows != cols
+
+    blocks = [
+        # Connect each core node with other core nodes with a higher probability
+        sample_block(rng, core_size, core_size, core_to_core_prob, keep=no_self_loops),
+        # Connect core nodes to periphery nodes with a higher probability
+        sample_block(rng, core_size, periphery_size, core_to_periphery_prob, col_offset=core_size),
+        # Allow periphery nodes to connect to other periphery nodes with a lower probability
+        sample_block(rng, periphery_size, periphery_size, periphery_to_periphery_prob, core_size, core_size,
+                     keep=no_self_loops),
+        # Rarely allow periphery nodes to influence core nodes
+        sample_block(rng, periphery_size, core_size, periphery_to_core_prob, row_offset=core_size),
+    ]
+    return assemble_adjacency(num_agents, blocks, directed=True)
+
+
+def create_core_periphery_network(num_agents, core_percent = 0.2, core_connected_prob = 0.5, periphery_connected_prob = 0.1,
+                                  rng=None, as_networkx=False):
+    """
+    A dense, fully connected core holding core_percent of the nodes, core to periphery links with probability
+    core_connected_prob and sparse periphery to periphery links with probability periphery_connected_prob
+    :return: CSR adjacency matrix, or a networkx Graph if as_networkx
+    """
+    adjacency = core_periphery_adjacency(num_agents, core_percent, core_connected_prob, periphery_connected_prob, rng)
+    return to_networkx(adjacency, directed=False) if as_networkx else adjacency
 
 
 def create_directed_core_periphery_network(num_agents, core_percent=0.2, core_to_core_prob=0.5,
                                            core_to_periphery_prob=0.5, periphery_to_periphery_prob=0.1,
-                                           periphery_to_core_prob=0.01):
-    G = nx.DiGraph()
-    core_size = int(num_agents * core_percent)  # Determine the number of core nodes
-
-    # Add all agents as nodes
-    G.add_nodes_from(range(num_agents))
-
-    # Connect each core node with other core nodes with a higher probability
-    for i in range(core_size):
-        for j in range(core_size):
-            if i != j and random.random() < core_to_core_prob:
-                G.add_edge(i, j)
+                                           periphery_to_core_prob=0.01, rng=None, as_networkx=False):
+    """
+    Directed core periphery network where the core mostly influences the periphery and only rarely the other way around
+    :return: CSR adjacency matrix, or a networkx DiGraph if as_networkx
+    """
+    adjacency = directed_core_periphery_adjacency(num_agents, core_percent, core_to_core_prob, core_to_periphery_prob,
+                                                  periphery_to_periphery_prob, periphery_to_core_prob, rng)
+    return to_networkx(adjacency, directed=True) if as_networkx else adjacency
 
-    # Connect core nodes to periphery nodes with a higher probability
-    for i in range(core_size):
-        for j in range(core_size, num_agents):
-            if random.random() < core_to_periphery_prob:
-                G.add_edge(i, j)
 
-    # Allow periphery nodes to connect to other periphery nodes with a lower probability
-    for i in range(core_size, num_agents):
-        for j in range(core_size, num_agents):
-            if i != j and random.random() < periphery_to_periphery_prob:
-                G.add_edge(i, j)
 
-    # Rarely allow periphery nodes to influence core nodes
-    for i in range(core_size, num_agents):
-        for j in range(core_size):
-            if random.random() < periphery_to_core_prob:
-                G.add_edge(i, j)
+def community_sizes(total_agents, networks_count):
+    """
+    Splits total_agents into networks_count communities whose sizes differ by at most one
+    """
+    base, remainder = divmod(total_agents, networks_count)
+    return [base + 1 if i < remainder else base for i in range(networks_count)]
 
-    return G
 
+def sparse_scale(size, sparse_above):
+    """
+    Factor the link probabilities of a community of size agents are multiplied by, so that its expected degrees stay
+    those of a community of sparse_above agents. 1 for smaller communities or if sparse_above is None
+    """
+    if sparse_above is None or size <= sparse_above:
+        return 1
+    return sparse_above / size
 
 
-def create_multiple_core_periphery_networks(total_agents, networks_count, interlink_probability, directed=False):
+def multiple_core_periphery_adjacency(sizes, interlink_probability, directed=False, core_percent=0.2, rng=None,
+                                      community_kwargs=None, sparse_above=None):
+    """
+    Core periphery communities joined together through their cores, as a CSR adjacency matrix. Nodes are numbered
+    community by community, each community starting with its core
+    :param sizes - number of agents in each community, sizes may differ
+    :param interlink_probability - probability of a link between any two core nodes of different communities
+    :param directed
+    :param core_percent - share of each community in its core
+    :param rng - SimulationRNG, the shared default stream if None
+    :param community_kwargs - extra arguments for the core periphery builder of each community
+    :param sparse_above - optional community size above which all link probabilities, the builder's defaults included,
+    are scaled down by sparse_scale. The core periphery builders are dense, a community's edges grow with the square
+    of its size otherwise
+    """
+    rng = rng if rng is not None else default_rng()
+    builder = directed_core_periphery_adjacency if directed else core_periphery_adjacency
+    defaults = {name: parameter.default for name, parameter in inspect.signature(builder).parameters.items()
+                if name.endswith('_prob')}
+    community_kwargs = {**defaults, **(community_kwargs or {})}
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    core_sizes = [int(size * core_percent) for size in sizes]
+
+    # Each community is one block on the diagonal
+    communities = []
+    for size in sizes:
+        scale = sparse_scale(size, sparse_above)
+        kwargs = {name: value * scale if name.endswith('_prob') else value for name, value in community_kwargs.items()}
+        communities.append(builder(size, core_percent=core_percent, rng=rng, **kwargs))
+    block_diagonal = sparse.csr_array(sparse.block_diag(communities, format='csr'))
+
+    # Link the cores of every pair of communities
+    interlinks = []
+    for i in range(len(sizes)):
+        for j in range(len(sizes)):
+            if i == j:
+                continue
+            probability = interlink_probability * sparse_scale(max(sizes[i], sizes[j]), sparse_above)
+            rows, cols = sample_block(rng, core_sizes[i], core_sizes[j], probability, offsets[i], offsets[j])
+            if directed:
+                # The direction of an inter-core link is random
+                flip = rng.generator.random(len(rows)) < 0.5
+                rows, cols = np.where(flip, cols, rows), np.where(flip, rows, cols)
+            interlinks.append((rows, cols))
+
+    adjacency = block_diagonal + assemble_adjacency(int(offsets[-1]), interlinks, directed)
+    adjacency.data[:] = 1
+    return sparse.csr_array(adjacency)
+
+
+def create_multiple_core_periphery_networks(total_agents, networks_count, interlink_probability, directed=False, rng=None,
+                                            sizes=None, as_networkx=False, core_percent=0.2, community_kwargs=None,
+                                            sparse_above=None):
     """
     Creates multiple core periphery networks joined together mostly through cores. Important hyperparameter is the number of networks
     :param total_agents:
     :param networks_count:
     :param interlink_probability:
     :param directed:
+    :param rng: SimulationRNG, the shared default stream if None
+    :param sizes: optional list of community sizes summing to total_agents, by default the agents are split evenly
+    :param as_networkx: return a networkx graph instead of the CSR adjacency matrix
+    :param core_percent: share of each community in its core
+    :param community_kwargs: link probabilities of the core periphery builder of each community, see
+    core_periphery_adjacency and directed_core_periphery_adjacency
+    :param sparse_above: community size above which the link probabilities are scaled down, see
+    multiple_core_periphery_adjacency
     :return:
     """
-    # Assume an equal number of agents per network for simplicity
-    agents_per_network = total_agents // networks_count
-
-    # Function to create a single core-periphery network based on the directed flag
-    def create_network(agents_count):
-        if directed:
-            return create_directed_core_periphery_network(agents_count)
-        else:
-            return create_core_periphery_network(agents_count)
-
-    # Create individual core-periphery networks
-    networks = [create_network(agents_per_network) for _ in range(networks_count)]
-
-    # Initialize one large graph to contain all individual networks
-    if directed:
-        large_network = nx.DiGraph()
-    else:
-        large_network = nx.Graph()
-
-    # Add individual networks to the large graph
-    offset = 0
-    for net in networks:
-        # Relabel nodes to ensure unique identifiers across the entire large network
-        mapping = {i: i + offset for i in net.nodes()}
-        relabeled_net = nx.relabel_nodes(net, mapping)
-        large_network = nx.compose(large_network, relabeled_net)
-
-        # Increment offset for the next network
-        offset += agents_per_network
-
-    # Link the networks together
-    # For each network, try to link its core nodes to core nodes of other networks
-    for i in range(networks_count):
-        core_nodes_i = range(i * agents_per_network, i * agents_per_network + int(agents_per_network * 0.2))
-
-        for j in range(networks_count):
-            if i != j:
-                core_nodes_j = range(j * agents_per_network, j * agents_per_network + int(agents_per_network * 0.2))
-
-                # Randomly establish inter-core links based on the specified probability
-                for node_i in core_nodes_i:
-                    for node_j in core_nodes_j:
-                        if random.random() < interlink_probability:
-                            if directed:
-                                # For directed, the link direction can also be randomized or set to a specific direction
-                                if random.random() < 0.5:
-                                    large_network.add_edge(node_i, node_j)
-                                else:
-                                    large_network.add_edge(node_j, node_i)
-                            else:
-                                large_network.add_edge(node_i, node_j)
-
-    return large_network
-
+    if sizes is None:
+        sizes = community_sizes(total_agents, networks_count)
+    elif sum(sizes) != total_agents or len(sizes) != networks_count:
+        raise ValueError(f"Expected {networks_count} community sizes summing to {total_agents}, got {sizes}")
+
+    adjacency = multiple_core_periphery_adjacency(sizes, interlink_probability, directed=directed,
+                                                  core_percent=core_percent, rng=rng,
+                                                  community_kwargs=community_kwargs, sparse_above=sparse_above)
+    return to_networkx(adjacency, directed) if as_networkx else adjacency
@@ -0,0 +1,163 @@
+import numpy as np
+from scipy import sparse
+
+
+class CentralityIndex:
+    """
+    Centrality measures of one network, computed on first use from its CSR adjacency matrix and cached, so every airdrop
+    strategy (and budgets_based_on_popularity) shares one computation per graph. Values are arrays indexed by agent id.
+
+    Measures:
+    - degree: number of edges at a node (in + out degree in a directed network), like networkx's degree
+    - in_degree, out_degree
+    - pagerank: PageRank with damping alpha=0.85, following edge directions
+    - kcore: core number, ignoring edge directions (a node's degree is its in + out degree, like networkx)
+    - betweenness: betweenness centrality estimated from a sample of source nodes, normalized like networkx
+
+    :param adjacency - CSR adjacency matrix, A[u, v] = 1 for an edge u -> v
+    :param directed
+    """
+
+    MEASURES = ('degree', 'in_degree', 'out_degree', 'pagerank', 'kcore', 'betweenness')
+
+    def __init__(self, adjacency, directed):
+        self.adjacency = sparse.csr_array(adjacency)
+        self.directed = directed
+        self.num_nodes = self.adjacency.shape[0]
+        self.cache = {}
+
+    def get(self, measure):
+        """
+        :return: array of the measure for every node
+        """
+        if measure not in self.cache:
+            if measure not in self.MEASURES:
+                raise ValueError(f"Unknown centrality {measure}, expected one of {self.MEASURES}")
+            self.cache[measure] = getattr(self, measure)()
+        return self.cache[measure]
+
+    def top_k(self, measure, k):
+        """
+        The k nodes with the highest measure, highest first. Ties are broken by lower id first, which is the order a stable
+        sort of the whole network would give. Costs O(N) plus sorting the k selected nodes
+        """
+        values = self.get(measure)
+        k = max(0, min(k, self.num_nodes))
+        if k == 0:
+            return np.empty(0, dtype=np.int64)
+        # The k-th highest value, everything above it is in, and ties at it are taken in id order
+        kth = values[np.argpartition(-values, k - 1)[k - 1]]
+        above = np.flatnonzero(values > kth)
+        ties = np.flatnonzero(values == kth)[:k - len(above)]
+        selected = np.concatenate([above, ties])
+        return selected[np.lexsort((selected, -values[selected]))]
+
+    def degree(self):
+        if self.directed:
+            return self.in_degree() + self.out_degree()
+        # Self loops count twice, like networkx
+        return self.out_degree() + (self.adjacency.diagonal() != 0)
+
+    def in_degree(self):
+        return np.bincount(self.adjacency.indices, minlength=self.num_nodes)
+
+    def out_degree(self):
+        return np.diff(self.adjacency.indptr)
+
+    def pagerank(self, alpha=0.85, max_iterations=100, tolerance=1.0e-6):
+        """
+        Power iteration, the mass of nodes without out edges is spread evenly like in networkx
+        """
+        n = self.num_nodes
+        out_degree = self.out_degree().astype(np.float64)
+        dangling = out_degree == 0
+        inverse_degree = np.divide(1.0, out_degree, out=np.zeros(n), where=~dangling)
+        transposed = sparse.csr_array(self.adjacency.T)
+        ranks = np.full(n, 1.0 / n)
+        for _ in range(max_iterations):
+            previous = ranks
+            ranks = alpha * (transposed @ (ranks * inverse_degree))
+            ranks += (alpha * previous[dangling].sum() + 1 - alpha) / n
+            if np.abs(ranks - previous).sum() < n * tolerance:
+                break
+        return ranks
+
+    def _simple(self):
+        """
+        0/1 adjacency without self loops
+        """
+        adjacency = self.adjacency.copy()
+        adjacency.setdiag(0)
+        adjacency.eliminate_zeros()
+        adjacency.data[:] = 1
+        return sparse.csr_array(adjacency)
+
+    def kcore(self):
+        """
+        Core numbers by peeling: at level k, nodes with at most k remaining neighbors are removed in bulk until none
+        are left, and their core number is k. Only the rows of removed nodes are read, so the whole peel is O(E)
+        """
+        simple = self._simple()
+        symmetric = sparse.csr_array(simple + simple.T) if self.directed else simple
+        degree = np.rint(symmetric.sum(axis=1)).astype(np.int64)
+        core = np.zeros(self.num_nodes, dtype=np.int64)
+        alive = np.ones(self.num_nodes, dtype=bool)
+        k = 0
+        while alive.any():
+            k = max(k, degree[alive].min())
+            removed = alive & (degree <= k)
+            while removed.any():
+                core[removed] = k
+                alive &= ~removed
+                rows = symmetric[np.flatnonzero(removed)]
+                degree -= np.rint(np.bincount(rows.indices, weights=rows.data, minlength=self.num_nodes)).astype(np.int64)
+                removed = alive & (degree <= k)
+        return core
+
+    def betweenness(self, samples=256, seed=0, batch_size=32):
+        """
+        Brandes' algorithm from a random sample of source nodes, run for a batch of sources at once with one sparse
+        product per BFS level. Uses its own seeded generator, so the estimate is a fixed property of the graph
+        :param samples - number of source nodes, every node when the network is smaller
+        :param seed
+        :param batch_size - sources processed together, memory grows with num_nodes * batch_size
+        """
+        n = self.num_nodes
+        adjacency = self._simple()
+        transposed = sparse.csr_array(adjacency.T)
+        if samples >= n:
+            sources = np.arange(n)
+        else:
+            sources = np.random.default_rng(seed).choice(n, size=samples, replace=False)
+
+        betweenness = np.zeros(n)
+        for start in range(0, len(sources), batch_size):
+            batch = sources[start:start + batch_size]
+            columns = np.arange(len(batch))
+            # Number of shortest paths from each source, and the BFS level every node was reached at (-1 if not yet)
+            sigma = np.zeros((n, len(batch)))
+            sigma[batch, columns] = 1
+            level = np.full((n, len(batch)), -1, dtype=np.int64)
+            level[batch, columns] = 0
+            frontier = sigma.copy()
+            depth = 0
+            while frontier.any():
+                depth += 1
+                reached = transposed @ frontier
+                reached[level >= 0] = 0
+                level[reached > 0] = depth
+                sigma += reached
+                frontier = reached
+
+            # Dependencies accumulated from the deepest level back to the sources
+            delta = np.zeros((n, len(batch)))
+            safe_sigma = np.where(sigma > 0, sigma, 1)
+            for d in range(depth - 1, 0, -1):
+                successors = np.where(level == d + 1, (1 + delta) / safe_sigma, 0)
+                delta += np.where(level == d, sigma * (adjacency @ successors), 0)
+            betweenness += delta.sum(axis=1)
+
+        scale = n / len(sources) if len(sources) else 0
+        if n > 2:
+            scale /= (n - 1) * (n - 2)
+        return betweenness * scale
@@ -0,0 +1,281 @@
+import gc
+import os
+import pickle
+import tempfile
+from contextlib import contextmanager
+from itertools import compress
+from operator import attrgetter, itemgetter
+
+import numpy as np
+from scipy import sparse
+
+from AgentStructure import AgentStructure, IDGenerator
+from NeighborhoodAggregates import NeighborhoodAggregates
+from Portfolio import CoinRegistry, PortfolioState
+
+FORMAT_VERSION = 1
+
+# Agent attributes that aren't stored as columns: the portfolio views are rebound to the restored PortfolioState, and
+# budgets and fair values are kept as arrays by agent id
+SEPARATE_ATTRIBUTES = ('holdings', 'average_buy_prices', 'bought', 'budget', 'fair_values')
+PORTFOLIO_ARRAYS = ('holdings', 'average_buy_prices', 'bought')
+
+
+@contextmanager
+def _paused_gc():
+    # Saving and loading build millions of tuples and objects that can't be garbage, pausing the collector saves it from
+    # rescanning them over and over
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if collecting:
+            gc.enable()
+
+
+class Checkpoints:
+    """
+    When and where CryptoMarket.simulate saves checkpoints, pass one as simulate(..., checkpoints=checkpoints)
+
+    Checkpoints are taken at the end of a step. Resuming from one (see resume) finishes the run with exactly the results
+    of an uninterrupted run
+
+    :param path - file name, formatted with the step the checkpoint was taken after, e.g. 'run/checkpoint_{step:06d}.npz'
+    :param every - save after every every-th step
+    :param steps - save after these steps
+    :param keep - number of the most recent checkpoints kept on disk, None keeps them all
+    """
+
+    def __init__(self, path, every=None, steps=(), keep=None):
+        self.path = path
+        self.every = every
+        self.steps = set(steps)
+        self.keep = keep
+        self.saved = []
+
+    def due(self, t):
+        return t in self.steps or (self.every is not None and (t + 1) % self.every == 0)
+
+    def save(self, market, t, run, recorder, budgets=None, fair_values=None):
+        """
+        Saves a checkpoint after step t when one is due
+        """
+        if not self.due(t):
+            return
+        path = self.path.format(step=t)
+        save_checkpoint(market, path, {**run, 'start': {'next_step': t + 1, 'recorder': recorder.state(t)}}, budgets,
+                        fair_values)
+        self.saved.append(path)
+        if self.keep is not None:
+            while len(self.saved) > self.keep:
+                stale = self.saved.pop(0)
+                if stale != path and os.path.exists(stale):
+                    os.remove(stale)
+
+
+@_paused_gc()
+def save_checkpoint(market, path, run=None, budgets=None, fair_values=None):
+    """
+    Writes the full state of a market to one uncompressed .npz file: per agent state as one array per attribute and agent
+    class, portfolios, network, neighborhood aggregates, coins, airdrop strategies, the random stream and the simulate
+    run in progress. The file is written next to path and renamed into place, so a crash never leaves a partial
+    checkpoint behind
+    :param market
+    :param path
+    :param run - simulate arguments and loop position of the run in progress (see Checkpoints.save)
+    :param budgets - array of budgets by agent id, read from the agents if None
+    :param fair_values - (agents, coins) array of fair values (NaN for none), read from the agents if None
+    """
+    agent_table = market.agent_structure.agent_table
+    registry = market.coin_registry
+    num_agents, num_coins = market.portfolios.holdings.shape
+    arrays = {}
+
+    # One pass over the agents per class (agents are scattered in memory, every pass over a million of them costs),
+    # pulling out all of a class's attributes at once
+    types = list(map(type, agent_table))
+    classes = list(dict.fromkeys(types))
+    class_codes = {klass: k for k, klass in enumerate(classes)}
+    codes = np.fromiter(map(class_codes.__getitem__, types), dtype=np.int64, count=num_agents)
+    arrays['agent_classes'] = codes
+
+    # One column per attribute and class, numbers and bools as arrays, anything else pickled with the metadata
+    columns = []
+    read_budgets = budgets is None
+    read_fair_values = fair_values is None
+    if read_budgets:
+        budgets = np.empty(num_agents)
+    if read_fair_values:
+        fair_values = np.full((num_agents, num_coins), np.nan)
+    for k in range(len(classes)):
+        members = np.flatnonzero(codes == k)
+        attributes = list(map(vars, compress(agent_table, codes == k)))
+        names = [name for name in attributes[0] if name not in SEPARATE_ATTRIBUTES]
+        has_fair_values = 'fair_values' in attributes[0]
+        table = zip(*map(itemgetter(*names, 'budget'), attributes))
+        objects = {}
+        for name, values in zip(names, table):
+            # Only columns of a single type become arrays, so values come back with the type they had
+            kinds = set(map(type, values))
+            if len(kinds) == 1 and kinds <= {int, float, bool}:
+                arrays[f'agents{k}.{name}'] = np.array(values)
+            else:
+                objects[name] = list(values)
+        if read_budgets:
+            budgets[members] = next(table)
+        if has_fair_values and read_fair_values:
+            for i, values in zip(members.tolist(), map(itemgetter('fair_values'), attributes)):
+                for coin_name, value in values.items():
+                    fair_values[i, registry.index[coin_name]] = value
+        columns.append((names, objects, has_fair_values))
+    arrays['budgets'] = np.asarray(budgets, dtype=np.float64)
+    arrays['fair_values'] = fair_values
+
+    agent_structure = market.agent_structure
+    arrays['activation_order'] = np.fromiter(map(attrgetter('id'), agent_structure.agents), dtype=np.int64,
+                                             count=len(agent_structure.agents))
+    arrays['id_order'] = agent_structure.id_generator.order
+
+    portfolios = market.portfolios
+    for name in PORTFOLIO_ARRAYS:
+        arrays[f'portfolios.{name}'] = getattr(portfolios, name)
+
+    adjacency = market.adjacency
+    arrays['adjacency.indptr'] = adjacency.indptr
+    arrays['adjacency.indices'] = adjacency.indices
+    arrays['adjacency.data'] = adjacency.data
+    if market.communities is not None:
+        arrays['communities'] = np.asarray(market.communities)
+    aggregates = market.aggregates
+    for name in ('neighbor_units', 'neighbor_holders', 'neighbor_cash'):
+        arrays[f'aggregates.{name}'] = getattr(aggregates, name)
+
+    run = dict(run or {})
+    start = run.pop('start', None)
+    if start is not None:
+        for name, value in start['recorder'].items():
+            arrays[f'recorder.{name}'] = value
+        start = {'next_step': start['next_step']}
+
+    # Coins, airdrops, the clearing engine and the random stream are pickled together, so objects they share stay shared
+    metadata = {
+        'version': FORMAT_VERSION,
+        'market_class': type(market),
+        'market': {name: getattr(market, name) for name in ('num_agents', 'descriptor_string', 'network_type',
+                                                            'directed')},
+        'agent_structure': {'agent_type_string': agent_structure.agent_type_string,
+                            'agent_types': agent_structure.agent_types,
+                            'id_position': agent_structure.id_generator.position},
+        'agent_classes': classes,
+        'agent_columns': columns,
+        'rng': market.rng,
+        'coins': market.coins,
+        'registered_coins': registry.coins,
+        'airdrop_strategies': market.airdrop_strategies,
+        'run': run,
+        'start': start,
+    }
+    arrays['metadata'] = np.frombuffer(pickle.dumps(metadata, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    descriptor, staging = tempfile.mkstemp(prefix='.checkpoint.', suffix='.npz', dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(staging, path)
+    finally:
+        if os.path.exists(staging):
+            os.remove(staging)
+
+
+@_paused_gc()
+def load_checkpoint(path):
+    """
+    Rebuilds a market from a checkpoint
+    :return: (market, run) where run holds the simulate arguments of the run in progress, so
+    market.simulate(**run) finishes it (see resume). run is empty for checkpoints taken outside of simulate
+    """
+    with np.load(path) as checkpoint:
+        arrays = {name: checkpoint[name] for name in checkpoint.files}
+    metadata = pickle.loads(arrays.pop('metadata').tobytes())
+    if metadata['version'] != FORMAT_VERSION:
+        raise ValueError(f"Checkpoint format {metadata['version']} is not supported, expected {FORMAT_VERSION}")
+
+    codes = arrays['agent_classes']
+    num_agents = len(codes)
+    registered_coins = metadata['registered_coins']
+    coin_names = [coin.name for coin in registered_coins]
+    budgets = arrays['budgets']
+    fair_values = arrays['fair_values']
+
+    agent_table = [None] * num_agents
+    new = object.__new__
+    for k, (klass, (names, objects, has_fair_values)) in enumerate(zip(metadata['agent_classes'],
+                                                                       metadata['agent_columns'])):
+        members = np.flatnonzero(codes == k)
+        values = [arrays[f'agents{k}.{name}'].tolist() if name not in objects else objects[name] for name in names]
+        names = names + ['budget']
+        values.append(budgets[members].tolist())
+        for i, row in zip(members.tolist(), zip(*values)):
+            agent = new(klass)
+            agent.__dict__ = dict(zip(names, row))
+            agent_table[i] = agent
+        if has_fair_values:
+            for i, row in zip(members.tolist(), fair_values[members].tolist()):
+                agent_table[i].fair_values = {name: value for name, value in zip(coin_names, row) if value == value}
+
+    rng = metadata['rng']
+    agent_structure = new(AgentStructure)
+    agent_structure.num_agents = num_agents
+    agent_structure.rng = rng
+    agent_structure.agent_table = agent_table
+    agent_structure.agents = [agent_table[i] for i in arrays['activation_order'].tolist()]
+    id_generator = new(IDGenerator)
+    id_generator.order = arrays['id_order']
+    id_generator.position = metadata['agent_structure']['id_position']
+    agent_structure.id_generator = id_generator
+    agent_structure.agent_type_string = metadata['agent_structure']['agent_type_string']
+    agent_structure.agent_types = metadata['agent_structure']['agent_types']
+
+    registry = CoinRegistry(registered_coins)
+
+    market = new(metadata['market_class'])
+    market.__dict__.update(metadata['market'])
+    market.rng = rng
+    market.agent_structure = agent_structure
+    market.agent_types = agent_structure.agent_types
+    market.airdrop_strategies = metadata['airdrop_strategies']
+    market.coins = metadata['coins']
+    market.coin_registry = registry
+    market.portfolios = PortfolioState.from_arrays(agent_table, registry, *(arrays[f'portfolios.{name}'] for name in
+                                                                            PORTFOLIO_ARRAYS))
+    market.adjacency = sparse.csr_array((arrays['adjacency.data'], arrays['adjacency.indices'],
+                                         arrays['adjacency.indptr']), shape=(num_agents, num_agents))
+    market._network = None
+    market.communities = arrays.get('communities')
+    market.aggregates = NeighborhoodAggregates(market)
+    for name in ('neighbor_units', 'neighbor_holders', 'neighbor_cash'):
+        setattr(market.aggregates, name, arrays[f'aggregates.{name}'])
+    market._centrality = None
+    market.recorder = None
+
+    run = dict(metadata['run'])
+    if metadata['start'] is not None:
+        recorder = {name[len('recorder.'):]: value for name, value in arrays.items() if name.startswith('recorder.')}
+        run['start'] = {**metadata['start'], 'recorder': recorder}
+    return market, run
+
+
+def resume(path, **simulate_kwargs):
+    """
+    Finishes the simulate run a checkpoint was taken in
+    :param path
+    :param simulate_kwargs - extra arguments for CryptoMarket.simulate, e.g. checkpoints to keep taking checkpoints
+    :return: (market, the histories of the whole run as returned by CryptoMarket.simulate)
+    """
+    market, run = load_checkpoint(path)
+    if 'start' not in run:
+        raise ValueError(f"{path} wasn't taken during a simulate run")
+    return market, market.simulate(**run, **simulate_kwargs)
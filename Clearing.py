@@ -0,0 +1,180 @@
+import math
+
+import numpy as np
+
+# Multiplicative price impact of a single buy/sell, the rule CryptoMarket.simulate has always applied after every trade
+BUY_IMPACT = 1.05
+SELL_IMPACT = 0.95
+
+
+class Clearing:
+    """
+    Turns the orders of a market into a new price and the price they settle at
+
+    Agents decide against the quoted coin.price. A clearing engine then either clears one trade at a time (clear_trade,
+    used by the sequential engine) or a batch of orders at once (clear, used by the vectorized engine), moves coin.price
+    and returns the execution price the trades settle at.
+    """
+
+    # Engines that can only clear whole batches of orders
+    batch_only = False
+
+    def clear(self, coin, delta):
+        """
+        Clears a batch of orders
+        :param coin
+        :param delta - array with the change in holdings every agent asked for
+        :return: the price every order in the batch settles at
+        """
+        raise NotImplementedError
+
+    def clear_trade(self, coin, change_in_holdings, change_in_budget):
+        """
+        Clears one trade that the agent already settled at the quoted price
+        :return: the price the trade settles at
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def set_price(coin, price):
+        coin.price = max(price, coin.initial_price * 0.01)  # enforce a minimum price for the coin
+        coin.highest_price = max(coin.highest_price, coin.price)
+
+    def get_descriptor(self):
+        return type(self).__name__
+
+
+class PerTradeClearing(Clearing):
+    """
+    Reference rule: every trade settles at the quoted price, then moves it by BUY_IMPACT or SELL_IMPACT
+
+    A batch moves the price by the net impact of its trades, damped by the depth of the market: b buys and s sells
+    change the log price by (b * log(BUY_IMPACT) + s * log(SELL_IMPACT)) * depth / (depth + b + s). The agents of a batch
+    all decided at the same price without seeing each other's trades, so compounding every trade's impact would let a
+    one sided batch overshoot without bound. A batch much smaller than depth moves the price about as much as clearing
+    its trades one by one, while no batch moves it by more than depth trades' worth, however many agents it holds
+
+    :param depth - number of trades a batch absorbs at close to their full impact
+    """
+
+    def __init__(self, depth=10):
+        self.depth = depth
+
+    def get_descriptor(self):
+        return f"{type(self).__name__}({self.depth})"
+
+    def clear_trade(self, coin, change_in_holdings, change_in_budget):
+        price = coin.price
+        if change_in_holdings > 0:
+            bought = change_in_holdings
+            spent = -change_in_budget
+            price_change_factor = 1 + (bought / (spent / coin.price)) * 0.05
+            coin.price *= price_change_factor
+        elif change_in_holdings < 0:
+            sold = -change_in_holdings
+            earned = change_in_budget
+            price_change_factor = max(0, 1 - (sold / (earned / coin.price)) * 0.05)
+            coin.price *= price_change_factor
+        self.set_price(coin, coin.price)
+        return price
+
+    def impact(self, num_buys, num_sells):
+        """
+        :return: the log price change of a batch of num_buys buys and num_sells sells
+        """
+        net_impact = num_buys * math.log(BUY_IMPACT) + num_sells * math.log(SELL_IMPACT)
+        return net_impact * self.depth / (self.depth + num_buys + num_sells)
+
+    def clear(self, coin, delta):
+        price = coin.price
+        num_buys, num_sells = int(np.count_nonzero(delta > 0)), int(np.count_nonzero(delta < 0))
+        self.set_price(coin, price * math.exp(self.impact(num_buys, num_sells)))
+        return price
+
+
+class CallAuctionClearing(PerTradeClearing):
+    """
+    Call auction: all orders of a batch (every agent's order for a coin in a step when sub_steps=1) are collected and
+    executed together at one uniform clearing price, the price after the batch's impact (see PerTradeClearing). Buyers
+    that can no longer afford their order at the clearing price only get what their budget covers. Batch only
+    """
+
+    batch_only = True
+
+    def clear_trade(self, coin, change_in_holdings, change_in_budget):
+        raise ValueError("CallAuctionClearing clears whole batches, use it with engine='vectorized'")
+
+    def clear(self, coin, delta):
+        super().clear(coin, delta)
+        return coin.price
+
+
+class ConstantProductAMM(Clearing):
+    """
+    Constant product liquidity pool (x * y = k) per coin, holding liquidity units of the coin and the matching amount of
+    cash at the coin's price when first used. The orders of a batch are netted and swapped against the pool in closed
+    form, and every order settles at the average price of the net swap. A single trade is the same as a batch of one.
+    The minimum price rule is not applied, since the pool price can never reach zero
+
+    :param liquidity - coin units in each pool. Deeper pools move less per trade
+    """
+
+    def __init__(self, liquidity=1000000):
+        self.liquidity = liquidity
+        self.pools = {}
+
+    def get_descriptor(self):
+        return f"ConstantProductAMM({self.liquidity})"
+
+    def pool(self, coin):
+        """
+        :return: [coin reserve, cash reserve], recentered on coin.price if the price was changed outside of the pool
+        """
+        pool = self.pools.get(coin.name)
+        if pool is None or not math.isclose(pool[1] / pool[0], coin.price, rel_tol=1e-9):
+            units = pool[0] if pool is not None else self.liquidity
+            pool = self.pools[coin.name] = [units, units * coin.price]
+        return pool
+
+    def swap(self, coin, net_units):
+        """
+        Takes net_units of the coin out of the pool (puts them in when negative)
+        :return: the average price of the swap
+        """
+        pool = self.pool(coin)
+        coin_reserve, cash_reserve = pool
+        if net_units == 0:
+            return coin.price
+        if net_units >= coin_reserve:
+            raise ValueError(f"Buying {net_units} {coin.name} would drain its pool of {coin_reserve}, "
+                             f"use more liquidity")
+        new_coin_reserve = coin_reserve - net_units
+        new_cash_reserve = coin_reserve * cash_reserve / new_coin_reserve
+        pool[0], pool[1] = new_coin_reserve, new_cash_reserve
+        coin.price = new_cash_reserve / new_coin_reserve
+        coin.highest_price = max(coin.highest_price, coin.price)
+        return (new_cash_reserve - cash_reserve) / net_units
+
+    def clear(self, coin, delta):
+        return self.swap(coin, float(np.sum(delta)))
+
+    def clear_trade(self, coin, change_in_holdings, change_in_budget):
+        return self.swap(coin, change_in_holdings)
+
+
+CLEARING_ENGINES = {
+    'per_trade': PerTradeClearing,
+    'call_auction': CallAuctionClearing,
+    'amm': ConstantProductAMM,
+}
+
+
+def make_clearing(clearing):
+    """
+    :param clearing - a Clearing, or the name of one in CLEARING_ENGINES
+    """
+    if isinstance(clearing, Clearing):
+        return clearing
+    if clearing not in CLEARING_ENGINES:
+        raise ValueError(f"Unknown clearing {clearing}")
+    return CLEARING_ENGINES[clearing]()
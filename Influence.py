@@ -0,0 +1,401 @@
+import heapq
+import math
+import multiprocessing
+
+import numpy as np
+from scipy import sparse
+
+from Agent import LinearHerdingAgent, BudgetProportionHerdingAgent, NeighborhoodProbabilisticInvestor
+
+
+class HerdingCascadeModel:
+    """
+    Monte Carlo model of how far an airdrop spreads through the herding agents of a market, used to rank airdrop
+    recipients by influence.
+
+    Starting from the agents that hold the coin when the airdrop happens, airdrop recipients start holding it and the
+    herding rules are replayed for a number of synchronous rounds, each round letting every agent that doesn't hold the
+    coin yet react to its neighbors:
+    - LinearHerdingAgent buys once the share of its neighbors holding the coin reaches its threshold
+    - BudgetProportionHerdingAgent buys once the value its neighbors hold in the coin reaches buy_threshold of their budgets
+    - NeighborhoodProbabilisticInvestor buys with probability equal to the share of its neighbors' wealth in the coin
+    Buyers are assumed to put initial_buy_proportion of their budget in the coin. Selling and price changes are
+    ignored, so the cascade only grows. Rational agents never follow their neighbors and only count when seeded.
+
+    Every estimate runs all samples at once as the columns of (agents, samples) arrays and reuses the same seed, so
+    spreads of different seed sets are compared on common random numbers.
+
+    :param market
+    :param coin - the airdropped coin
+    :param amount - units airdropped to every recipient
+    :param rounds - number of rounds a cascade runs for
+    :param samples - number of Monte Carlo cascades per estimate
+    :param seed
+    """
+
+    def __init__(self, market, coin, amount, rounds=10, samples=64, seed=0):
+        self.rounds = rounds
+        self.samples = samples
+        self.seed = seed
+        self.neighbors = market.aggregates.neighbors
+        self.degree = np.maximum(market.aggregates.in_degree, 1).astype(np.float64)
+        agent_table = market.agent_structure.agent_table
+
+        def mask(agent_class):
+            return np.array([isinstance(agent, agent_class) for agent in agent_table])
+
+        def param(name):
+            return np.array([getattr(agent, name, np.nan) for agent in agent_table], dtype=np.float64)
+
+        self.is_linear = mask(LinearHerdingAgent)
+        self.is_budget = mask(BudgetProportionHerdingAgent)
+        self.is_probabilistic = mask(NeighborhoodProbabilisticInvestor)
+        self.threshold = param('threshold')
+        self.buy_threshold = param('buy_threshold')
+
+        budgets = np.array([agent.budget for agent in agent_table], dtype=np.float64)
+        holdings = market.portfolios.holdings[:, coin.index]
+        self.holders = holdings > 0
+        # Value each agent holds in the coin once it holds it
+        self.value = np.where(self.holders, holdings * coin.price,
+                              budgets * np.nan_to_num(param('initial_buy_proportion')))
+        self.seed_value = amount * coin.price
+        self.neighbor_budget = self.neighbors @ budgets
+        self.neighbor_wealth = self.neighbors @ market.portfolios.portfolio_values(budgets)
+        self.base_spread = int(np.count_nonzero(self.holders))
+
+    def spread(self, seeds):
+        """
+        Expected number of agents that end up holding the coin because of an airdrop to seeds, not counting the
+        agents that already held it
+        """
+        rng = np.random.default_rng(self.seed)
+        seeds = np.asarray(seeds, dtype=np.int64)
+        value = self.value.copy()
+        value[seeds] = np.where(self.holders[seeds], value[seeds] + self.seed_value, self.seed_value)
+        holding = np.repeat(self.holders[:, None], self.samples, axis=1)
+        holding[seeds] = True
+
+        neighbor_budget = self.neighbor_budget[:, None]
+        neighbor_wealth = self.neighbor_wealth[:, None]
+        for _ in range(self.rounds):
+            holding_proportion = (self.neighbors @ holding.astype(np.float64)) / self.degree[:, None]
+            invested = self.neighbors @ (holding * value[:, None])
+            budget_proportion = np.divide(invested, neighbor_budget, out=np.zeros_like(invested),
+                                          where=neighbor_budget > 0)
+            wealth_proportion = np.divide(invested, neighbor_wealth, out=np.zeros_like(invested),
+                                          where=neighbor_wealth > 0)
+            buys = ~holding & (
+                    (self.is_linear[:, None] & (holding_proportion >= self.threshold[:, None])) |
+                    (self.is_budget[:, None] & (budget_proportion >= self.buy_threshold[:, None])) |
+                    (self.is_probabilistic[:, None] & (rng.random(holding.shape) < wealth_proportion)))
+            if not buys.any():
+                break
+            holding |= buys
+        return float(holding.sum(axis=0).mean()) - self.base_spread
+
+
+# Model of the worker processes, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(model):
+    _worker['model'] = model
+
+
+def _single_spread(node):
+    return _worker['model'].spread([node])
+
+
+def celf(model, k, candidates, processes=None):
+    """
+    Greedy influence maximization with CELF lazy evaluation: marginal gains only shrink as the seed set grows
+    (submodularity), so a node whose gain was computed for an earlier seed set is only re-evaluated when it reaches the
+    top of the queue. The first pass over the candidates is the bulk of the work and runs across a process pool
+    :param model - HerdingCascadeModel
+    :param k - number of seeds to pick
+    :param candidates - ids to choose from, most promising first (e.g. by centrality). Nodes with equal gains are
+    picked in this order, which matters once the gains left are all the same, e.g. when no single node tips a
+    threshold agent
+    :param processes - worker processes for the first pass, defaults to the number of cores. 1 runs in this process, as
+    does any call made from a pool worker, which can't start processes of its own
+    :return: (seeds, marginal gain of each seed)
+    """
+    candidates = [int(node) for node in candidates]
+    if processes == 1 or len(candidates) < 2 or multiprocessing.current_process().daemon:
+        gains = [model.spread([node]) for node in candidates]
+    else:
+        workers = processes or multiprocessing.cpu_count()
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(model,)) as pool:
+            gains = pool.map(_single_spread, candidates, chunksize=max(1, len(candidates) // (4 * workers)))
+
+    # (-gain, rank in candidates, node, size of the seed set the gain was computed for)
+    queue = [(-gain, rank, node, 0) for rank, (node, gain) in enumerate(zip(candidates, gains))]
+    heapq.heapify(queue)
+    seeds = []
+    seed_gains = []
+    spread = 0.0
+    while queue and len(seeds) < k:
+        negative_gain, rank, node, evaluated_at = heapq.heappop(queue)
+        if evaluated_at == len(seeds):
+            seeds.append(node)
+            seed_gains.append(-negative_gain)
+            spread += -negative_gain
+        else:
+            gain = model.spread(seeds + [node]) - spread
+            heapq.heappush(queue, (-gain, rank, node, len(seeds)))
+    return seeds, seed_gains
+
+
+def calibrated_edge_probabilities(market, coin, amount):
+    """
+    Per round independent cascade probabilities calibrated to the herding rules of HerdingCascadeModel, aligned with
+    the entries of the market's in-neighbor matrix (market.aggregates.neighbors, row v lists the u that v watches). The
+    probability of an edge is the chance that u holding the coin makes v buy in one round of the herding model, on top
+    of the neighbors of v that already hold it:
+    - LinearHerdingAgent buys for sure if u brings the share of its neighbors holding up to its threshold, and never
+      otherwise. A single new holder rarely tips a well connected agent, which is what keeps herding cascades small
+    - BudgetProportionHerdingAgent likewise buys if u's investment brings its neighbors' investment up to buy_threshold
+      of their budgets
+    - NeighborhoodProbabilisticInvestor buys with probability u's investment over its neighborhood's wealth
+    Rational agents and agents already holding the coin don't follow their neighbors.
+
+    An airdrop recipient invests the airdrop, worth amount units, while an agent drawn in by the cascade invests what it
+    buys (initial_buy_proportion of its budget), so the edges of a recipient get their own probabilities
+    :return: (probabilities, seed_probabilities) - of every edge when u bought into the coin and when u was airdropped it
+    """
+    model = HerdingCascadeModel(market, coin, amount, samples=1)
+    neighbors = model.neighbors
+    n = neighbors.shape[0]
+    holding = model.holders.astype(np.float64)
+    neighbor_holders = neighbors @ holding
+    neighbor_invested = neighbors @ (holding * model.value)
+    # Agents that already hold count what they hold
+    seed_investment = np.where(model.holders, model.value + model.seed_value, model.seed_value)
+
+    # Target (row) and source (column) of every entry
+    target = np.repeat(np.arange(n), np.diff(neighbors.indptr))
+    source = neighbors.indices
+    followers = ~model.holders[target]
+    linear = model.is_linear[target] & followers & (
+            (neighbor_holders[target] + 1) / model.degree[target] >= model.threshold[target])
+
+    def probabilities(investment):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            budget = model.is_budget[target] & followers & (
+                    (neighbor_invested[target] + investment) / model.neighbor_budget[target]
+                    >= model.buy_threshold[target])
+            share = np.where(model.is_probabilistic[target] & followers,
+                             investment / model.neighbor_wealth[target], 0)
+        return np.clip(np.nan_to_num(np.where(linear | budget, 1.0, share)), 0, 1)
+
+    return probabilities(model.value[source]), probabilities(seed_investment[source])
+
+
+def _ranges(indptr, rows):
+    """
+    Positions of all entries of the given CSR rows, and the index in rows each one belongs to
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    owner = np.repeat(np.arange(len(rows)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    return starts[owner] + np.arange(lengths.sum()) - offsets[owner], owner
+
+
+def _unique(keys):
+    """
+    Sorted unique keys, by sorting, which is much faster than np.unique's hashing for the large int64 keys used here
+    """
+    keys = np.sort(keys)
+    return keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
+
+
+def _members(sorted_keys, keys):
+    """
+    Which of keys are in the sorted array sorted_keys
+    """
+    if not len(sorted_keys):
+        return np.zeros(len(keys), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return sorted_keys[positions] == keys
+
+
+class RRSetIndex:
+    """
+    Reverse reachable sets stored as flat arrays in CSR form (set_indptr, set_nodes), with greedy max coverage over them
+
+    Without a horizon every edge gets one try, as in the plain independent cascade. With one, an edge tries again every
+    round and a set only holds the nodes that reach its root within horizon rounds, which is how the herding cascade
+    plays out (see HerdingCascadeModel). With seed_probabilities, the first edge of a path, out of the node that would be
+    seeded, uses them instead of probabilities
+
+    :param neighbors - CSR in-neighbor matrix, row v lists the nodes that can influence v
+    :param probabilities - activation probability of every entry of neighbors, per round with a horizon
+    :param rng - numpy Generator
+    :param seed_probabilities - optional activation probabilities of the entries when their source is a seed
+    :param horizon - optional number of rounds
+    :param batch_size - number of sets sampled together
+    """
+
+    def __init__(self, neighbors, probabilities, rng, seed_probabilities=None, horizon=None, batch_size=16384):
+        self.indptr = neighbors.indptr.astype(np.int64)
+        self.indices = neighbors.indices.astype(np.int64)
+        self.probabilities = probabilities
+        self.seed_probabilities = seed_probabilities
+        self.horizon = horizon if horizon is not None else math.inf
+        self.num_nodes = neighbors.shape[0]
+        self.rng = rng
+        self.batch_size = batch_size
+        self.set_indptr = np.zeros(1, dtype=np.int64)
+        self.set_nodes = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.set_indptr) - 1
+
+    def delays(self, probabilities, uniforms):
+        """
+        Rounds until each edge fires, from one uniform per edge, inf for edges that never do
+        """
+        if self.horizon == math.inf:
+            return np.where(uniforms < probabilities, 1.0, math.inf)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Geometric number of rounds with success probability p, 1 when p is 1
+            rounds = 1 + np.floor(np.log(uniforms) / np.log1p(-probabilities))
+        return np.where(probabilities >= 1, 1.0, np.where(probabilities > 0, rounds, math.inf))
+
+    def extend(self, count):
+        """
+        Samples RR sets until the index holds count of them
+        """
+        n = self.num_nodes
+        chunks = [self.set_nodes]
+        sizes = [np.diff(self.set_indptr)]
+        missing = count - len(self)
+        while missing > 0:
+            batch = min(self.batch_size, missing)
+            missing -= batch
+            keys = self.sample(batch)
+            chunks.append(keys % n)
+            sizes.append(np.bincount(keys // n, minlength=batch))
+        self.set_nodes = np.concatenate(chunks)
+        self.set_indptr = np.concatenate([[0], np.cumsum(np.concatenate(sizes))])
+
+    def sample(self, batch):
+        """
+        Grows batch RR sets together as a reverse search in rounds: the nodes reached at the earliest pending round
+        try all of their in-edges at once, and each source is queued for the round its edge fires in. Members are keyed
+        set * n + node and only the keys visited so far are kept, as a sorted array, so memory grows with the size of
+        the sets rather than with batch * n
+        :return: sorted keys of the members of every set
+        """
+        n = self.num_nodes
+        roots = np.arange(batch, dtype=np.int64) * n + self.rng.integers(0, n, size=batch)
+        pending, times = roots, np.zeros(batch)
+        visited = np.empty(0, dtype=np.int64)
+        seeds = [roots]
+        while len(pending):
+            now = times == times.min()
+            t = times[now][0]
+            frontier = _unique(pending[now])
+            pending, times = pending[~now], times[~now]
+            frontier = frontier[~_members(visited, frontier)]
+            visited = np.sort(np.concatenate([visited, frontier]))
+            if t >= self.horizon or not len(frontier):
+                continue
+            positions, owner = _ranges(self.indptr, frontier % n)
+            sources = (frontier[owner] // n) * n + self.indices[positions]
+            uniforms = self.rng.random(len(positions))
+            arrival = t + self.delays(self.probabilities[positions], uniforms)
+            if self.seed_probabilities is not None:
+                # The same uniform decides the edge for a seeded source, so a seed is never weaker than a buyer
+                seed_arrival = t + self.delays(self.seed_probabilities[positions], uniforms)
+                seeds.append(sources[seed_arrival <= self.horizon])
+            queued = (arrival <= self.horizon) & ~_members(visited, sources)
+            pending = np.concatenate([pending, sources[queued]])
+            times = np.concatenate([times, arrival[queued]])
+        if self.seed_probabilities is None:
+            return visited
+        return _unique(np.concatenate(seeds))
+
+    def select(self, k):
+        """
+        Greedy max coverage, picking the node that covers the most uncovered sets k times (ties to the lower id)
+        :return: (seeds, fraction of the sets covered)
+        """
+        n = self.num_nodes
+        # Inverted index: the sets every node is in, as the transpose of the set x node incidence matrix
+        incidence = sparse.csr_array((np.ones(len(self.set_nodes), dtype=np.int8), self.set_nodes, self.set_indptr),
+                                     shape=(len(self), n)).tocsc()
+        node_indptr, node_sets = incidence.indptr, incidence.indices
+
+        coverage = np.bincount(self.set_nodes, minlength=n)
+        covered = np.zeros(len(self), dtype=bool)
+        seeds = []
+        for _ in range(min(k, n)):
+            node = int(np.argmax(coverage))
+            if coverage[node] == 0:
+                break
+            seeds.append(node)
+            sets = node_sets[node_indptr[node]:node_indptr[node + 1]]
+            sets = sets[~covered[sets]]
+            covered[sets] = True
+            positions, _ = _ranges(self.set_indptr, sets)
+            coverage -= np.bincount(self.set_nodes[positions], minlength=n)
+        return seeds, float(covered.mean()) if len(self) else 0.0
+
+
+def _log_binomial(n, k):
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+
+def imm(neighbors, probabilities, k, epsilon=0.5, ell=1, rng=None, max_sets=None, seed_probabilities=None,
+        horizon=None):
+    """
+    IMM influence maximization (Tang, Shi and Xiao 2015): estimates a lower bound of the optimal spread with a doubling
+    search over the number of RR sets, then samples enough fresh RR sets for the greedy max coverage seeds to be within
+    (1 - 1/e - epsilon) of optimal with probability 1 - n^-ell
+    :param neighbors - CSR in-neighbor matrix
+    :param probabilities - IC probability of every entry of neighbors, per round with a horizon
+    :param k - number of seeds
+    :param epsilon
+    :param ell
+    :param rng - numpy Generator
+    :param max_sets - optional cap on the number of RR sets, which gives up the guarantee for speed
+    :param seed_probabilities - optional probabilities of the edges out of seeds, see RRSetIndex
+    :param horizon - optional number of rounds, see RRSetIndex
+    :return: (seeds, estimated spread)
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    n = neighbors.shape[0]
+    k = min(k, n)
+    if k == 0 or n < 2:
+        return [], 0.0
+    ell = ell * (1 + math.log(2) / math.log(n))
+    log_binomial = _log_binomial(n, k)
+    cap = max_sets if max_sets is not None else math.inf
+
+    # Sampling phase: find a lower bound of the optimal spread
+    epsilon_prime = math.sqrt(2) * epsilon
+    lambda_prime = ((2 + 2 / 3 * epsilon_prime) * (log_binomial + ell * math.log(n) + math.log(math.log2(n)))
+                    * n / epsilon_prime ** 2)
+    lower_bound = 1.0
+    index = RRSetIndex(neighbors, probabilities, rng, seed_probabilities, horizon)
+    for i in range(1, max(int(math.log2(n)), 2)):
+        x = n / 2 ** i
+        index.extend(int(min(math.ceil(lambda_prime / x), cap)))
+        _, coverage = index.select(k)
+        if n * coverage >= (1 + epsilon_prime) * x:
+            lower_bound = n * coverage / (1 + epsilon_prime)
+            break
+        if len(index) >= cap:
+            break
+
+    # Node selection on fresh sets, so the seeds don't depend on the sets used for the bound
+    alpha = math.sqrt(ell * math.log(n) + math.log(2))
+    beta = math.sqrt((1 - 1 / math.e) * (log_binomial + ell * math.log(n) + math.log(2)))
+    lambda_star = 2 * n * ((1 - 1 / math.e) * alpha + beta) ** 2 / epsilon ** 2
+    index = RRSetIndex(neighbors, probabilities, rng, seed_probabilities, horizon)
+    index.extend(int(min(math.ceil(lambda_star / lower_bound), cap)))
+    seeds, coverage = index.select(k)
+    return seeds, n * coverage
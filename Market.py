@@ -0,0 +1,449 @@
+from textwrap import wrap
+from time import perf_counter
+
+import numpy as np
+import matplotlib.pyplot as plt
+from Agent import *
+from Airdrop import *
+from CPN import *
+from VectorizedEngine import VectorizedEngine
+from ParallelEngine import ParallelEngine
+from NeighborhoodAggregates import NeighborhoodAggregates
+from SparseNetwork import to_adjacency, to_networkx
+from RandomStreams import SimulationRNG
+from Recorder import HistoryRecorder
+from Tracer import no_phase
+from WhatIf import what_if
+from Animation import render_animation
+from Clearing import make_clearing
+from Portfolio import CoinRegistry, PortfolioState
+from Centrality import CentralityIndex
+
+class Cryptocurrency:
+    def __init__(self, name, initial_price, ismeme):
+        self.name = name
+        self.price = initial_price
+        self.initial_price = initial_price
+        self.is_meme = ismeme
+        self.highest_price = 0
+
+
+# Generator parameters of each network type, CryptoMarket's network_params override them
+NETWORK_PARAMS = {
+    'random': {'p': 0.1},
+    'scale_free': {'m': 2},
+    'small_world': {'k': 4, 'p': 0.1},
+    'directed_random': {'p': 0.1},
+    'directed_scale_free': {'alpha': 0.41, 'beta': 0.54, 'gamma': 0.05, 'delta_in': 0.2, 'delta_out': 0},
+    'directed_small_world': {'k': 4, 'p': 0.1},
+    'core_periphery': {'core_percent': 0.1, 'core_connected_prob': 0.8, 'periphery_connected_prob': 0.01},
+    'directed_core_periphery': {'core_percent': 0.2, 'core_to_core_prob': 0.5, 'core_to_periphery_prob': 0.5,
+                                'periphery_to_periphery_prob': 0.1, 'periphery_to_core_prob': 0.01},
+    # Dense communities by default, set sparse_above to keep the degrees of larger communities at those of one of that
+    # size (see multiple_core_periphery_adjacency)
+    'multiple_core_periphery': {'networks_count': 4, 'interlink_probability': .1, 'core_percent': 0.2,
+                                'community_kwargs': {}, 'sparse_above': None},
+    'directed_multiple_core_periphery': {'networks_count': 5, 'interlink_probability': .01, 'core_percent': 0.2,
+                                         'community_kwargs': {}, 'sparse_above': None},
+}
+
+
+def generate_network(network_type, num_agents, params, seed):
+    """
+    Generates a network of one of the types in NETWORK_PARAMS
+    :param network_type
+    :param num_agents
+    :param params - generator parameters, see NETWORK_PARAMS
+    :param seed - the network only depends on the type, size, params and this seed
+    :return: (adjacency, directed)
+    """
+    rng = SimulationRNG(seed)
+    if network_type == 'random':
+        return to_adjacency(nx.erdos_renyi_graph(num_agents, params['p'], directed=True, seed=seed))
+    elif network_type == 'scale_free':
+        return to_adjacency(nx.barabasi_albert_graph(num_agents, params['m'], seed=seed))
+    elif network_type == 'small_world':
+        return to_adjacency(nx.watts_strogatz_graph(num_agents, params['k'], params['p'], seed=seed))
+    elif network_type == 'directed_random':
+        return to_adjacency(nx.gnp_random_graph(num_agents, params['p'], seed=seed))
+    elif network_type == 'directed_scale_free':
+        G = nx.DiGraph()
+        G.add_nodes_from(range(num_agents))
+        edges = nx.scale_free_graph(num_agents, seed=seed, **params).edges()
+        G.add_edges_from(edges)
+        return to_adjacency(G)
+    elif network_type == 'directed_small_world':
+        return to_adjacency(nx.watts_strogatz_graph(num_agents, params['k'], params['p'], directed=True, seed=seed))
+    elif network_type == "core_periphery":
+        return create_core_periphery_network(num_agents, rng=rng, **params), False
+    elif network_type == "directed_core_periphery":
+        return create_directed_core_periphery_network(num_agents, rng=rng, **params), True
+    elif network_type == "multiple_core_periphery":
+        return create_multiple_core_periphery_networks(total_agents=num_agents, directed=False, rng=rng, **params), False
+    elif network_type == "directed_multiple_core_periphery":
+        return create_multiple_core_periphery_networks(total_agents=num_agents, directed=True, rng=rng, **params), True
+    raise ValueError(f"Unknown network type {network_type}")
+
+
+class CryptoMarket:
+    def __init__(self, network_type, initial_coins, airdrop_strategies, agent_structure, network=None, rng=None,
+                 network_params=None, network_seed=None, network_cache=None):
+        """
+        :param network_type
+        :param initial_coins
+        :param airdrop_strategies
+        :param agent_structure
+        :param network - a prebuilt network to use instead of generating one from network_type, either a networkx graph
+        or an (adjacency, directed) pair as returned by to_adjacency. It is only read, so the same network can be shared
+        between markets
+        :param rng - SimulationRNG for everything random in the simulation, defaults to the agent structure's
+        :param network_params - overrides of the generator parameters in NETWORK_PARAMS
+        :param network_seed - seed of the network generator, drawn from rng if None. Markets built with the same type,
+        size, params and seed get the same network
+        :param network_cache - optional NetworkCache, generated networks are then stored and reused across runs
+        """
+        self.rng = rng if rng is not None else agent_structure.rng
+        self.num_agents = agent_structure.num_agents
+        self.agent_structure = agent_structure
+        self.agent_types = agent_structure.agent_types
+        self.descriptor_string = f"{network_type}: {agent_structure.get_descriptor()} - {[airdrop_strategy.get_descriptor() for airdrop_strategy in airdrop_strategies]}"
+        self.network_type = network_type
+        self.airdrop_strategies = airdrop_strategies
+        self.coins = initial_coins
+        # Coins get fixed indices, the columns of the agents' holdings, buy prices and bought flags in self.portfolios.
+        # Airdropped coins that aren't traded still need a column
+        self.coin_registry = CoinRegistry(initial_coins)
+        for airdrop_strategy in airdrop_strategies:
+            for coin in (getattr(airdrop_strategy, 'coin', None), getattr(airdrop_strategy, 'existing_coin', None)):
+                if coin is not None:
+                    self.coin_registry.add(coin)
+        self.portfolios = PortfolioState(agent_structure.agent_table, self.coin_registry)
+        # The network is kept as a CSR adjacency matrix (A[u, v] = 1 for an edge u -> v), the networkx view is only built
+        # when something asks for it
+        if isinstance(network, tuple):
+            self.adjacency, self.directed = network
+            if self.adjacency.shape != (self.num_agents, self.num_agents):
+                raise ValueError(f"The network has {self.adjacency.shape[0]} nodes for {self.num_agents} agents")
+            self._network = None
+        elif network is not None:
+            self.adjacency, self.directed = to_adjacency(network, self.num_agents)
+            self._network = network
+        else:
+            if network_type not in NETWORK_PARAMS:
+                raise ValueError(f"Unknown network type {network_type}")
+            params = {**NETWORK_PARAMS[network_type], **(network_params or {})}
+            seed = network_seed if network_seed is not None else self.rng.seed_int()
+            if network_cache is not None:
+                key = network_cache.key(network_type, self.num_agents, params, seed)
+                self.adjacency, self.directed = network_cache.get_or_create(key, lambda: self.create_network(params, seed))
+            else:
+                self.adjacency, self.directed = self.create_network(params, seed)
+            self._network = None
+        # Community of every agent for the generators that build the network community by community, None otherwise
+        self.communities = self.network_communities(params) if network is None else None
+        self.aggregates = NeighborhoodAggregates(self)
+        self._centrality = None
+        # HistoryRecorder of the simulation in progress, see record_trade
+        self.recorder = None
+
+    def network_communities(self, params):
+        """
+        :return: the community of every agent in networks built community by community, None for other network types
+        """
+        if self.network_type not in ("multiple_core_periphery", "directed_multiple_core_periphery"):
+            return None
+        sizes = params.get('sizes') or community_sizes(self.num_agents, params['networks_count'])
+        return np.repeat(np.arange(len(sizes)), sizes)
+
+    def create_network(self, params, seed):
+        """
+        Generates the network for self.network_type, see generate_network
+        :return: (adjacency, directed)
+        """
+        return generate_network(self.network_type, self.num_agents, params, seed)
+
+    @property
+    def network(self):
+        """
+        networkx view of the market's network, built on first use
+        """
+        if self._network is None:
+            self._network = to_networkx(self.adjacency, self.directed)
+        return self._network
+
+    @property
+    def centrality(self):
+        """
+        CentralityIndex of the market's network, built on first use. Measures are cached in it, so they are computed
+        once per market however many airdrops use them
+        """
+        if self._centrality is None:
+            self._centrality = CentralityIndex(self.adjacency, self.directed)
+        return self._centrality
+
+    def get_coin_price(self, coin_name):
+        if coin_name not in self.coin_registry:
+            return None
+        return self.coin_registry[coin_name].price
+
+    def set_coin_price(self, coin_name, new_price):
+        if coin_name in self.coin_registry:
+            coin = self.coin_registry[coin_name]
+            coin.price = new_price
+            coin.highest_price = max(coin.highest_price, new_price)
+
+    def record_trade(self, agent_id, coin, holdings_before, holdings_after, budget_change):
+        """
+        Reports a change in an agent's holdings of a coin and in its budget to the neighborhood aggregates and to the
+        recorder of the running simulation. Everything that changes holdings or budgets outside of Agent.act has to call it
+        """
+        self.aggregates.record_trade(agent_id, coin, holdings_before, holdings_after, budget_change)
+        if self.recorder is not None:
+            self.recorder.on_trade(agent_id, coin, holdings_before, holdings_after, budget_change)
+
+    def record_trades(self, coin, agent_ids, holdings_before, holdings_after):
+        """
+        record_trade for a change in the holdings of one coin by many agents at once, without budget changes
+        :param coin
+        :param agent_ids - array of agent ids, without duplicates
+        :param holdings_before - arrays aligned with agent_ids
+        :param holdings_after
+        """
+        self.aggregates.record_trades(coin, agent_ids, holdings_before, holdings_after)
+        if self.recorder is not None:
+            self.recorder.on_trades(coin, agent_ids, holdings_before, holdings_after)
+
+    def simulate(self, num_iterations, engine="sequential", sub_steps=1, resolution="action", decimation=1,
+                 clearing="per_trade", processes=None, tracer=None, checkpoints=None, start=None, stop_after=None):
+        """
+        Runs the market for num_iterations steps
+        :param num_iterations
+        :param engine - "sequential" activates agents one at a time in a shuffled order and moves the price after every
+        trade. "vectorized" updates all agents synchronously with array operations (see VectorizedEngine), which is much
+        faster on large networks but only records the price once per sub step. "parallel" runs the vectorized engine on
+        a partition of the network over several processes (see ParallelEngine)
+        :param sub_steps - number of synchronous groups each step is split into by the vectorized engine
+        :param resolution - "action" records the price after every action, "step" only at the end of every step
+        :param decimation - with resolution="action", only keep the price every decimation actions (see HistoryRecorder)
+        :param processes - number of worker processes of the parallel engine, all cores by default
+        :param clearing - how orders move the price and what they settle at: a Clearing or one of "per_trade" (the
+        original rule), "call_auction" (vectorized engine only) and "amm"
+        :param tracer - optional SimulationTracer timing the phases of every step, the act time of every agent type and
+        the hot calls, off by default (see Tracer)
+        :param checkpoints - optional Checkpoints saving the full state of the market and the run at the end of chosen
+        steps, not supported by the parallel engine
+        :param start - position of an interrupted run to continue from, as returned by load_checkpoint (see
+        Checkpoint.resume) or by a run with stop_after
+        :param stop_after - pause the run after this step and return its position, to be passed as start to a later
+        call, instead of the histories (see what_if)
+        :return: price_histories, holdings_histories, network_states, net_trade_volume_histories, trade_volume_histories,
+        asset_allocation_data, as array views (see HistoryRecorder.histories)
+        """
+        clearing = make_clearing(clearing)
+        if engine == "vectorized":
+            return VectorizedEngine(self, sub_steps=sub_steps, clearing=clearing,
+                                    tracer=tracer).simulate(num_iterations, resolution, decimation, checkpoints, start,
+                                                            stop_after)
+        elif engine == "parallel":
+            # The workers' streams are spawned anew by every run, so a resumed run couldn't match an uninterrupted one
+            if checkpoints is not None or start is not None or stop_after is not None:
+                raise ValueError("engine='parallel' doesn't support checkpoints or paused runs")
+            return ParallelEngine(self, sub_steps=sub_steps, clearing=clearing, processes=processes,
+                                  tracer=tracer).simulate(num_iterations, resolution, decimation)
+        elif engine != "sequential":
+            raise ValueError(f"Unknown engine {engine}")
+        if clearing.batch_only:
+            raise ValueError(f"{clearing.get_descriptor()} only works with engine='vectorized'")
+
+        recorder = HistoryRecorder(self, num_iterations, self.num_agents, resolution, decimation)
+        if start is None:
+            # Budgets and holdings may have been changed since the market was created
+            self.aggregates.rebuild()
+        else:
+            recorder.restore(start['recorder'])
+        self.recorder = recorder
+        run = {'num_iterations': num_iterations, 'engine': engine, 'resolution': resolution, 'decimation': decimation,
+               'clearing': clearing}
+
+        # Tracing is opt-in, untraced runs only pay the time_acts check per action
+        phase = tracer.phase if tracer is not None else no_phase
+        time_acts = tracer is not None and tracer.time_acts
+        if tracer is not None:
+            tracer.start()
+
+        try:
+            for t in range(start['next_step'] if start is not None else 0, num_iterations):
+                #Execute the airdrop when needed
+                with phase('airdrops', step=t):
+                    for airdrop_strategy in self.airdrop_strategies:
+                        if int(airdrop_strategy.time * num_iterations)==t:
+                            airdrop_strategy.do_airdrop(self)
+                recorder.begin_step(t)
+
+                for c, coin in enumerate(self.coins):
+                    with phase('shuffle', step=t, coin=coin.name):
+                        self.agent_structure.shuffle_activation_order(self.rng)
+                    trade_volume = 0
+                    abs_trade_volume = 0
+                    holdings = self.portfolios.holdings
+                    column = coin.index
+
+                    with phase('agents', step=t, coin=coin.name):
+                        for action, agent in enumerate(self.agent_structure.agents):
+                            initial_holdings = holdings.item(agent.id, column)
+                            initial_budget = agent.budget
+                            if time_acts:
+                                started = perf_counter()
+                                agent.act(self, coin)
+                                acted = perf_counter()
+                                tracer.add('act:' + type(agent).__name__, acted - started)
+                            else:
+                                agent.act(self, coin)
+
+                            change_in_holdings = holdings.item(agent.id, column) - initial_holdings
+                            change_in_budget = agent.budget - initial_budget
+                            if change_in_holdings:
+                                # The agent paid the quoted price, settle the difference to the execution price
+                                quoted_price = coin.price
+                                price = clearing.clear_trade(coin, change_in_holdings, change_in_budget)
+                                if price != quoted_price:
+                                    if change_in_holdings > 0 and change_in_holdings * price > initial_budget:
+                                        # As in the vectorized engine's commit, a buyer only gets what its budget
+                                        # covers at the execution price
+                                        change_in_holdings = initial_budget // price
+                                        holdings[agent.id, column] = initial_holdings + change_in_holdings
+                                        agent.budget = initial_budget - change_in_holdings * price
+                                    else:
+                                        agent.budget -= change_in_holdings * (price - quoted_price)
+                                    change_in_budget = agent.budget - initial_budget
+                                    if agent.average_buy_prices.get(coin.name) == quoted_price:
+                                        if change_in_holdings:
+                                            agent.average_buy_prices[coin.name] = price
+                                        else:
+                                            # A first purchase that wasn't filled at all didn't happen
+                                            del agent.average_buy_prices[coin.name]
+                                            agent.bought.discard(coin.name)
+                            if change_in_holdings or change_in_budget:
+                                self.record_trade(agent.id, coin, initial_holdings, holdings.item(agent.id, column),
+                                                  change_in_budget)
+
+                            # The price floor and the highest price are kept up after every action, traded or not
+                            clearing.set_price(coin, coin.price)
+                            trade_volume -= change_in_holdings
+                            abs_trade_volume += abs(change_in_holdings)
+
+                            recorder.record_price(c, t, action, coin.price)
+                            if time_acts:
+                                tracer.add('clearing and recording', perf_counter() - acted)
+                    with phase('record', step=t, coin=coin.name):
+                        recorder.end_coin(c, t, trade_volume, abs_trade_volume)
+                with phase('record', step=t):
+                    recorder.end_step(t)
+                if tracer is not None:
+                    tracer.end_step(t)
+                if checkpoints is not None:
+                    with phase('checkpoint', step=t):
+                        checkpoints.save(self, t, run, recorder)
+                if t == stop_after:
+                    return {'next_step': t + 1, 'recorder': recorder.state(t)}
+        finally:
+            self.recorder = None
+            if tracer is not None:
+                tracer.stop()
+
+        return recorder.histories()
+
+    def what_if(self, airdrop_strategies, num_iterations, processes=None, **simulate_kwargs):
+        """
+        Compares candidate airdrop strategies by running the steps before the first candidate airdrop once and forking
+        the market into one branch per candidate (see WhatIf.what_if)
+        :return: list of (strategy, histories), in the order of airdrop_strategies
+        """
+        return what_if(self, airdrop_strategies, num_iterations, processes, **simulate_kwargs)
+
+    def plot_price_history(self, price_histories, holdings_histories, net_trade_volume_histories, asset_allocation_data, show_graph=True):
+        num_coins = len(self.coins)
+        fig, axs = plt.subplots(4, 1, figsize=(12, 16), gridspec_kw={'height_ratios': [1, num_coins, 1, 1]})
+        if show_graph:
+            fig, axs = plt.subplots(5, 1, figsize=(12, 30), gridspec_kw={'height_ratios': [1, num_coins, 1, 1, 2]})
+
+        for coin in self.coins:
+            # Prices are recorded either after every action or once per step depending on the engine
+            prices_per_iteration = (len(price_histories[coin.name]) - 1) / max(len(net_trade_volume_histories[coin.name]), 1) or 1
+            x_values = np.arange(len(price_histories[coin.name])) / prices_per_iteration
+            axs[0].plot(x_values, price_histories[coin.name], label=coin.name)
+        axs[0].set_xlabel('Iteration')
+        axs[0].set_ylabel('Price')
+        axs[0].set_title('Cryptocurrency Price Simulation')
+        axs[0].legend()
+
+        for i, coin in enumerate(self.coins):
+            for agent_type, holdings in holdings_histories[coin.name].items():
+                axs[1].plot(holdings, label=f'{coin.name} - {agent_type} Holdings')
+            axs[1].set_xlabel('Iteration')
+            axs[1].set_ylabel('Number of Agents Holding')
+            axs[1].set_title('Number of Agents Holding by Agent Type')
+            axs[1].legend()
+
+        for coin in self.coins:
+            axs[2].bar(range(len(net_trade_volume_histories[coin.name])), net_trade_volume_histories[coin.name],
+                       alpha=0.5, label=f'{coin.name} Net Trade Volume')
+        axs[2].set_xlabel('Iteration')
+        axs[2].set_ylabel('Net Trade Volume')
+        axs[2].set_title('Net Trade Volume Over Time')
+        axs[2].legend()
+
+        # Value every coin at its price at the start of each step
+        coin_values = {}
+        for coin in self.coins:
+            history = np.asarray(price_histories[coin.name])
+            prices_per_iteration = max((len(history) - 1) // max(len(net_trade_volume_histories[coin.name]), 1), 1)
+            step_prices = history[::prices_per_iteration][:len(asset_allocation_data['cash'])]
+            coin_values[coin.name] = np.asarray(asset_allocation_data[coin.name]) * step_prices
+        total_wealth = np.asarray(asset_allocation_data['cash']) + sum(coin_values.values())
+
+        asset_allocation = {'Uninvested Cash': np.asarray(asset_allocation_data['cash']) / total_wealth * 100}
+        for coin in self.coins:
+            asset_allocation[coin.name] = coin_values[coin.name] / total_wealth * 100
+
+        for asset, allocation in asset_allocation.items():
+            axs[3].plot(allocation, label=asset)
+        axs[3].set_xlabel('Iteration')
+        axs[3].set_ylabel('Percentage of Total Wealth')
+        axs[3].set_title('Asset Allocation Over Time')
+        axs[3].legend()
+
+        if show_graph:
+            self.draw_network(axs[4])
+            axs[4].set_title('Network Structure of Agents')
+
+        fig.suptitle("\n".join(wrap(self.descriptor_string)))
+        plt.tight_layout()
+        fig.subplots_adjust(top=0.90)
+        plt.show()
+    def draw_network(self, ax):
+        color_map = []
+        for node in self.network:
+            # if isinstance(self.agent_structure.get_agent(node), RationalAgent):
+            #     color_map.append('blue')
+            # else:
+            #     color_map.append('red')
+            color_map.append('blue')
+
+        pos = nx.spring_layout(self.network)
+        nx.draw(self.network, pos, node_color=color_map, with_labels=True, ax=ax)
+
+    def generate_images_and_gif(self, network_states, output_filename='network_behavior.gif', fps=5, processes=1,
+                                positions=None, **animator_kwargs):
+        """
+        Animates who holds the coin over the run. The graph is drawn once, every frame only recolors the nodes and goes
+        to the writer as it is rendered, without frame files (see Animation.render_animation)
+        :param network_states - (iterations, agents) bool array of the agents, by id, holding the coin at every step
+        :param output_filename - .gif, or a video format such as .mp4
+        :param fps
+        :param processes - number of processes rendering frames, all cores if None
+        :param positions - node positions, a spring layout if None
+        :param animator_kwargs - drawing options, see Animation.NetworkAnimator
+        """
+        render_animation(self.network, network_states, output_filename, fps=fps, positions=positions,
+                         processes=processes, **animator_kwargs)
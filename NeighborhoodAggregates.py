@@ -0,0 +1,109 @@
+import numpy as np
+from scipy import sparse
+
+from SparseNetwork import in_neighbor_matrix
+
+
+class NeighborhoodAggregates:
+    """
+    Running sums over every agent's neighborhood (the neighbors it looks at when it acts), so agents can read their
+    signal in O(1) instead of visiting each neighbor:
+    - neighbor_units[i, c]: total units of coin c held by i's neighbors
+    - neighbor_holders[i, c]: number of i's neighbors holding coin c
+    - neighbor_cash[i]: total budget of i's neighbors
+
+    Coin values are kept in units and multiplied by the current price when read, so price changes need no update.
+    Every change to an agent's holdings or budget has to be reported through record_trade, which pushes the delta to
+    the agents that have it as a neighbor. rebuild recomputes everything from the agent objects
+    """
+
+    def __init__(self, market):
+        self.market = market
+        self.coin_index = market.coin_registry.index
+        self.neighbors = in_neighbor_matrix(market.adjacency, market.directed)
+        # Row j lists the agents that have j as a neighbor
+        self.followers = sparse.csr_array(market.adjacency)
+        self.in_degree = np.diff(self.neighbors.indptr)
+        self.rebuild()
+
+    def rebuild(self):
+        agent_table = self.market.agent_structure.agent_table
+        holdings = self.market.portfolios.holdings
+        budgets = np.array([agent.budget for agent in agent_table], dtype=np.float64)
+
+        self.neighbor_units = self.neighbors @ holdings
+        self.neighbor_holders = np.rint(self.neighbors @ (holdings > 0).astype(np.float64)).astype(np.int64)
+        self.neighbor_cash = self.neighbors @ budgets
+
+    def record_trade(self, agent_id, coin, holdings_before, holdings_after, budget_change):
+        """
+        Pushes a change in an agent's holdings of a coin and in its budget to everyone that watches it
+        """
+        start, end = self.followers.indptr[agent_id], self.followers.indptr[agent_id + 1]
+        if start == end:
+            return
+        followers = self.followers.indices[start:end]
+        c = self.coin_index[coin.name]
+
+        if holdings_after != holdings_before:
+            self.neighbor_units[followers, c] += holdings_after - holdings_before
+        if (holdings_before > 0) != (holdings_after > 0):
+            self.neighbor_holders[followers, c] += 1 if holdings_after > 0 else -1
+        if budget_change:
+            self.neighbor_cash[followers] += budget_change
+
+    def record_trades(self, coin, agent_ids, holdings_before, holdings_after):
+        """
+        Pushes a change in the holdings of one coin by many agents at once (agent_ids has to be free of duplicates), with
+        one sparse product instead of a record_trade per agent
+        """
+        if len(agent_ids) == 0:
+            return
+        c = self.coin_index[coin.name]
+        n = self.neighbors.shape[0]
+        units = np.zeros(n)
+        units[agent_ids] = holdings_after - holdings_before
+        holders = np.zeros(n)
+        holders[agent_ids] = (holdings_after > 0).astype(np.float64) - (holdings_before > 0)
+        self.neighbor_units[:, c] += self.neighbors @ units
+        self.neighbor_holders[:, c] += np.rint(self.neighbors @ holders).astype(np.int64)
+
+    def num_neighbors(self, agent_id):
+        return int(self.in_degree[agent_id])
+
+    def holding_proportion(self, agent_id, coin):
+        """
+        Share of the agent's neighbors holding the coin
+        """
+        return int(self.neighbor_holders[agent_id, self.coin_index[coin.name]]) / int(self.in_degree[agent_id])
+
+    def coin_value(self, agent_id, coin):
+        """
+        Total value of the coin held by the agent's neighbors
+        """
+        return float(self.neighbor_units[agent_id, self.coin_index[coin.name]]) * coin.price
+
+    def cash(self, agent_id):
+        """
+        Total budget of the agent's neighbors
+        """
+        return float(self.neighbor_cash[agent_id])
+
+    def portfolio_value(self, agent_id):
+        """
+        Total portfolio value of the agent's neighbors, valued at current prices
+        """
+        units = self.neighbor_units[agent_id].tolist()
+        return float(self.neighbor_cash[agent_id]) + sum(units[coin.index] * coin.price for coin in self.market.coin_registry)
+
+    def coin_values(self, agent_ids, coin):
+        """
+        coin_value of many agents at once
+        """
+        return self.neighbor_units[agent_ids, self.coin_index[coin.name]] * coin.price
+
+    def portfolio_values(self, agent_ids):
+        """
+        portfolio_value of many agents at once
+        """
+        return self.neighbor_cash[agent_ids] + self.neighbor_units[agent_ids] @ self.market.coin_registry.prices()
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+
+class NetworkCache:
+    """
+    Content addressed on-disk cache of generated networks
+
+    Entries are keyed by a hash of (network_type, num_agents, generator params, seed) and stored as one directory of
+    uncompressed .npy CSR arrays, so they can be memory-mapped: repeat runs and parallel workers map the cached graph
+    (sharing the OS page cache) instead of rebuilding it. Entries are written to a temporary directory and renamed into
+    place, so concurrent writers never expose a partial entry. When the cache grows past max_bytes the least recently
+    used entries are evicted.
+
+    :param directory
+    :param max_bytes - disk budget, None for no limit
+    :param mmap - map cached arrays read only instead of reading them into memory
+    """
+
+    def __init__(self, directory, max_bytes=None, mmap=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mmap = mmap
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(network_type, num_agents, params, seed):
+        description = json.dumps([network_type, num_agents, params, seed], sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        :return: (adjacency, directed), or None on a miss
+        """
+        path = self._path(key)
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            mmap_mode = 'r' if self.mmap else None
+            arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+                      for name in ('data', 'indices', 'indptr')}
+        except FileNotFoundError:
+            return None
+
+        # Mark as recently used
+        os.utime(path)
+        shape = (meta['num_nodes'], meta['num_nodes'])
+        adjacency = sparse.csr_array((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape)
+        return adjacency, meta['directed']
+
+    def put(self, key, adjacency, directed):
+        path = self._path(key)
+        if os.path.isdir(path):
+            return
+        adjacency = sparse.csr_array(adjacency)
+        staging = tempfile.mkdtemp(prefix=f'.{key}.', dir=self.directory)
+        try:
+            for name in ('data', 'indices', 'indptr'):
+                np.save(os.path.join(staging, f'{name}.npy'), getattr(adjacency, name))
+            with open(os.path.join(staging, 'meta.json'), 'w') as f:
+                json.dump({'num_nodes': adjacency.shape[0], 'directed': directed}, f)
+            os.rename(staging, path)
+        except OSError:
+            # Another process stored the same entry first
+            if not os.path.isdir(path):
+                raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def get_or_create(self, key, build):
+        """
+        Returns the cached network for key, calling build() -> (adjacency, directed) and storing its result on a miss
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        adjacency, directed = build()
+        self.put(key, adjacency, directed)
+        # Reload through the cache so the caller gets the mapped copy (unless the entry was too big to keep)
+        cached = self.get(key) if self.mmap else None
+        return cached if cached is not None else (adjacency, directed)
+
+    def entries(self):
+        """
+        :return: [(path, size in bytes, last use)] for every complete entry, least recently used first
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((path, size, os.stat(path).st_mtime))
+            except FileNotFoundError:
+                continue
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes
+        """
+        if self.max_bytes is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            # Workers that already mapped the entry keep their view, unlinked files stay valid until closed
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,208 @@
+import multiprocessing
+import os
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from Partition import partition_network
+from Portfolio import PortfolioValuation
+from VectorizedEngine import VectorizedEngine
+
+
+class ParallelEngine(VectorizedEngine):
+    """
+    VectorizedEngine whose agents are split over worker processes along a partition of the network (see
+    partition_network), for markets too big for one core
+
+    Holdings, buy prices, bought flags, budgets, fair values, portfolio valuations (see PortfolioValuation) and coin
+    prices live in shared memory, so no state is sent between processes. In every sub step each worker decides for the
+    agents of its part in the group, reading their neighbors' state straight from the shared arrays, and the partition
+    only keeps most of those reads within the part's own rows. The main process then clears the group's orders and the
+    workers commit their own agents' trades. Replies are collected in part order, so the result only depends on the seed
+    and the partition, not on timing.
+
+    Each part draws from its own child stream of the market's rng, so runs are reproducible for a given number of
+    parts but differ from the single process vectorized engine. Workers are forked, which needs a platform with the fork
+    start method
+
+    :param market
+    :param sub_steps
+    :param clearing
+    :param processes - number of worker processes (and parts), all cores by default
+    :param partition - optional array with the part of every agent, overrides the partition of the network
+    :param tracer - optional SimulationTracer, only the main process is traced
+    """
+
+    # Per agent state kept in shared memory, written by the workers for the agents of their part
+    SHARED_STATE = ('holdings', 'average_buy_prices', 'bought', 'budgets', 'fair_values')
+
+    def __init__(self, market, sub_steps=1, clearing=None, processes=None, partition=None, tracer=None):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise ValueError("engine='parallel' needs the fork start method")
+        self.blocks = []
+        self.shared = {}
+        num_agents, num_coins = market.portfolios.holdings.shape
+        for name, shape, dtype in (('holdings', (num_agents, num_coins), np.float64),
+                                   ('average_buy_prices', (num_agents, num_coins), np.float64),
+                                   ('bought', (num_agents, num_coins), np.bool_),
+                                   ('budgets', (num_agents,), np.float64),
+                                   ('fair_values', (num_agents, num_coins), np.float64),
+                                   ('prices', (num_coins,), np.float64),
+                                   ('values', (num_agents,), np.float64),
+                                   ('valued_prices', (num_coins,), np.float64),
+                                   ('delta', (num_agents,), np.float64),
+                                   ('group_of', (num_agents,), np.int64)):
+            self.shared[name] = self._allocate(shape, dtype)
+        self.prices = self.shared['prices']
+        self.delta = self.shared['delta']
+        self.group_of = self.shared['group_of']
+        super().__init__(market, sub_steps, clearing, tracer)
+
+        processes = processes if processes is not None else os.cpu_count() or 1
+        if partition is None:
+            partition = partition_network(market.adjacency, processes, getattr(market, 'communities', None))
+        self.partition = np.asarray(partition, dtype=np.int64)
+        self.parts = [np.flatnonzero(self.partition == part) for part in range(int(self.partition.max()) + 1)]
+        self.streams = market.rng.spawn(len(self.parts))
+        self.workers = []
+
+    def _allocate(self, shape, dtype):
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        self.blocks.append(block)
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def load_state(self):
+        """
+        Copies the market's state into the shared arrays, in place so the workers keep seeing them
+        """
+        super().load_state()
+        for name in self.SHARED_STATE:
+            shared = self.shared[name]
+            shared[...] = getattr(self, name)
+            setattr(self, name, shared)
+        self.valuation = PortfolioValuation(self.holdings, self.budgets, self.market.coin_registry.prices(),
+                                            self.shared['values'], self.shared['valued_prices'])
+
+    def store_state(self):
+        portfolios = self.market.portfolios
+        portfolios.holdings[...] = self.holdings
+        portfolios.average_buy_prices[...] = self.average_buy_prices
+        portfolios.bought[...] = self.bought
+        super().store_state()
+
+    def _sync_prices(self):
+        self.prices[:] = self.market.coin_registry.prices()
+
+    def _broadcast(self, command):
+        """
+        Sends a command to every worker and waits for all of them, in part order
+        """
+        for connection, _ in self.workers:
+            connection.send(command)
+        for connection, _ in self.workers:
+            reply = connection.recv()
+            if reply is not None:
+                raise RuntimeError(f"Parallel engine worker failed:\n{reply}")
+
+    def step(self, coin):
+        c = self.coin_index[coin.name]
+        if self.sub_steps == 1:
+            groups = [np.arange(self.num_agents)]
+        else:
+            groups = np.array_split(self.rng.permutation(self.num_agents), self.sub_steps)
+        for g, rows in enumerate(groups):
+            self.group_of[rows] = g
+
+        self._sync_prices()
+        self.valuation.refresh(self.prices)
+        total_delta = np.zeros(self.num_agents)
+        prices = []
+        phase = self.phase
+        for g, rows in enumerate(groups):
+            with phase('decide', coin=coin.name):
+                self._sync_prices()
+                self._broadcast(('decide', c, g))
+            with phase('clear', coin=coin.name):
+                price = self.clearing.clear(coin, self.delta[rows])
+            with phase('commit', coin=coin.name):
+                self._broadcast(('commit', c, price))
+            total_delta[rows] = self.delta[rows]
+            # Keeps the price floor and the highest price up even when the group didn't trade
+            self.clearing.set_price(coin, coin.price)
+            prices.append(coin.price)
+        return total_delta, prices
+
+    def start(self):
+        context = multiprocessing.get_context('fork')
+        for part, rows in enumerate(self.parts):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=_work, args=(self, rows, self.streams[part], worker_connection),
+                                      daemon=True)
+            process.start()
+            worker_connection.close()
+            self.workers.append((connection, process))
+
+    def stop(self):
+        for connection, process in self.workers:
+            try:
+                connection.send(('stop',))
+            except (BrokenPipeError, OSError):
+                pass
+            process.join()
+            connection.close()
+        self.workers = []
+
+    def close(self):
+        """
+        Stops the workers and releases the shared memory, the engine's arrays become private copies
+        """
+        self.stop()
+        for name in self.SHARED_STATE:
+            setattr(self, name, np.array(getattr(self, name)))
+        self.valuation = PortfolioValuation(self.holdings, self.budgets, np.array(self.valuation.prices))
+        self.prices = self.delta = self.group_of = None
+        self.shared = {}
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def simulate(self, num_iterations, resolution="action", decimation=1):
+        self.start()
+        try:
+            return super().simulate(num_iterations, resolution, decimation)
+        finally:
+            self.close()
+
+
+def _work(engine, part_rows, stream, connection):
+    """
+    Worker loop: decides for the agents of one part and commits their trades once the group is cleared
+    """
+    engine.rng = stream.generator
+    registry = engine.market.coin_registry
+    pending = None
+    while True:
+        command = connection.recv()
+        if command[0] == 'stop':
+            break
+        try:
+            coin = registry.coins[command[1]]
+            if command[0] == 'decide':
+                _, _, g = command
+                for registered, price in zip(registry.coins, engine.prices.tolist()):
+                    registered.price = price
+                rows = part_rows[engine.group_of[part_rows] == g]
+                delta, bought, avg = engine.decide(coin, rows)
+                engine.delta[rows] = delta
+                pending = rows, delta, bought, avg
+            elif command[0] == 'commit':
+                rows, delta, bought, avg = pending
+                engine.delta[rows] = engine.commit(coin, delta, bought, avg, command[2], rows)
+                pending = None
+            connection.send(None)
+        except Exception:
+            connection.send(traceback.format_exc())
+    connection.close()
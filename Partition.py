@@ -0,0 +1,54 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+
+def partition_network(adjacency, num_parts, communities=None, tolerance=0.1):
+    """
+    Splits the nodes of a network into num_parts balanced parts that keep connected nodes together, so each part mostly
+    reads its own nodes and only the boundary (see boundary_nodes) crosses parts
+
+    With community labels (the communities of the multiple core periphery generators) whole communities are packed into
+    parts, largest first into the part with the fewest nodes, as long as no part ends up more than tolerance above an
+    equal share. Otherwise nodes are ordered by reverse Cuthill-McKee, which places neighbors close to each other, and
+    the order is cut into equal chunks
+    :param adjacency - CSR adjacency matrix
+    :param num_parts
+    :param communities - optional array with the community of every node
+    :param tolerance - allowed imbalance of a partition by communities
+    :return: array with the part of every node
+    """
+    n = adjacency.shape[0]
+    num_parts = max(1, min(num_parts, n))
+    labels = np.empty(n, dtype=np.int64)
+    if communities is not None and len(np.unique(communities)) >= num_parts:
+        names, community_of, sizes = np.unique(communities, return_inverse=True, return_counts=True)
+        part_of_community = np.empty(len(names), dtype=np.int64)
+        loads = np.zeros(num_parts, dtype=np.int64)
+        for community in np.argsort(-sizes, kind='stable'):
+            part = int(np.argmin(loads))
+            part_of_community[community] = part
+            loads[part] += sizes[community]
+        if loads.max() <= (1 + tolerance) * n / num_parts:
+            labels[:] = part_of_community[community_of]
+            return labels
+
+    pattern = sparse.csr_array(adjacency, dtype=np.int8)
+    symmetric = sparse.csr_array(pattern + pattern.T)
+    order = reverse_cuthill_mckee(symmetric, symmetric_mode=True)
+    for part, chunk in enumerate(np.array_split(order, num_parts)):
+        labels[chunk] = part
+    return labels
+
+
+def boundary_nodes(neighbors, labels):
+    """
+    Nodes watched by a node of another part, the reads a partition doesn't keep within a part
+    :param neighbors - CSR in-neighbor matrix
+    :param labels - part of every node, see partition_network
+    :return: bool array over the nodes
+    """
+    rows = np.repeat(np.arange(neighbors.shape[0]), np.diff(neighbors.indptr))
+    boundary = np.zeros(neighbors.shape[0], dtype=bool)
+    boundary[neighbors.indices[labels[rows] != labels[neighbors.indices]]] = True
+    return boundary
@@ -0,0 +1,283 @@
+import numpy as np
+
+
+class CoinRegistry:
+    """
+    Assigns every coin of a market a fixed integer index (stored on the coin as coin.index), the column of the coin in
+    the market's (agents, coins) arrays. Coins are looked up by name in O(1)
+    """
+
+    def __init__(self, coins=()):
+        self.coins = []
+        self.index = {}
+        for coin in coins:
+            self.add(coin)
+
+    def add(self, coin):
+        """
+        Registers a coin, coins that share the name of a registered coin get its index
+        :return: the coin's index
+        """
+        if coin.name not in self.index:
+            self.index[coin.name] = len(self.coins)
+            self.coins.append(coin)
+        coin.index = self.index[coin.name]
+        return coin.index
+
+    def __len__(self):
+        return len(self.coins)
+
+    def __iter__(self):
+        return iter(self.coins)
+
+    def __contains__(self, coin_name):
+        return coin_name in self.index
+
+    def __getitem__(self, coin_name):
+        return self.coins[self.index[coin_name]]
+
+    def prices(self):
+        return np.array([coin.price for coin in self.coins], dtype=np.float64)
+
+
+class PortfolioState:
+    """
+    Holdings, average buy prices and bought flags of every agent in a market, as (agents, coins) arrays indexed by agent
+    id and coin index:
+    - holdings: units held
+    - average_buy_prices: NaN when the agent has no buy price for the coin
+    - bought: whether the agent is in a position it opened by buying
+
+    bind replaces an agent's holdings, average_buy_prices and bought dicts/sets with views of its row, so Agent code keeps
+    working unchanged while array code (the vectorized engine, aggregates, valuations) reads the same memory.
+
+    :param agent_table - agents indexed by id, every one of them is bound
+    :param registry - CoinRegistry, every coin the agents hold has to be registered
+    """
+
+    def __init__(self, agent_table, registry):
+        self.registry = registry
+        num_agents, num_coins = len(agent_table), len(registry)
+        self.holdings = np.zeros((num_agents, num_coins))
+        self.average_buy_prices = np.full((num_agents, num_coins), np.nan)
+        self.bought = np.zeros((num_agents, num_coins), dtype=bool)
+        for agent in agent_table:
+            self.bind(agent)
+
+    @classmethod
+    def from_arrays(cls, agent_table, registry, holdings, average_buy_prices, bought):
+        """
+        PortfolioState over existing arrays, e.g. restored from a checkpoint. The agents get views of their rows, nothing
+        is read from their own holdings
+        """
+        state = cls.__new__(cls)
+        state.registry = registry
+        state.holdings = holdings
+        state.average_buy_prices = average_buy_prices
+        state.bought = bought
+        index = registry.index
+        for agent, holdings_row, prices_row, bought_row in zip(agent_table, holdings, average_buy_prices, bought):
+            agent.holdings = HoldingsView(index, holdings_row)
+            agent.average_buy_prices = AverageBuyPriceView(index, prices_row)
+            agent.bought = BoughtView(index, bought_row)
+        return state
+
+    def bind(self, agent):
+        """
+        Moves the agent's current holdings, buy prices and bought flags into the arrays and swaps in array views
+        """
+        i = agent.id
+        for coin_name, amount in agent.holdings.items():
+            self.holdings[i, self._column(coin_name)] = amount
+        for coin_name, price in agent.average_buy_prices.items():
+            self.average_buy_prices[i, self._column(coin_name)] = price
+        for coin_name in agent.bought:
+            self.bought[i, self._column(coin_name)] = True
+        agent.holdings = HoldingsView(self.registry.index, self.holdings[i])
+        agent.average_buy_prices = AverageBuyPriceView(self.registry.index, self.average_buy_prices[i])
+        agent.bought = BoughtView(self.registry.index, self.bought[i])
+
+    def _column(self, coin_name):
+        if coin_name not in self.registry:
+            raise KeyError(f"{coin_name} is not a coin of this market")
+        return self.registry.index[coin_name]
+
+    def portfolio_values(self, budgets):
+        """
+        Total value of every agent's portfolio at current prices
+        :param budgets - array of budgets by agent id
+        """
+        return budgets + self.holdings @ self.registry.prices()
+
+
+class PortfolioValuation:
+    """
+    Cache of every agent's portfolio value (budget plus holdings at market prices), kept with the prices it was computed
+    at. refresh revalues everyone at once, revalue redoes the agents whose holdings or budget changed since, and
+    values_of brings cached values up to the current prices by reading only the holdings of the coins that moved. Within
+    a coin pass of the vectorized engines only that coin moves, so a neighbor's value costs a lookup and one held amount
+    however many coins the market has, and agents watched by many others aren't revalued for each of them
+
+    :param holdings - (agents, coins) array of units held
+    :param budgets - array of budgets by agent id
+    :param prices - array of prices by coin index to value everyone at first
+    :param values - optional array to keep the values in (e.g. in shared memory), by agent id
+    :param valued_prices - optional array to keep the prices of the values in, by coin index
+    """
+
+    def __init__(self, holdings, budgets, prices, values=None, valued_prices=None):
+        self.holdings = holdings
+        self.budgets = budgets
+        self.values = values if values is not None else np.zeros(len(budgets))
+        self.prices = valued_prices if valued_prices is not None else np.zeros(holdings.shape[1])
+        self.refresh(prices)
+
+    def refresh(self, prices):
+        """
+        Revalues every agent at prices
+        :param prices - array of prices by coin index
+        """
+        self.prices[:] = prices
+        np.add(self.budgets, self.holdings @ self.prices, out=self.values)
+
+    def revalue(self, rows):
+        """
+        Revalues some agents at the prices of the cache, after they traded
+        """
+        self.values[rows] = self.budgets[rows] + self.holdings[rows] @ self.prices
+
+    def values_of(self, ids, prices):
+        """
+        Portfolio values of some agents at prices
+        :param ids - array of agent ids (or a slice)
+        :param prices - array of prices by coin index
+        """
+        values = self.values[ids]
+        for c in np.flatnonzero(prices != self.prices).tolist():
+            values = values + self.holdings[ids, c] * (prices[c] - self.prices[c])
+        return values
+
+
+class _RowView:
+    """
+    Base of the dict/set views over one agent's row of a PortfolioState array
+    """
+
+    def __init__(self, index, row):
+        self._index = index
+        self._row = row
+
+    def _column(self, coin_name):
+        try:
+            return self._index[coin_name]
+        except KeyError:
+            raise KeyError(f"{coin_name} is not a coin of this market") from None
+
+    def _present(self, value):
+        raise NotImplementedError
+
+    def __iter__(self):
+        return (coin_name for coin_name, c in self._index.items() if self._present(self._row[c]))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, coin_name):
+        c = self._index.get(coin_name)
+        return c is not None and bool(self._present(self._row.item(c)))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({list(self)})"
+
+
+class HoldingsView(_RowView):
+    """
+    Dict-like view of an agent's holdings. Every coin of the market has a value, coins held in zero units are left out
+    when iterating
+    """
+
+    def _present(self, value):
+        return value != 0
+
+    def __getitem__(self, coin_name):
+        return self._row.item(self._column(coin_name))
+
+    def get(self, coin_name, default=None):
+        c = self._index.get(coin_name)
+        return self._row.item(c) if c is not None else default
+
+    def __setitem__(self, coin_name, amount):
+        self._row[self._column(coin_name)] = amount
+
+    def items(self):
+        return [(coin_name, self._row.item(c)) for coin_name, c in self._index.items() if self._row[c] != 0]
+
+    def __repr__(self):
+        return f"HoldingsView({dict(self.items())})"
+
+
+class AverageBuyPriceView(_RowView):
+    """
+    Dict-like view of an agent's average buy prices, NaN means no price (tested with value != value, which is much
+    cheaper than np.isnan on a scalar)
+    """
+
+    def _present(self, value):
+        return value == value
+
+    def __getitem__(self, coin_name):
+        value = self._row.item(self._column(coin_name))
+        if value != value:
+            raise KeyError(coin_name)
+        return value
+
+    def get(self, coin_name, default=None):
+        c = self._index.get(coin_name)
+        if c is None:
+            return default
+        value = self._row.item(c)
+        return value if value == value else default
+
+    def __setitem__(self, coin_name, price):
+        self._row[self._column(coin_name)] = price
+
+    def __delitem__(self, coin_name):
+        self[coin_name]
+        self._row[self._column(coin_name)] = np.nan
+
+    def pop(self, coin_name, *default):
+        if coin_name in self:
+            value = self[coin_name]
+            del self[coin_name]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(coin_name)
+
+    def items(self):
+        return [(coin_name, self._row.item(c)) for coin_name, c in self._index.items() if self._row[c] == self._row[c]]
+
+    def __repr__(self):
+        return f"AverageBuyPriceView({dict(self.items())})"
+
+
+class BoughtView(_RowView):
+    """
+    Set-like view of the coins an agent has bought into
+    """
+
+    def _present(self, value):
+        return value
+
+    def add(self, coin_name):
+        self._row[self._column(coin_name)] = True
+
+    def discard(self, coin_name):
+        c = self._index.get(coin_name)
+        if c is not None:
+            self._row[c] = False
+
+    def remove(self, coin_name):
+        if coin_name not in self:
+            raise KeyError(coin_name)
+        self.discard(coin_name)
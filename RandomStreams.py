@@ -0,0 +1,140 @@
+import numpy as np
+
+
+class SimulationRNG:
+    """
+    Source of randomness for one simulation, built on numpy.random.Generator
+
+    Scalar draws (random, uniform, randint, normal, pareto) are served from blocks drawn in advance, so the hot loop pays
+    for one list lookup instead of one generator call per draw. The whole simulation (agent structure, agents, market,
+    airdrops and network builders) should share one instance, which makes a run reproducible from its seed without
+    touching the global random or numpy.random state.
+
+    :param seed - anything numpy.random.default_rng accepts, None draws fresh entropy
+    :param block_size - number of values drawn per block
+    """
+
+    def __init__(self, seed=None, block_size=4096):
+        self.generator = np.random.default_rng(seed)
+        self.block_size = block_size
+        self._next_uniform = iter(()).__next__
+        self._next_normal = iter(()).__next__
+
+    def __getstate__(self):
+        # The buffered draws not handed out yet are part of the state, keep them as lists instead of iterators
+        return {'generator': self.generator, 'block_size': self.block_size,
+                'uniforms': _remaining(self._next_uniform), 'normals': _remaining(self._next_normal)}
+
+    def __setstate__(self, state):
+        self.generator = state['generator']
+        self.block_size = state['block_size']
+        self._next_uniform = iter(state['uniforms']).__next__
+        self._next_normal = iter(state['normals']).__next__
+
+    def _refill_uniforms(self):
+        self._next_uniform = iter(self.generator.random(self.block_size).tolist()).__next__
+
+    def _refill_normals(self):
+        self._next_normal = iter(self.generator.standard_normal(self.block_size).tolist()).__next__
+
+    def random(self):
+        """
+        Uniform float in [0, 1)
+        """
+        try:
+            return self._next_uniform()
+        except StopIteration:
+            self._refill_uniforms()
+            return self._next_uniform()
+
+    def uniform(self, low, high):
+        return low + (high - low) * self.random()
+
+    def randint(self, low, high):
+        """
+        Integer in [low, high], both ends included like random.randint
+        """
+        if high < low:
+            raise ValueError(f"empty range for randint({low}, {high})")
+        return low + int(self.random() * (high - low + 1))
+
+    def normal(self, loc=0.0, scale=1.0):
+        try:
+            return loc + scale * self._next_normal()
+        except StopIteration:
+            self._refill_normals()
+            return loc + scale * self._next_normal()
+
+    def pareto(self, b, scale=1.0):
+        """
+        Same distribution as scipy.stats.pareto.rvs(b, scale=scale)
+        """
+        return scale * (1.0 - self.random()) ** (-1.0 / b)
+
+    def uniforms(self, low, high, size):
+        """
+        Array of size uniform floats in [low, high), for bulk draws
+        """
+        return self.generator.uniform(low, high, size)
+
+    def randints(self, low, high, size):
+        """
+        Array of size integers in [low, high], both ends included like randint
+        """
+        return self.generator.integers(low, high, size=size, endpoint=True)
+
+    def paretos(self, b, scale, size):
+        """
+        Array of size draws from the distribution of pareto
+        """
+        # numpy's pareto is the Lomax distribution, shifted by one from scipy's
+        return scale * (1.0 + self.generator.pareto(b, size))
+
+    def permutation(self, n):
+        return self.generator.permutation(n)
+
+    def shuffle(self, items):
+        """
+        Shuffles a list in place
+        """
+        order = self.generator.permutation(len(items))
+        items[:] = [items[i] for i in order]
+
+    def choices(self, population, k):
+        """
+        k elements of population drawn with replacement, like random.choices
+        """
+        return [population[i] for i in self.generator.integers(0, len(population), size=k)]
+
+    def seed_int(self):
+        """
+        Integer seed for libraries that take their own seed, such as the networkx generators
+        """
+        return int(self.generator.integers(2 ** 32))
+
+    def spawn(self, n):
+        """
+        n independent child streams, e.g. one per worker
+        """
+        return [SimulationRNG(child, self.block_size) for child in self.generator.bit_generator.seed_seq.spawn(n)]
+
+
+def _remaining(next_value):
+    """
+    Values a list iterator's __next__ has yet to return, without consuming them
+    """
+    _, (values,), *position = next_value.__self__.__reduce__()
+    return list(values[position[0] if position else len(values):])
+
+
+_default_rng = None
+
+
+def default_rng():
+    """
+    Shared unseeded stream used when no SimulationRNG is passed in
+    """
+    global _default_rng
+    if _default_rng is None:
+        _default_rng = SimulationRNG()
+    return _default_rng
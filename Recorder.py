@@ -0,0 +1,181 @@
+import numpy as np
+
+
+class HistoryRecorder:
+    """
+    Preallocated NumPy storage for the histories of one CryptoMarket.simulate run
+
+    Prices are kept in a (coins, samples) array. With resolution='action' a price is sampled after every action (every
+    agent action in the sequential engine, every sub step in the vectorized one), keeping only every decimation-th one
+    plus the last action of each step, so every step contributes the same number of samples and the price at the end of
+    step t is prices[:, (t + 1) * samples_per_step]. resolution='step' only keeps the price at the end of each step.
+
+    Holder counts per agent type, total units of each coin and total cash are running totals updated through on_trade
+    (or recomputed from arrays with sync), so nothing is summed over the agents between steps.
+
+    :param market
+    :param num_iterations
+    :param actions_per_step - actions of one coin in one step, num_agents for the sequential engine and sub_steps for the
+    vectorized one
+    :param resolution - 'action' or 'step'
+    :param decimation - with resolution='action', keep one price every decimation actions
+    :param network_coin - name of the coin whose holders are recorded for every step in network_states, None to skip them
+    """
+
+    def __init__(self, market, num_iterations, actions_per_step, resolution='action', decimation=1,
+                 network_coin='Bitcoin'):
+        if resolution not in ('action', 'step'):
+            raise ValueError(f"Unknown resolution {resolution}")
+        if decimation < 1:
+            raise ValueError(f"decimation has to be at least 1, got {decimation}")
+        self.coin_names = [coin.name for coin in market.coins]
+        self.coin_index = {name: i for i, name in enumerate(self.coin_names)}
+        self.agent_types = list(market.agent_types)
+        self.num_iterations = num_iterations
+        num_coins, num_types, num_agents = len(self.coin_names), len(self.agent_types), market.num_agents
+
+        # The action after which each price sample of a step is taken, -1 for actions that are skipped
+        if resolution == 'step':
+            sampled = [actions_per_step - 1]
+        else:
+            sampled = list(range(decimation - 1, actions_per_step, decimation))
+            if not sampled or sampled[-1] != actions_per_step - 1:
+                sampled.append(actions_per_step - 1)
+        self.samples_per_step = len(sampled)
+        self.slots = [-1] * actions_per_step
+        for slot, action in enumerate(sampled):
+            self.slots[action] = slot
+
+        self.prices = np.empty((num_coins, num_iterations * self.samples_per_step + 1))
+        self.holders = np.zeros((num_coins, num_types, num_iterations + 1), dtype=np.int64)
+        self.net_trade_volume = np.zeros((num_coins, num_iterations))
+        self.trade_volume = np.zeros((num_coins, num_iterations))
+        self.cash = np.zeros(num_iterations)
+        self.units = np.zeros((num_coins, num_iterations))
+        self.network_coin = network_coin if network_coin in self.coin_index else None
+        self.network_states = np.zeros((num_iterations if self.network_coin else 0, num_agents), dtype=bool)
+
+        agent_table = market.agent_structure.agent_table
+        type_index = {agent_type: k for k, agent_type in enumerate(self.agent_types)}
+        self.type_codes = np.array([type_index[agent.get_type()] for agent in agent_table], dtype=np.int64)
+        self._type_codes = self.type_codes.tolist()
+
+        # Columns of the recorded coins in the market's holdings array
+        self.columns = [coin.index for coin in market.coins]
+        self.sync(market.portfolios.holdings, np.array([agent.budget for agent in agent_table], dtype=np.float64))
+        self.prices[:, 0] = [coin.price for coin in market.coins]
+
+    def sync(self, holdings, budgets):
+        """
+        Recomputes the running totals from the market's (agents, coins) holdings array and a budgets array
+        """
+        self.holding = holdings[:, self.columns] > 0
+        self._holders = [np.bincount(self.type_codes[self.holding[:, c]], minlength=len(self.agent_types)).tolist()
+                         for c in range(len(self.coin_names))]
+        self._units = holdings[:, self.columns].sum(axis=0).tolist()
+        self._cash = float(budgets.sum())
+
+    def on_trade(self, agent_id, coin, holdings_before, holdings_after, budget_change):
+        """
+        Updates the running totals with one agent's change in holdings of a coin and in budget
+        """
+        self._cash += budget_change
+        c = self.coin_index.get(coin.name)
+        if c is None:
+            return
+        if (holdings_before > 0) != (holdings_after > 0):
+            self._holders[c][self._type_codes[agent_id]] += 1 if holdings_after > 0 else -1
+            self.holding[agent_id, c] = holdings_after > 0
+        self._units[c] += holdings_after - holdings_before
+
+    def on_trades(self, coin, agent_ids, holdings_before, holdings_after):
+        """
+        on_trade for a change in the holdings of one coin by many agents at once, agent_ids has to be free of duplicates
+        """
+        c = self.coin_index.get(coin.name)
+        if c is None or len(agent_ids) == 0:
+            return
+        entered = self.type_codes[agent_ids[(holdings_before <= 0) & (holdings_after > 0)]]
+        left = self.type_codes[agent_ids[(holdings_before > 0) & (holdings_after <= 0)]]
+        change = np.bincount(entered, minlength=len(self.agent_types)) - np.bincount(left, minlength=len(self.agent_types))
+        self._holders[c] = (np.array(self._holders[c]) + change).tolist()
+        self.holding[agent_ids, c] = holdings_after > 0
+        self._units[c] += float(np.sum(holdings_after - holdings_before))
+
+    def begin_step(self, t):
+        """
+        Called once airdrops for step t are done, before any agent acts
+        """
+        if t == 0:
+            self.holders[:, :, 0] = self._holders
+        self.cash[t] = self._cash
+
+    def record_price(self, c, t, action, price):
+        slot = self.slots[action]
+        if slot >= 0:
+            self.prices[c, t * self.samples_per_step + slot + 1] = price
+
+    def end_coin(self, c, t, net_volume, volume):
+        """
+        Called after every agent acted on coin c in step t
+        """
+        self.holders[c, :, t + 1] = self._holders[c]
+        self.net_trade_volume[c, t] = net_volume
+        self.trade_volume[c, t] = volume
+        self.units[c, t] = self._units[c]
+
+    def end_step(self, t):
+        if self.network_coin is not None:
+            self.network_states[t] = self.holding[:, self.coin_index[self.network_coin]]
+
+    def state(self, t):
+        """
+        What was recorded up to the end of step t and the running totals, as arrays, for checkpoints (see restore)
+        """
+        return {
+            'prices': self.prices[:, :(t + 1) * self.samples_per_step + 1],
+            'holders': self.holders[:, :, :t + 2],
+            'net_trade_volume': self.net_trade_volume[:, :t + 1],
+            'trade_volume': self.trade_volume[:, :t + 1],
+            'cash': self.cash[:t + 1],
+            'units': self.units[:, :t + 1],
+            'network_states': self.network_states[:t + 1],
+            'holding': self.holding,
+            'running_holders': np.array(self._holders, dtype=np.int64),
+            'running_units': np.array(self._units, dtype=np.float64),
+            'running_cash': np.array(self._cash),
+        }
+
+    def restore(self, state):
+        """
+        Continues a recording from the state of an earlier run with the same settings
+        """
+        for name in ('prices', 'holders', 'net_trade_volume', 'trade_volume', 'cash', 'units', 'network_states'):
+            recorded = state[name]
+            getattr(self, name)[tuple(slice(0, n) for n in recorded.shape)] = recorded
+        self.holding = np.array(state['holding'])
+        self._holders = state['running_holders'].tolist()
+        self._units = state['running_units'].tolist()
+        self._cash = float(state['running_cash'])
+
+    def step_prices(self):
+        """
+        (coins, iterations + 1) view of the price at the start of the run and at the end of every step
+        """
+        return self.prices[:, ::self.samples_per_step]
+
+    def histories(self):
+        """
+        :return: the tuple returned by CryptoMarket.simulate, with array views in place of lists:
+        price_histories, holdings_histories, network_states, net_trade_volume_histories, trade_volume_histories,
+        asset_allocation_data. network_states is an (iterations, agents) bool array, by agent id, of who holds
+        network_coin at the end of each step. asset_allocation_data maps 'cash' to the total cash at the start of each step
+        and every coin name to the total units held after that coin's trades in the step
+        """
+        price_histories = {name: self.prices[c] for name, c in self.coin_index.items()}
+        holdings_histories = {name: {agent_type: self.holders[c, k] for k, agent_type in enumerate(self.agent_types)}
+                              for name, c in self.coin_index.items()}
+        net_trade_volume_histories = {name: self.net_trade_volume[c] for name, c in self.coin_index.items()}
+        trade_volume_histories = {name: self.trade_volume[c] for name, c in self.coin_index.items()}
+        asset_allocation_data = {'cash': self.cash, **{name: self.units[c] for name, c in self.coin_index.items()}}
+        return price_histories, holdings_histories, self.network_states, net_trade_volume_histories, trade_volume_histories, asset_allocation_data
@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+MANIFEST = 'manifest.json'
+
+
+class ResultSink:
+    """
+    Append only on-disk store of replication summaries (see Runner.summarize_replication)
+
+    Summaries are buffered until chunk_size of them are collected, then every field is written as one uncompressed .npy
+    array per chunk (stacked along the first axis, like BatchResults) and the buffer is dropped, so memory stays flat
+    however many replications are run. manifest.json lists the finished chunks and is replaced atomically after each
+    one, so a crashed run leaves a readable dataset of every chunk written so far. Opening an existing directory appends
+    to it.
+
+    :param directory
+    :param chunk_size - replications per chunk
+    :param metadata - json serializable description of the dataset, e.g. coin names and agent types
+    """
+
+    def __init__(self, directory, chunk_size=256, metadata=None):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'fields': {}, 'chunks': [], 'metadata': {}}
+        self.manifest['metadata'].update(metadata or {})
+        self.seeds = []
+        self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def __len__(self):
+        return sum(chunk['count'] for chunk in self.manifest['chunks']) + len(self.buffer)
+
+    def append(self, seed, summary):
+        """
+        :param seed - the seed the replication was run with
+        :param summary - dict of field name -> array, with the same fields and shapes for every replication
+        """
+        fields = self.manifest['fields']
+        if not fields:
+            fields.update({name: {'dtype': np.asarray(value).dtype.str, 'shape': list(np.shape(value))}
+                           for name, value in summary.items()})
+        elif set(summary) != set(fields):
+            raise ValueError(f"Expected the fields {sorted(fields)}, got {sorted(summary)}")
+        self.seeds.append(seed)
+        self.buffer.append(summary)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered replications as a new chunk
+        """
+        if not self.buffer:
+            self.write_manifest()
+            return
+        name = f"chunk_{len(self.manifest['chunks']):06d}"
+        staging = tempfile.mkdtemp(prefix=f'.{name}.', dir=self.directory)
+        try:
+            np.save(os.path.join(staging, 'seeds.npy'), np.array(self.seeds, dtype=np.int64))
+            for field, spec in self.manifest['fields'].items():
+                stacked = np.stack([np.asarray(summary[field], dtype=spec['dtype']) for summary in self.buffer])
+                np.save(os.path.join(staging, f'{field}.npy'), stacked)
+            os.rename(staging, os.path.join(self.directory, name))
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.manifest['chunks'].append({'name': name, 'count': len(self.buffer)})
+        self.seeds = []
+        self.buffer = []
+        self.write_manifest()
+
+    def write_manifest(self):
+        staging = os.path.join(self.directory, f'.{MANIFEST}.tmp')
+        with open(staging, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(staging, os.path.join(self.directory, MANIFEST))
+
+    def close(self):
+        """
+        Flushes the last partial chunk
+        :return: ResultDataset over everything written
+        """
+        self.flush()
+        return ResultDataset(self.directory)
+
+
+class ResultDataset:
+    """
+    Reader for a directory written by ResultSink. Chunks are memory-mapped, so only the pages that are used get read
+
+    Fields can be read as attributes like BatchResults (dataset.max_prices), which concatenates the chunks into one
+    array, or one chunk at a time through chunks(field) to keep memory bounded on big datasets
+    """
+
+    def __init__(self, directory, mmap=True):
+        self.directory = directory
+        self.mmap_mode = 'r' if mmap else None
+        with open(os.path.join(directory, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.fields = list(self.manifest['fields'])
+        self.metadata = self.manifest['metadata']
+        self.offsets = np.cumsum([0] + [chunk['count'] for chunk in self.manifest['chunks']])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getattr__(self, name):
+        if name in self.__dict__.get('fields', ()) or name == 'seeds':
+            return self.field(name)
+        if name in self.__dict__.get('metadata', {}):
+            return self.metadata[name]
+        raise AttributeError(name)
+
+    def _load(self, chunk, field):
+        return np.load(os.path.join(self.directory, chunk['name'], f'{field}.npy'), mmap_mode=self.mmap_mode)
+
+    def chunks(self, field):
+        """
+        Yields the field's array of every chunk in order
+        """
+        for chunk in self.manifest['chunks']:
+            yield self._load(chunk, field)
+
+    def field(self, field):
+        """
+        The field of every replication as one array, replication first
+        """
+        arrays = list(self.chunks(field))
+        if not arrays:
+            spec = self.manifest['fields'].get(field, {'dtype': '<i8', 'shape': []})
+            return np.empty([0] + spec['shape'], dtype=spec['dtype'])
+        return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+    def replication(self, i):
+        """
+        :return: dict of field -> value of the i-th replication, plus its seed
+        """
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        c = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        chunk = self.manifest['chunks'][c]
+        row = i - int(self.offsets[c])
+        return {field: self._load(chunk, field)[row] for field in self.fields + ['seeds']}
@@ -0,0 +1,182 @@
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+
+from SparseNetwork import to_adjacency
+
+
+class BatchResults:
+    """
+    Results of a batch of replications, stacked into arrays whose first axis is the replication
+    - final_prices, max_prices: (replications, coins)
+    - amount_airdropped: (replications, airdrop strategies), value airdropped by each strategy
+    - price_histories: (replications, coins, iterations + 1), price at the end of every step
+    - holdings_histories: (replications, coins, agent types, iterations + 1), number of agents of each type holding a coin
+    - net_trade_volume_histories, trade_volume_histories: (replications, coins, iterations)
+    - seeds: the seed each replication was run with, so any single one can be rerun on its own
+    """
+
+    def __init__(self, coin_names, agent_types, seeds, replications):
+        self.coin_names = coin_names
+        self.agent_types = agent_types
+        self.seeds = np.array(seeds)
+        for field in replications[0]:
+            setattr(self, field, np.stack([replication[field] for replication in replications]))
+
+    def __len__(self):
+        return len(self.seeds)
+
+
+def summarize_replication(market, histories, num_iterations):
+    """
+    Compresses the output of CryptoMarket.simulate into per step arrays
+    """
+    price_histories, holdings_histories, network_states, net_trade_volume_histories, trade_volume_histories, asset_allocation_data = histories
+    coin_names = [coin.name for coin in market.coins]
+
+    # Prices may be recorded after every action or every sub step, keep the one at the end of each step
+    prices = []
+    for name in coin_names:
+        history = np.asarray(price_histories[name], dtype=np.float64)
+        stride = (len(history) - 1) // num_iterations if num_iterations else 1
+        prices.append(history[::stride][:num_iterations + 1])
+
+    return {
+        'final_prices': np.array([coin.price for coin in market.coins]),
+        'max_prices': np.array([coin.highest_price for coin in market.coins]),
+        'amount_airdropped': np.array([airdrop_strategy.amount_airdropped
+                                       for airdrop_strategy in market.airdrop_strategies], dtype=np.float64),
+        'price_histories': np.array(prices),
+        'holdings_histories': np.array([[holdings_histories[name][agent_type] for agent_type in market.agent_types]
+                                        for name in coin_names], dtype=np.int64),
+        'net_trade_volume_histories': np.array([net_trade_volume_histories[name] for name in coin_names],
+                                               dtype=np.float64),
+        'trade_volume_histories': np.array([trade_volume_histories[name] for name in coin_names], dtype=np.float64),
+    }
+
+
+class SharedNetwork:
+    """
+    Read only network placed in shared memory as CSR arrays, so workers map it instead of receiving a pickled copy with
+    every task
+    """
+
+    def __init__(self, network):
+        adjacency, self.directed = to_adjacency(network)
+        self.num_nodes = adjacency.shape[0]
+        self.blocks = {}
+        self.specs = {}
+        for name in ('indptr', 'indices'):
+            array = getattr(adjacency, name)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+            self.blocks[name] = block
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def handle(self):
+        """
+        Picklable description that workers pass to attach
+        """
+        return self.specs, self.num_nodes, self.directed
+
+    @staticmethod
+    def attach(handle):
+        """
+        Maps the shared arrays and returns ((adjacency, directed), shared memory blocks). The adjacency matrix is a view
+        of the blocks, which have to be kept alive for as long as it is used
+        """
+        specs, num_nodes, directed = handle
+        blocks = []
+        arrays = {}
+        for name, (block_name, shape, dtype) in specs.items():
+            # Pool workers share the parent's resource tracker, which already knows about the block
+            block = shared_memory.SharedMemory(name=block_name)
+            blocks.append(block)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+        data = np.ones(len(arrays['indices']))
+        adjacency = sparse.csr_array((data, arrays['indices'], arrays['indptr']), shape=(num_nodes, num_nodes))
+        return (adjacency, directed), blocks
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+# State of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(scenario, network_handle, num_iterations, simulate_kwargs):
+    _worker['scenario'] = scenario
+    _worker['num_iterations'] = num_iterations
+    _worker['simulate_kwargs'] = simulate_kwargs
+    _worker['network'] = None
+    if network_handle is not None:
+        _worker['network'], _worker['blocks'] = SharedNetwork.attach(network_handle)
+
+
+def _run_replication(seed):
+    market = _worker['scenario'](seed, _worker['network'])
+    histories = market.simulate(_worker['num_iterations'], **_worker['simulate_kwargs'])
+    summary = summarize_replication(market, histories, _worker['num_iterations'])
+    return summary, [coin.name for coin in market.coins], list(market.agent_types)
+
+
+def run_replications(scenario, num_replications, num_iterations, seed=None, processes=None, network=None,
+                     simulate_kwargs=None, sink=None):
+    """
+    Runs independent replications of a market across a process pool
+    :param scenario - module level function scenario(seed, network) that builds a fresh CryptoMarket. It should draw all
+    of its randomness from a SimulationRNG(seed) shared by the agent structure and the market. network is the shared
+    prebuilt network as an (adjacency, directed) pair (None if none was given) and should be passed on to CryptoMarket
+    :param num_replications
+    :param num_iterations - iterations per replication
+    :param seed - master seed. Each replication gets its own seed spawned from it, so results don't depend on which
+    worker runs which replication
+    :param processes - number of worker processes, defaults to the number of cores. 1 runs everything in this process
+    :param network - optional prebuilt network shared read only with every replication through shared memory
+    :param simulate_kwargs - extra arguments for CryptoMarket.simulate, e.g. {'engine': 'vectorized'}
+    :param sink - optional ResultSink. Each replication is written to it as soon as it finishes instead of being kept
+    in memory
+    :return: BatchResults, or the sink's ResultDataset if a sink was given
+    """
+    simulate_kwargs = simulate_kwargs or {}
+    seeds = [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(num_replications)]
+
+    def collect(outputs):
+        if sink is None:
+            return list(outputs)
+        for replication_seed, (summary, coin_names, agent_types) in zip(seeds, outputs):
+            sink.manifest['metadata'].update({'coin_names': coin_names, 'agent_types': agent_types})
+            sink.append(replication_seed, summary)
+        return sink.close()
+
+    if processes == 1:
+        _init_worker(scenario, None, num_iterations, simulate_kwargs)
+        # Converted once here rather than by every replication's CryptoMarket
+        _worker['network'] = to_adjacency(network) if network is not None else None
+        outputs = collect(_run_replication(replication_seed) for replication_seed in seeds)
+    else:
+        shared_network = SharedNetwork(network) if network is not None else None
+        try:
+            handle = shared_network.handle() if shared_network is not None else None
+            workers = processes or multiprocessing.cpu_count()
+            with multiprocessing.Pool(workers, initializer=_init_worker,
+                                      initargs=(scenario, handle, num_iterations, simulate_kwargs)) as pool:
+                # imap hands results back in order as they finish, so a sink never holds more than a chunk
+                outputs = collect(pool.imap(_run_replication, seeds,
+                                            chunksize=max(1, num_replications // (4 * workers))))
+        finally:
+            if shared_network is not None:
+                shared_network.close()
+
+    if sink is not None:
+        return outputs
+    summaries = [summary for summary, _, _ in outputs]
+    _, coin_names, agent_types = outputs[0]
+    return BatchResults(coin_names, agent_types, seeds, summaries)
@@ -0,0 +1,68 @@
+import networkx as nx
+import numpy as np
+from scipy import sparse
+
+
+def to_adjacency(network, num_nodes=None):
+    """
+    Converts a networkx graph into a CSR adjacency matrix where A[u, v] = 1 if there is an edge u -> v
+    (both directions are set for undirected graphs)
+    :param network
+    :param num_nodes - nodes are expected to be labelled 0..num_nodes-1, defaults to the number of nodes in the graph
+    :return: (adjacency, directed)
+    """
+    if num_nodes is None:
+        num_nodes = network.number_of_nodes()
+    adjacency = nx.to_scipy_sparse_array(network, nodelist=range(num_nodes), weight=None, dtype=np.float64,
+                                         format='csr')
+    return adjacency, network.is_directed()
+
+
+def in_neighbor_matrix(adjacency, directed):
+    """
+    Returns the CSR matrix whose row i holds the neighbors agent i looks at when it acts: its predecessors in a
+    directed network, or all of its neighbors in an undirected one. Multiplying it by a per agent vector gives the
+    neighborhood sum of that vector for every agent at once
+    """
+    if directed:
+        return sparse.csr_array(adjacency.T)
+    return sparse.csr_array(adjacency)
+
+
+def csr_row_sums(indptr, entries):
+    """
+    Sums of entries gathered in the order of a CSR matrix's entries (e.g. vector[matrix.indices]) over every row of
+    the matrix, 0 for empty rows. Only the non-empty rows are passed to np.add.reduceat, which would otherwise give an
+    empty row the entry at its start
+    :param indptr - indptr of the CSR matrix
+    :param entries - one value (or row of values) per entry of the matrix
+    """
+    sums = np.zeros((len(indptr) - 1,) + np.shape(entries)[1:])
+    nonempty = np.flatnonzero(np.diff(indptr))
+    if len(nonempty):
+        sums[nonempty] = np.add.reduceat(entries, indptr[:-1][nonempty])
+    return sums
+
+
+def csr_rows(indptr, indices, rows):
+    """
+    Entries of some rows of a CSR matrix, as the indptr and indices of the matrix made of those rows. Same as
+    matrix[rows] without building a matrix, which is much cheaper for a few rows
+    :param indptr - indptr of the CSR matrix
+    :param indices - indices of the CSR matrix
+    :param rows - array of row numbers
+    :return: (indptr, indices) of the selected rows
+    """
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    row_indptr = np.zeros(len(rows) + 1, dtype=indptr.dtype)
+    np.cumsum(counts, out=row_indptr[1:])
+    positions = np.arange(row_indptr[-1]) + np.repeat(starts - row_indptr[:-1], counts)
+    return row_indptr, indices[positions]
+
+
+def to_networkx(adjacency, directed):
+    """
+    networkx view of a CSR adjacency matrix, with nodes 0..n-1
+    """
+    return nx.from_scipy_sparse_array(adjacency, create_using=nx.DiGraph if directed else nx.Graph)
@@ -0,0 +1,399 @@
+"""
+Resumable parameter sweeps over markets, agent mixes and airdrop strategies
+
+    python Sweep.py sweep.json sweeps/leader    # runs the sweep, or resumes it if it was interrupted
+
+with a spec like
+    {"design": "latin_hypercube", "samples": 200, "replications": 5, "num_iterations": 20, "seed": 0,
+     "simulate": {"engine": "vectorized", "sub_steps": 4},
+     "space": {"network_type": ["scale_free", "small_world"], "num_rational": {"integer": [10, 200]},
+               "airdrop": "ProportionalLeaderAirdropStrategy", "airdrop.time": {"uniform": [0, 0.5]},
+               "airdrop.percentage": {"log_uniform": [0.01, 0.5]}, "airdrop.threshold": 0.4}}
+
+A space maps parameter names to a fixed value, a list of choices or a Range. grid crosses every list, random and
+latin_hypercube draw samples points (lists are then sampled uniformly). The designs are expanded into tasks, one per
+point and replication, and duplicate tasks are dropped, so overlapping designs can simply be concatenated.
+
+Parameters of the default scenario sweep_market (see DEFAULT_PARAMS):
+- network_type, network_seed and network.<name> for the generator parameters of NETWORK_PARAMS
+- num_rational and num_behav as in main.py, behavioral_agent the class of the num_behav agents, and agents.<Class> for
+  any other agent class
+- airdrop the strategy class, airdrop.<name> its constructor arguments (coin arguments take coin names)
+
+Every finished task is appended to tasks.jsonl in the sweep's directory, a run skips the tasks already listed there
+"""
+import argparse
+import hashlib
+import inspect
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy as np
+
+from Market import *
+from AgentStructure import AgentStructure
+from NetworkCache import NetworkCache
+from RandomStreams import SimulationRNG
+from Runner import summarize_replication
+
+MANIFEST = 'tasks.jsonl'
+CONFIG = 'sweep.json'
+
+AGENT_CLASSES = {agent_class.__name__: agent_class for agent_class in
+                 (RationalAgent, LinearHerdingAgent, BudgetProportionHerdingAgent, NeighborhoodProbabilisticInvestor)}
+
+AIRDROP_CLASSES = {airdrop_class.__name__: airdrop_class for airdrop_class in
+                   (RandomAirdropStrategy, MoreToLeaders, ProportionalLeaderAirdropStrategy,
+                    RandomProportionalAirdropStrategy, LeaderAirdropStrategy, CELFAirdropStrategy, IMMAirdropStrategy,
+                    BiggestHoldersAirdropStrategy, ProportionalBiggestHoldersAirdropStrategy)}
+
+# The market of main.py. The airdrop.* defaults only apply when a task doesn't set airdrop itself
+DEFAULT_PARAMS = {
+    'network_type': 'scale_free',
+    'network_seed': None,
+    'num_rational': 90,
+    'num_behav': 210,
+    'behavioral_agent': 'NeighborhoodProbabilisticInvestor',
+    'airdrop': 'ProportionalLeaderAirdropStrategy',
+    'airdrop.coin': 'DogWifHat',
+    'airdrop.time': 0.1,
+    'airdrop.percentage': 0.3,
+    'airdrop.threshold': 0.4,
+}
+
+
+def sweep_market(seed, params, network_cache=None):
+    """
+    Default scenario of a sweep: Bitcoin and DogWifHat, the population, network and airdrop described by params
+    :param seed - seed of the task
+    :param params - the task's parameters, on top of DEFAULT_PARAMS
+    :param network_cache - optional NetworkCache shared by the tasks
+    """
+    if 'airdrop' in params:
+        defaults = {name: value for name, value in DEFAULT_PARAMS.items() if not name.startswith('airdrop')}
+        params = {**defaults, 'airdrop.coin': DEFAULT_PARAMS['airdrop.coin'], **params}
+    else:
+        params = {**DEFAULT_PARAMS, **params}
+    rng = SimulationRNG(seed)
+    coins = {'Bitcoin': Cryptocurrency('Bitcoin', 1.00, ismeme=False),
+             'DogWifHat': Cryptocurrency('DogWifHat', .25, ismeme=True)}
+
+    counts = {'RationalAgent': params['num_rational'], params['behavioral_agent']: params['num_behav']}
+    for name, value in params.items():
+        if name.startswith('agents.'):
+            counts[name[len('agents.'):]] = counts.get(name[len('agents.'):], 0) + value
+    agent_structure = AgentStructure(int(sum(counts.values())), rng=rng)
+    for name, count in counts.items():
+        if name not in AGENT_CLASSES:
+            raise ValueError(f"Unknown agent class {name}")
+        if count:
+            agent_structure.add_agents(AGENT_CLASSES[name], int(count))
+
+    airdrop_strategies = []
+    if params['airdrop'] is not None:
+        if params['airdrop'] not in AIRDROP_CLASSES:
+            raise ValueError(f"Unknown airdrop strategy {params['airdrop']}")
+        kwargs = {name[len('airdrop.'):]: value for name, value in params.items() if name.startswith('airdrop.')}
+        for name in ('coin', 'existing_coin'):
+            if name in kwargs:
+                kwargs[name] = coins[kwargs[name]]
+        # Tasks already run one per core, strategies that can start worker processes of their own (CELF) run serially
+        if 'processes' in inspect.signature(AIRDROP_CLASSES[params['airdrop']]).parameters:
+            kwargs.setdefault('processes', 1)
+        airdrop_strategies.append(AIRDROP_CLASSES[params['airdrop']](**kwargs))
+
+    network_params = {name[len('network.'):]: value for name, value in params.items() if name.startswith('network.')}
+    market = CryptoMarket(params['network_type'], list(coins.values()), airdrop_strategies, agent_structure, rng=rng,
+                          network_params=network_params, network_seed=params['network_seed'],
+                          network_cache=network_cache)
+    agent_structure.budgets_based_on_popularity(market)
+    return market
+
+
+class Range:
+    """
+    Continuous or integer interval of a sweep space, sampled by the random and latin_hypercube designs
+    :param low
+    :param high - inclusive for integers
+    :param log - sample uniformly in log space
+    :param integer
+    """
+
+    def __init__(self, low, high, log=False, integer=False):
+        if high < low or (log and low <= 0):
+            raise ValueError(f"Bad range [{low}, {high}]")
+        self.low = low
+        self.high = high
+        self.log = log
+        self.integer = integer
+
+    def value(self, u):
+        """
+        :param u - position in the interval, in [0, 1)
+        """
+        if self.integer:
+            low, high = (np.log(self.low), np.log(self.high + 1)) if self.log else (self.low, self.high + 1)
+            value = np.exp(low + u * (high - low)) if self.log else low + u * (high - low)
+            return int(min(np.floor(value), self.high))
+        if self.log:
+            return float(np.exp(np.log(self.low) + u * (np.log(self.high) - np.log(self.low))))
+        return float(self.low + u * (self.high - self.low))
+
+
+def parse_space(spec):
+    """
+    Space from its JSON form, where {"uniform": [low, high]}, {"log_uniform": [low, high]}, {"integer": [low, high]} and
+    {"log_integer": [low, high]} are Ranges, lists are choices and anything else is fixed
+    """
+    kinds = {'uniform': {}, 'log_uniform': {'log': True}, 'integer': {'integer': True},
+             'log_integer': {'log': True, 'integer': True}}
+    space = {}
+    for name, value in spec.items():
+        if isinstance(value, dict) and len(value) == 1 and next(iter(value)) in kinds:
+            kind, (low, high) = next(iter(value.items()))
+            value = Range(low, high, **kinds[kind])
+        space[name] = value
+    return space
+
+
+def _plain(value):
+    # numpy scalars out of the designs, so points serialize and hash the same as hand written ones
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def grid(space):
+    """
+    Every combination of the space's choices
+    :return: list of parameter dicts
+    """
+    if any(isinstance(value, Range) for value in space.values()):
+        raise ValueError("A grid needs lists of values, not ranges")
+    names = list(space)
+    choices = [space[name] if isinstance(space[name], list) else [space[name]] for name in names]
+    return [{name: _plain(value) for name, value in zip(names, combination)}
+            for combination in itertools.product(*choices)]
+
+
+def _points(space, unit):
+    points = []
+    for row in unit:
+        point = {}
+        for name, u in zip(space, row):
+            value = space[name]
+            if isinstance(value, Range):
+                value = value.value(u)
+            elif isinstance(value, list):
+                value = value[min(int(u * len(value)), len(value) - 1)]
+            point[name] = _plain(value)
+        points.append(point)
+    return points
+
+
+def random_design(space, num_samples, seed=0):
+    """
+    num_samples independent uniform points of the space
+    """
+    return _points(space, np.random.default_rng(seed).random((num_samples, len(space))))
+
+
+def latin_hypercube(space, num_samples, seed=0):
+    """
+    num_samples points such that every parameter has exactly one sample in each of num_samples equal strata of its
+    range, which covers each parameter far more evenly than random_design for the same budget
+    """
+    rng = np.random.default_rng(seed)
+    strata = np.argsort(rng.random((num_samples, len(space))), axis=0)
+    return _points(space, (strata + rng.random((num_samples, len(space)))) / num_samples)
+
+
+DESIGNS = {'grid': grid, 'random': random_design, 'latin_hypercube': latin_hypercube}
+
+
+def task_id(params, replicate, seed):
+    description = json.dumps([params, replicate, seed], sort_keys=True, default=str)
+    return hashlib.sha256(description.encode()).hexdigest()[:20]
+
+
+def expand(points, replications=1, seed=0):
+    """
+    Tasks of a list of points, one per point and replication, without duplicates
+
+    A task's id and seed only depend on the master seed, its parameters and its replicate number, so the same task gets
+    the same seed whichever design or sweep it comes from, and a different master seed gives different tasks
+    :return: list of dicts with id, params, replicate, seed and the master seed as sweep_seed
+    """
+    tasks = {}
+    for params in points:
+        params = {name: _plain(value) for name, value in params.items()}
+        for replicate in range(replications):
+            identifier = task_id(params, replicate, seed)
+            if identifier not in tasks:
+                entropy = [seed, int(identifier, 16)]
+                tasks[identifier] = {'id': identifier, 'params': params, 'replicate': replicate,
+                                     'seed': int(np.random.SeedSequence(entropy).generate_state(1)[0]),
+                                     'sweep_seed': seed}
+    return list(tasks.values())
+
+
+def read_manifest(directory):
+    """
+    Records of the tasks run so far, the latest one of every task. A record cut short by a crash is ignored
+    :return: dict of task id -> record
+    """
+    records = {}
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record['id']] = record
+    return records
+
+
+# State of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(scenario, num_iterations, simulate_kwargs, network_cache, keep_histories):
+    _worker['scenario'] = scenario
+    _worker['num_iterations'] = num_iterations
+    _worker['simulate_kwargs'] = simulate_kwargs
+    _worker['network_cache'] = NetworkCache(network_cache) if network_cache is not None else None
+    _worker['keep_histories'] = keep_histories
+
+
+def _run_task(task):
+    start = time.perf_counter()
+    record = {'id': task['id'], 'params': task['params'], 'replicate': task['replicate'], 'seed': task['seed']}
+    try:
+        market = _worker['scenario'](task['seed'], task['params'], _worker['network_cache'])
+        num_iterations = _worker['num_iterations']
+        histories = market.simulate(num_iterations, **_worker['simulate_kwargs'])
+        summary = summarize_replication(market, histories, num_iterations)
+        coin_names = [coin.name for coin in market.coins]
+        record.update({
+            'status': 'ok',
+            'final_prices': dict(zip(coin_names, summary['final_prices'].tolist())),
+            'max_prices': dict(zip(coin_names, summary['max_prices'].tolist())),
+            'amount_airdropped': summary['amount_airdropped'].tolist(),
+        })
+        if _worker['keep_histories']:
+            record['price_histories'] = dict(zip(coin_names, summary['price_histories'].tolist()))
+    except Exception:
+        record.update({'status': 'error', 'error': traceback.format_exc()})
+    record['seconds'] = time.perf_counter() - start
+    return record
+
+
+def run_sweep(tasks, num_iterations, directory, scenario=sweep_market, processes=None, simulate_kwargs=None,
+              network_cache=None, keep_histories=False, retry_errors=True):
+    """
+    Runs the tasks of a sweep across a process pool, skipping the ones already finished in directory
+
+    Each finished task is appended to the manifest as one line as soon as it comes back, so an interrupted sweep loses
+    at most the tasks that were running. The sweep's master seed, num_iterations and simulate_kwargs are stored next to
+    it, and resuming with different ones is an error since the results wouldn't be comparable
+    :param tasks - see expand, all expanded with the same master seed
+    :param num_iterations
+    :param directory
+    :param scenario - module level function scenario(seed, params, network_cache) that builds a fresh CryptoMarket
+    :param processes - number of worker processes, defaults to the number of cores. 1 runs everything in this process
+    :param simulate_kwargs - extra arguments for CryptoMarket.simulate, e.g. {'engine': 'vectorized'}
+    :param network_cache - optional directory of a NetworkCache, so tasks with the same network share it
+    :param keep_histories - also record the price at the end of every step
+    :param retry_errors - rerun tasks whose last attempt failed
+    :return: dict of task id -> record of every task of the sweep that has a record
+    """
+    simulate_kwargs = simulate_kwargs or {}
+    os.makedirs(directory, exist_ok=True)
+    sweep_seeds = {task.get('sweep_seed') for task in tasks}
+    if len(sweep_seeds) > 1:
+        raise ValueError(f"The tasks were expanded with different master seeds {sweep_seeds}, run them as separate "
+                         f"sweeps")
+    config = {'seed': sweep_seeds.pop() if sweep_seeds else None, 'num_iterations': num_iterations,
+              'simulate_kwargs': simulate_kwargs}
+    config_path = os.path.join(directory, CONFIG)
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            stored = json.load(f)
+        if stored != json.loads(json.dumps(config)):
+            raise ValueError(f"{directory} holds a sweep run with {stored}, not {config}")
+    else:
+        with open(config_path, 'w') as f:
+            json.dump(config, f, indent=1)
+
+    records = read_manifest(directory)
+    finished = {identifier for identifier, record in records.items()
+                if record['status'] == 'ok' or not retry_errors}
+    pending = [task for task in tasks if task['id'] not in finished]
+    print(f"Sweep {directory}: {len(tasks) - len(pending)} of {len(tasks)} tasks already done")
+
+    initargs = (scenario, num_iterations, simulate_kwargs, network_cache, keep_histories)
+    with open(os.path.join(directory, MANIFEST), 'a') as manifest:
+        def write(record):
+            manifest.write(json.dumps(record) + '\n')
+            manifest.flush()
+            records[record['id']] = record
+
+        if processes == 1 or len(pending) <= 1:
+            _init_worker(*initargs)
+            for task in pending:
+                write(_run_task(task))
+        else:
+            workers = processes or multiprocessing.cpu_count()
+            with multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+                chunksize = max(1, min(16, len(pending) // (8 * workers)))
+                for record in pool.imap_unordered(_run_task, pending, chunksize=chunksize):
+                    write(record)
+
+    failed = sum(records[task['id']]['status'] != 'ok' for task in tasks if task['id'] in records)
+    if failed:
+        print(f"Sweep {directory}: {failed} tasks failed, see their error in {MANIFEST}")
+    return {task['id']: records[task['id']] for task in tasks if task['id'] in records}
+
+
+def tasks_from_spec(spec):
+    """
+    Tasks of a JSON sweep spec (see the module docstring)
+    """
+    space = parse_space(spec['space'])
+    design = spec.get('design', 'grid')
+    if design not in DESIGNS:
+        raise ValueError(f"Unknown design {design}, expected one of {list(DESIGNS)}")
+    if design == 'grid':
+        points = grid(space)
+    else:
+        points = DESIGNS[design](space, spec['samples'], spec.get('seed', 0))
+    return expand(points, spec.get('replications', 1), spec.get('seed', 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('spec', help="JSON sweep spec")
+    parser.add_argument('directory', help="where the manifest goes, rerun with the same one to resume")
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--network-cache', default=None, help="directory of a network cache shared by the tasks")
+    parser.add_argument('--keep-histories', action='store_true')
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    tasks = tasks_from_spec(spec)
+    records = run_sweep(tasks, spec.get('num_iterations', 20), args.directory, processes=args.processes,
+                        simulate_kwargs=spec.get('simulate'), network_cache=args.network_cache,
+                        keep_histories=args.keep_histories)
+    done = sum(record['status'] == 'ok' for record in records.values())
+    print(f"{done} of {len(tasks)} tasks done")
+    return 0 if done == len(tasks) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
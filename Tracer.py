@@ -0,0 +1,166 @@
+import json
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+from time import perf_counter
+
+_NO_PHASE = nullcontext()
+
+
+def no_phase(name, **args):
+    """
+    Stand-in for SimulationTracer.phase when a run isn't traced
+    """
+    return _NO_PHASE
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.start, perf_counter(), self.args)
+
+
+class SimulationTracer:
+    """
+    Opt-in instrumentation of CryptoMarket.simulate, pass one as simulate(..., tracer=tracer)
+
+    - phases (airdrops, shuffling, the agents' turns, decide/clear/commit of the vectorized engine, recording) are timed
+      as spans, each of which becomes a complete event of the Chrome trace
+    - with time_acts, every agent.act of the sequential engine is timed and summed by agent type, together with the
+      clearing of its trades
+    - with count_calls, the hot calls in HOT_CALLS are counted while the simulation runs, by wrapping the methods on
+      their classes for the duration of the run
+
+    Untraced runs pay one None check per action. summary() returns the totals, write_summary and write_trace export them
+    as JSON and as a Chrome trace event file (open in chrome://tracing or Perfetto)
+
+    :param time_acts
+    :param count_calls
+    """
+
+    # (module, class, method) of the calls counted with count_calls: the portfolio views and neighborhood aggregates the
+    # agents read in act, and the clearing and recording of every trade. Methods are wrapped on the class that defines
+    # them, e.g. _RowView.__contains__ counts membership tests of all three views
+    HOT_CALLS = (
+        ('Portfolio', 'HoldingsView', 'get'),
+        ('Portfolio', 'HoldingsView', '__setitem__'),
+        ('Portfolio', 'AverageBuyPriceView', 'get'),
+        ('Portfolio', 'AverageBuyPriceView', '__setitem__'),
+        ('Portfolio', '_RowView', '__contains__'),
+        ('NeighborhoodAggregates', 'NeighborhoodAggregates', 'num_neighbors'),
+        ('NeighborhoodAggregates', 'NeighborhoodAggregates', 'holding_proportion'),
+        ('NeighborhoodAggregates', 'NeighborhoodAggregates', 'coin_value'),
+        ('NeighborhoodAggregates', 'NeighborhoodAggregates', 'cash'),
+        ('NeighborhoodAggregates', 'NeighborhoodAggregates', 'portfolio_value'),
+        ('Clearing', 'PerTradeClearing', 'clear_trade'),
+        ('Clearing', 'PerTradeClearing', 'clear'),
+        ('Clearing', 'ConstantProductAMM', 'clear_trade'),
+        ('Clearing', 'ConstantProductAMM', 'clear'),
+        ('Market', 'CryptoMarket', 'record_trade'),
+        ('Recorder', 'HistoryRecorder', 'record_price'),
+    )
+
+    def __init__(self, time_acts=True, count_calls=True):
+        self.time_acts = time_acts
+        self.count_calls = count_calls
+        self.origin = perf_counter()
+        self.events = []
+        self.phases = defaultdict(lambda: [0.0, 0])
+        self.timers = defaultdict(lambda: [0.0, 0])
+        self.calls = Counter()
+        self._patched = []
+
+    def phase(self, name, **args):
+        """
+        Context manager timing one phase, args end up in the trace event
+        """
+        return _Span(self, name, args)
+
+    def record(self, name, start, end, args=None):
+        totals = self.phases[name]
+        totals[0] += end - start
+        totals[1] += 1
+        self.events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': 0, 'ts': (start - self.origin) * 1e6,
+                            'dur': (end - start) * 1e6, 'args': args or {}})
+
+    def add(self, name, seconds):
+        """
+        Adds to an aggregate timer, for spans too short and too many to keep as events
+        """
+        totals = self.timers[name]
+        totals[0] += seconds
+        totals[1] += 1
+
+    def counter(self, name, values):
+        """
+        Counter event of the trace, e.g. the act time by agent type at the end of a step
+        """
+        self.events.append({'name': name, 'ph': 'C', 'pid': 0, 'ts': (perf_counter() - self.origin) * 1e6,
+                            'args': values})
+
+    def end_step(self, t):
+        acts = {name[4:]: totals[0] for name, totals in self.timers.items() if name.startswith('act:')}
+        if acts:
+            self.counter('act seconds', acts)
+        if self.calls:
+            self.counter('calls', dict(self.calls))
+
+    def start(self):
+        """
+        Wraps the hot calls in counters, called by simulate before the first step
+        """
+        if not self.count_calls or self._patched:
+            return
+        import importlib
+        calls = self.calls
+        for module_name, class_name, method_name in self.HOT_CALLS:
+            owner = getattr(importlib.import_module(module_name), class_name)
+            original = vars(owner).get(method_name)
+            function = getattr(owner, method_name)
+            key = f"{class_name}.{method_name}"
+
+            def counted(*args, _function=function, _key=key, **kwargs):
+                calls[_key] += 1
+                return _function(*args, **kwargs)
+
+            setattr(owner, method_name, counted)
+            self._patched.append((owner, method_name, original))
+
+    def stop(self):
+        """
+        Restores the wrapped calls, called by simulate when the run ends
+        """
+        for owner, method_name, original in reversed(self._patched):
+            if original is None:
+                delattr(owner, method_name)
+            else:
+                setattr(owner, method_name, original)
+        self._patched = []
+
+    def summary(self):
+        """
+        :return: dict with the total seconds and count of every phase and timer, and the count of every hot call
+        """
+        return {
+            'wall_seconds': perf_counter() - self.origin,
+            'phases': {name: {'seconds': seconds, 'count': count} for name, (seconds, count) in self.phases.items()},
+            'timers': {name: {'seconds': seconds, 'count': count} for name, (seconds, count) in self.timers.items()},
+            'calls': dict(self.calls),
+        }
+
+    def write_summary(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.summary(), file, indent=2)
+
+    def write_trace(self, path):
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, file)
@@ -0,0 +1,357 @@
+import numpy as np
+
+from Agent import RationalAgent, LinearHerdingAgent, BudgetProportionHerdingAgent, NeighborhoodProbabilisticInvestor
+from Clearing import PerTradeClearing
+from Portfolio import PortfolioValuation
+from Recorder import HistoryRecorder
+from SparseNetwork import csr_row_sums, csr_rows
+from Tracer import no_phase
+
+
+class VectorizedEngine:
+    """
+    Array based engine for CryptoMarket.simulate
+
+    Holdings, budgets and agent parameters are kept in NumPy arrays and every agent's neighborhood signal is computed
+    at once with a CSR adjacency mat-vec. The buy, profit-take, sentiment-sell and stop-loss rules of the supported
+    agent types are then applied as masked array operations.
+
+    Unlike the sequential engine, updates are synchronous: for every coin, the agents are split at random into sub_steps
+    groups, every agent in a group decides from the same state and sees the same price, and the price impact of all of the
+    group's trades is cleared (see Clearing) before the next group acts. sub_steps=1 updates the whole market at once, while
+    sub_steps=num_agents approaches the shuffled sequential order. The agents of a group can't react to each other's price
+    impact, so the clearing engine damps the impact of big groups (see PerTradeClearing): prices stay bounded for any
+    sub_steps, and more sub steps bring the price paths closer to the sequential engine's.
+
+    Each group's orders are cleared as one batch by the clearing engine, PerTradeClearing by default, and settle at the
+    execution price it returns.
+
+    Supported agents: RationalAgent, LinearHerdingAgent, BudgetProportionHerdingAgent, NeighborhoodProbabilisticInvestor
+
+    :param market
+    :param sub_steps
+    :param clearing
+    :param tracer - optional SimulationTracer timing the decide, clear and commit phases of every sub step
+    """
+
+    def __init__(self, market, sub_steps=1, clearing=None, tracer=None):
+        self.market = market
+        self.sub_steps = sub_steps
+        self.clearing = clearing if clearing is not None else PerTradeClearing()
+        self.tracer = tracer
+        self.phase = tracer.phase if tracer is not None else no_phase
+        self.rng = market.rng.generator
+        self.coins = market.coins
+        self.num_agents = market.num_agents
+        self.coin_index = market.coin_registry.index
+
+        self.neighbors = market.aggregates.neighbors
+        self.in_degree = market.aggregates.in_degree
+
+        self.agent_table = market.agent_structure.agent_table
+        self.type_names = np.array([agent.get_type() for agent in self.agent_table])
+        self.is_rational = self._mask(RationalAgent)
+        self.is_linear = self._mask(LinearHerdingAgent)
+        self.is_budget = self._mask(BudgetProportionHerdingAgent)
+        self.is_probabilistic = self._mask(NeighborhoodProbabilisticInvestor)
+        unsupported = ~(self.is_rational | self.is_linear | self.is_budget | self.is_probabilistic)
+        if unsupported.any():
+            raise ValueError(f"The vectorized engine does not support {set(self.type_names[unsupported])}")
+
+        # Agent parameters, NaN for agents of types that don't have them
+        self.threshold = self._param('threshold')
+        self.buy_threshold = self._param('buy_threshold')
+        self.price_sensitivity = self._param('price_sensitivity')
+        self.loss_sensitivity = self._param('loss_sensitivity')
+        self.negative_sentiment_threshold = self._param('negative_sentiment_threshold')
+        self.initial_buy_proportion = self._param('initial_buy_proportion')
+        self.max_multiple = self._param('max_multiple')
+        self.sell_scaling_factor = self._param('sell_scaling_factor')
+        self.value_bias = self._param('value_bias')
+        self.fair_value_growth_rate = np.array([
+            agent.fair_value_growth_rate if getattr(agent, 'fair_value_growth_enabled', False) else 0.0
+            for agent in self.agent_table])
+
+        self.load_state()
+
+    def _mask(self, agent_class):
+        return np.array([isinstance(agent, agent_class) for agent in self.agent_table])
+
+    def _param(self, name):
+        return np.array([getattr(agent, name, np.nan) for agent in self.agent_table], dtype=np.float64)
+
+    def load_state(self):
+        """
+        Copies the agent state that isn't already array backed (budgets and fair values) from the agent objects into
+        arrays. Holdings, bought flags and buy prices are the market's PortfolioState arrays, shared with the agents
+        """
+        portfolios = self.market.portfolios
+        self.holdings = portfolios.holdings
+        self.bought = portfolios.bought
+        self.average_buy_prices = portfolios.average_buy_prices
+        self.fair_values = np.full(self.holdings.shape, np.nan)
+        self.budgets = np.array([agent.budget for agent in self.agent_table], dtype=np.float64)
+        self.valuation = PortfolioValuation(self.holdings, self.budgets, self.market.coin_registry.prices())
+
+        for agent in self.agent_table:
+            for coin_name, value in getattr(agent, 'fair_values', {}).items():
+                if coin_name in self.coin_index:
+                    self.fair_values[agent.id, self.coin_index[coin_name]] = value
+
+    def store_state(self):
+        """
+        Writes budgets and fair values back into the agent objects so the market can be inspected (or airdropped into)
+        as usual
+        """
+        for agent in self.agent_table:
+            if hasattr(agent, 'fair_values'):
+                for coin in self.coins:
+                    c = self.coin_index[coin.name]
+                    if not np.isnan(self.fair_values[agent.id, c]):
+                        agent.fair_values[coin.name] = float(self.fair_values[agent.id, c])
+            agent.budget = float(self.budgets[agent.id])
+
+    def neighborhood_signals(self, c, price, rows=slice(None)):
+        """
+        The whole market's signals are mat-vecs, while those of a sub step's rows only read the state of their
+        neighbors, so a sub step costs the size of its neighborhoods rather than the whole market. Portfolio values come
+        from the valuation refreshed at the start of the coin pass
+        :return: (holders, coin value, budget, portfolio value) summed over the neighborhood of every agent in rows
+        """
+        prices = self.market.coin_registry.prices()
+        if isinstance(rows, slice):
+            neighbors = self.neighbors
+            return (neighbors @ (self.holdings[:, c] > 0).astype(np.float64), (neighbors @ self.holdings[:, c]) * price,
+                    neighbors @ self.budgets, neighbors @ self.valuation.values_of(rows, prices))
+        indptr, watched = csr_rows(self.neighbors.indptr, self.neighbors.indices, rows)
+        budgets = self.budgets[watched]
+        values = self.holdings[watched, c]
+        portfolio_values = self.valuation.values_of(watched, prices)
+        return (csr_row_sums(indptr, (values > 0).astype(np.float64)), csr_row_sums(indptr, values) * price,
+                csr_row_sums(indptr, budgets), csr_row_sums(indptr, portfolio_values))
+
+    def decide(self, coin, rows=slice(None)):
+        """
+        Applies every agent's trading rules for one coin against the current state, without modifying it
+        :param coin
+        :param rows - the agents to decide for, all of them by default
+        :return: (delta, bought, average_buy_prices) - the change in holdings of each agent and its new bought flag and
+        average buy price for the coin
+        """
+        c = self.coin_index[coin.name]
+        price = coin.price
+        holdings = self.holdings[rows, c].copy()
+        budgets = self.budgets[rows]
+        bought = self.bought[rows, c].copy()
+        avg = self.average_buy_prices[rows, c].copy()
+        n = holdings.shape[0]
+        uniforms = self.rng.random((4, n))
+
+        degree = self.in_degree[rows]
+        has_neighbors = degree > 0
+        safe_degree = np.maximum(degree, 1)
+
+        # Neighborhood signals for every agent at once
+        neighbor_holders, neighbor_coin_value, neighbor_budget, neighbor_portfolio_value = \
+            self.neighborhood_signals(c, price, rows)
+        holding_proportion = neighbor_holders / safe_degree
+        budget_proportion = np.divide(neighbor_coin_value, neighbor_budget, out=np.zeros(n),
+                                      where=neighbor_budget > 0)
+        portfolio_proportion = np.divide(neighbor_coin_value, neighbor_portfolio_value, out=np.zeros(n),
+                                         where=neighbor_portfolio_value > 0)
+
+        is_linear = self.is_linear[rows] & has_neighbors
+        is_budget = self.is_budget[rows] & has_neighbors
+        is_probabilistic = self.is_probabilistic[rows] & has_neighbors
+        is_rational = self.is_rational[rows]
+
+        # First purchase for the herding agents
+        first_buy = ~bought & (
+                (is_linear & (holding_proportion >= self.threshold[rows])) |
+                (is_budget & (budget_proportion >= self.buy_threshold[rows])) |
+                (is_probabilistic & (uniforms[0] < portfolio_proportion)))
+        buy_amount = np.floor((budgets // price) * self.initial_buy_proportion[rows])
+        holdings = np.where(first_buy, holdings + buy_amount, holdings)
+        bought |= first_buy
+        avg = np.where(first_buy, price, avg)
+
+        sell_all = np.zeros(n, dtype=bool)
+        forget_price = np.zeros(n, dtype=bool)
+
+        def sell(mask, forget):
+            nonlocal holdings
+            sell_all[mask] = True
+            forget_price[mask & forget] = True
+            holdings = np.where(mask, 0.0, holdings)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            profit_ratio = price / avg
+            profit_probability = 1 - np.exp(-self.price_sensitivity[rows] * (profit_ratio - 1))
+            loss_probability = 1 - np.exp(-self.loss_sensitivity[rows] * (avg / price - 1))
+
+        # Linear and budget proportion herders: take profit, otherwise sell on negative sentiment
+        herding = is_linear | is_budget
+        can_take_profit = herding & (holdings > 0) & ~np.isnan(avg)
+        take_profit = can_take_profit & ((profit_ratio >= self.max_multiple[rows]) |
+                                         (uniforms[1] < profit_probability))
+        sell(take_profit, False)
+        negative_sentiment = 1 - holding_proportion
+        sentiment_candidates = (is_linear & (holdings > 0)) | (is_budget & (holdings > 0) & ~can_take_profit)
+        sell(sentiment_candidates & (negative_sentiment > self.negative_sentiment_threshold[rows]), True)
+
+        # Probabilistic investors: sentiment sell, then take profit, then cut losses
+        sentiment_sell = is_probabilistic & (holdings > 0) & (
+                uniforms[1] < (1 - portfolio_proportion) * self.sell_scaling_factor[rows])
+        sell(sentiment_sell, True)
+        open_position = is_probabilistic & (holdings > 0) & ~np.isnan(avg)
+        max_multiple_hit = open_position & (profit_ratio >= self.max_multiple[rows])
+        sell(max_multiple_hit, False)
+        profit_sell = open_position & ~max_multiple_hit & (uniforms[2] < profit_probability)
+        sell(profit_sell, True)
+        loss_sell = open_position & ~max_multiple_hit & ~profit_sell & (uniforms[3] < loss_probability)
+        sell(loss_sell, True)
+
+        # Rational agents trade around their fair value and dump meme coins
+        if is_rational.any():
+            fair_values = self.fair_values[rows, c]
+            unset = is_rational & np.isnan(fair_values)
+            if unset.any():
+                fair_values[unset] = self.rng.normal(coin.initial_price,
+                                                      self.value_bias[rows][unset] * coin.initial_price)
+            fair_values = np.where(is_rational, fair_values * (1 + self.fair_value_growth_rate[rows]), fair_values)
+            self.fair_values[rows, c] = fair_values
+
+            if coin.is_meme:
+                sell(is_rational & (holdings > 0), False)
+            else:
+                max_affordable = budgets // price
+                max_buy = np.floor(np.maximum(max_affordable, 1) * 0.2)
+                rational_buy = is_rational & (price < fair_values)
+                rational_buy_amount = np.where(max_buy >= 1, 1 + np.floor(uniforms[0] * max_buy), 0)
+                rational_buy_amount = np.where(rational_buy_amount * price <= budgets, rational_buy_amount, 0)
+                holdings = np.where(rational_buy, holdings + rational_buy_amount, holdings)
+                bought |= rational_buy
+
+                rational_sell = is_rational & (price > fair_values) & (holdings > 0)
+                max_sell = np.floor(holdings)
+                rational_sell_amount = np.where(max_sell >= 1, 1 + np.floor(uniforms[1] * max_sell), 0)
+                holdings = np.where(rational_sell, holdings - rational_sell_amount, holdings)
+
+        bought &= ~sell_all
+        avg = np.where(forget_price, np.nan, avg)
+        delta = holdings - self.holdings[rows, c]
+        return delta, bought, avg
+
+    def commit(self, coin, delta, bought, avg, price, rows=slice(None)):
+        """
+        Applies the decisions returned by decide, settling every trade at the execution price. Buyers that can't afford
+        their whole order at that price get what their budget covers
+        :return: the change in holdings that was executed
+        """
+        c = self.coin_index[coin.name]
+        budgets = self.budgets[rows]
+        delta = np.where(delta > 0, np.minimum(delta, budgets // price), delta)
+        # Buyers left with nothing keep their previous state
+        unfilled = bought & ~self.bought[rows, c] & (delta <= 0)
+        bought = np.where(unfilled, False, bought)
+        avg = np.where(unfilled, self.average_buy_prices[rows, c], avg)
+        # First purchases remember the price they were made at
+        avg = np.where(bought & ~self.bought[rows, c] & ~np.isnan(avg), price, avg)
+
+        self.holdings[rows, c] += delta
+        self.budgets[rows] = budgets - delta * price
+        self.bought[rows, c] = bought
+        self.average_buy_prices[rows, c] = avg
+        self.valuation.revalue(rows)
+        return delta
+
+    def step(self, coin):
+        """
+        Lets every agent act once on the coin
+        :return: the change in holdings of every agent, and the price after each sub step
+        """
+        if self.sub_steps == 1:
+            groups = [slice(None)]
+        else:
+            groups = np.array_split(self.rng.permutation(self.num_agents), self.sub_steps)
+
+        # Only this coin's price moves during the pass, the valuation corrects for it
+        self.valuation.refresh(self.market.coin_registry.prices())
+        total_delta = np.zeros(self.num_agents)
+        prices = []
+        phase = self.phase
+        for rows in groups:
+            with phase('decide', coin=coin.name):
+                delta, bought, avg = self.decide(coin, rows)
+            with phase('clear', coin=coin.name):
+                price = self.clearing.clear(coin, delta)
+            with phase('commit', coin=coin.name):
+                total_delta[rows] = self.commit(coin, delta, bought, avg, price, rows)
+            # Keeps the price floor and the highest price up even when the group didn't trade
+            self.clearing.set_price(coin, coin.price)
+            prices.append(coin.price)
+        return total_delta, prices
+
+    def simulate(self, num_iterations, resolution="action", decimation=1, checkpoints=None, start=None,
+                 stop_after=None):
+        """
+        Runs the simulation with synchronous updates and returns the same histories as CryptoMarket.simulate, except that
+        an action is a whole sub step, so resolution="action" records the price once per sub step
+        :param num_iterations
+        :param resolution
+        :param decimation
+        :param checkpoints - optional Checkpoints, see CryptoMarket.simulate
+        :param start - position of an interrupted run to continue from, see CryptoMarket.simulate
+        :param stop_after - step to pause the run after, see CryptoMarket.simulate
+        """
+        market = self.market
+        recorder = HistoryRecorder(market, num_iterations, self.sub_steps, resolution, decimation)
+        if start is not None:
+            recorder.restore(start['recorder'])
+        run = {'num_iterations': num_iterations, 'engine': 'vectorized', 'sub_steps': self.sub_steps,
+               'resolution': resolution, 'decimation': decimation, 'clearing': self.clearing}
+        tracer = self.tracer
+        phase = self.phase
+        if tracer is not None:
+            tracer.start()
+
+        try:
+            for t in range(start['next_step'] if start is not None else 0, num_iterations):
+                # Airdrops work on the agent objects and the market's aggregates, so sync them around the airdrop
+                airdrops = [airdrop_strategy for airdrop_strategy in market.airdrop_strategies
+                            if int(airdrop_strategy.time * num_iterations) == t]
+                if airdrops:
+                    with phase('airdrops', step=t):
+                        self.store_state()
+                        market.aggregates.rebuild()
+                        for airdrop_strategy in airdrops:
+                            airdrop_strategy.do_airdrop(market)
+                        self.load_state()
+                        recorder.sync(self.holdings, self.budgets)
+                recorder.begin_step(t)
+
+                for coin in self.coins:
+                    c = self.coin_index[coin.name]
+                    with phase('step', step=t, coin=coin.name):
+                        delta, prices = self.step(coin)
+
+                    with phase('record', step=t, coin=coin.name):
+                        for action, price in enumerate(prices):
+                            recorder.record_price(c, t, action, price)
+                        recorder.sync(self.holdings, self.budgets)
+                        recorder.end_coin(c, t, float(-delta.sum()), float(np.abs(delta).sum()))
+                recorder.end_step(t)
+                if tracer is not None:
+                    tracer.end_step(t)
+                if checkpoints is not None:
+                    with phase('checkpoint', step=t):
+                        checkpoints.save(market, t, run, recorder, self.budgets, self.fair_values)
+                if t == stop_after:
+                    self.store_state()
+                    return {'next_step': t + 1, 'recorder': recorder.state(t)}
+        finally:
+            if tracer is not None:
+                tracer.stop()
+
+        self.store_state()
+        return recorder.histories()
@@ -0,0 +1,94 @@
+import copy
+import multiprocessing
+import os
+import shutil
+import tempfile
+import traceback
+
+from Checkpoint import save_checkpoint, load_checkpoint
+from Clearing import make_clearing
+
+# Prefix state the forked branch workers start from, set by what_if before the pool is created
+_branch = {}
+
+
+def what_if(market, airdrop_strategies, num_iterations, processes=None, **simulate_kwargs):
+    """
+    Runs one simulation per candidate airdrop strategy, sharing the steps before the first candidate airdrop
+
+    The market runs once with its own airdrop strategies up to the earliest step a candidate airdrops at. Each branch
+    then continues from that state with the market's strategies plus its candidate, and runs to the end. Branches are
+    forked worker processes that start from the paused market (copy-on-write) and a fresh worker is used for every
+    branch, so all of them start from the same state and draw the same random numbers. A branch gives exactly the
+    results of a full run of a market built with the candidate appended to its airdrop strategies. Without the fork
+    start method the state is written to a temporary checkpoint that every branch loads instead.
+
+    Afterwards the market is left at the end of the shared prefix
+    :param market
+    :param airdrop_strategies - candidates, their coins have to be coins of the market
+    :param num_iterations
+    :param processes - number of branches run at once, all cores by default
+    :param simulate_kwargs - arguments of CryptoMarket.simulate shared by the prefix and the branches, except for the
+    parallel engine which can't be paused
+    :return: list of (strategy, histories), in the order of airdrop_strategies. strategy is the branch's copy of the
+    candidate, with its amount_airdropped, and histories cover the whole run as returned by CryptoMarket.simulate
+    """
+    for strategy in airdrop_strategies:
+        for coin in (getattr(strategy, 'coin', None), getattr(strategy, 'existing_coin', None)):
+            if coin is not None and coin.name not in market.coin_registry:
+                raise ValueError(f"{coin.name} is not a coin of this market, create the market with it")
+    if not airdrop_strategies:
+        return []
+
+    # The prefix's clearing state (e.g. AMM pools) carries over into the branches
+    simulate_kwargs['clearing'] = make_clearing(simulate_kwargs.get('clearing', 'per_trade'))
+    branch_step = min(int(strategy.time * num_iterations) for strategy in airdrop_strategies)
+    start = None
+    if branch_step > 0:
+        start = market.simulate(num_iterations, stop_after=min(branch_step, num_iterations) - 1, **simulate_kwargs)
+
+    _branch.update(market=market, strategies=airdrop_strategies, num_iterations=num_iterations, start=start,
+                   simulate_kwargs=simulate_kwargs)
+    try:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+            workers = min(processes or os.cpu_count() or 1, len(airdrop_strategies))
+            # One task per worker, so every branch is forked from the paused market rather than from a used up branch
+            with context.Pool(workers, maxtasksperchild=1) as pool:
+                results = pool.map(_run_branch, range(len(airdrop_strategies)), chunksize=1)
+        else:
+            directory = tempfile.mkdtemp(prefix='what_if.')
+            try:
+                _branch['checkpoint'] = os.path.join(directory, 'prefix.npz')
+                save_checkpoint(market, _branch['checkpoint'], {'clearing': simulate_kwargs['clearing']})
+                results = [_run_branch(b) for b in range(len(airdrop_strategies))]
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+    finally:
+        _branch.clear()
+
+    for result in results:
+        if isinstance(result, str):
+            raise RuntimeError(f"What-if branch failed:\n{result}")
+    return results
+
+
+def _run_branch(b):
+    try:
+        if 'checkpoint' in _branch:
+            market, run = load_checkpoint(_branch['checkpoint'])
+            simulate_kwargs = {**_branch['simulate_kwargs'], 'clearing': run['clearing']}
+            strategy = copy.copy(_branch['strategies'][b])
+        else:
+            market = _branch['market']
+            simulate_kwargs = _branch['simulate_kwargs']
+            strategy = _branch['strategies'][b]
+        # Point the candidate at the market's own coin objects, which hold their index and price
+        for name in ('coin', 'existing_coin'):
+            if getattr(strategy, name, None) is not None:
+                setattr(strategy, name, market.coin_registry[getattr(strategy, name).name])
+        market.airdrop_strategies = list(market.airdrop_strategies) + [strategy]
+        histories = market.simulate(_branch['num_iterations'], start=_branch['start'], **simulate_kwargs)
+        return strategy, histories
+    except Exception:
+        return traceback.format_exc()
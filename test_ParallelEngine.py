@@ -0,0 +1,77 @@
+import numpy as np
+from scipy import sparse
+
+from AgentStructure import AgentStructure
+from Market import CryptoMarket, Cryptocurrency
+from Agent import NeighborhoodProbabilisticInvestor, RationalAgent
+from ParallelEngine import ParallelEngine
+from RandomStreams import SimulationRNG
+
+
+def directed_market(num_agents=40, seed=0):
+    """
+    Market on a random directed network in which every third agent watches nobody, with random holdings
+    """
+    rng = SimulationRNG(seed)
+    agent_structure = AgentStructure(num_agents, rng=rng)
+    agent_structure.add_agents(RationalAgent, num_agents // 2)
+    agent_structure.add_agents(NeighborhoodProbabilisticInvestor, num_agents - num_agents // 2)
+
+    generator = np.random.default_rng(seed)
+    sources, targets = np.nonzero(generator.random((num_agents, num_agents)) < 0.15)
+    keep = (sources != targets) & (targets % 3 != 0)
+    adjacency = sparse.csr_array((np.ones(keep.sum()), (sources[keep], targets[keep])),
+                                 shape=(num_agents, num_agents))
+    coins = [Cryptocurrency('Bitcoin', 1.00, ismeme=False), Cryptocurrency('DogWifHat', .25, ismeme=True)]
+    market = CryptoMarket('directed_random', coins, [], agent_structure, network=(adjacency, True), rng=rng)
+
+    market.portfolios.holdings[...] = np.where(generator.random((num_agents, 2)) < 0.5,
+                                               generator.integers(1, 100, (num_agents, 2)), 0)
+    market.aggregates.rebuild()
+    return market
+
+
+def expected_signals(market, coin, rows):
+    aggregates = market.aggregates
+    c = coin.index
+    return (aggregates.neighbor_holders[rows, c].astype(np.float64), aggregates.coin_values(rows, coin),
+            aggregates.neighbor_cash[rows], aggregates.portfolio_values(rows))
+
+
+def test_neighborhood_signals_match_aggregates_on_directed_network():
+    market = directed_market()
+    engine = ParallelEngine(market, processes=2)
+    try:
+        engine._sync_prices()
+        in_degree = market.aggregates.in_degree
+        watched, unwatched = np.flatnonzero(in_degree >= 3), np.flatnonzero(in_degree == 0)
+        selections = [
+            # Rows without neighbors at the end of the selection
+            np.array([watched[0], unwatched[0]]),
+            np.concatenate([watched[:5], unwatched[:5]]),
+            unwatched[:3],
+            np.random.default_rng(1).permutation(market.num_agents),
+        ]
+        for coin in market.coins:
+            for rows in selections:
+                signals = engine.neighborhood_signals(coin.index, coin.price, rows)
+                for signal, expected in zip(signals, expected_signals(market, coin, rows)):
+                    np.testing.assert_allclose(signal, expected)
+    finally:
+        engine.close()
+
+
+def test_neighborhood_signals_follow_price_moves_within_a_pass():
+    market = directed_market()
+    engine = ParallelEngine(market, processes=2)
+    try:
+        # The valuation was taken at the previous prices, as it is after the start of a coin pass
+        market.coins[1].price *= 1.8
+        engine._sync_prices()
+        rows = np.random.default_rng(2).permutation(market.num_agents)[:25]
+        for coin in market.coins:
+            signals = engine.neighborhood_signals(coin.index, coin.price, rows)
+            for signal, expected in zip(signals, expected_signals(market, coin, rows)):
+                np.testing.assert_allclose(signal, expected)
+    finally:
+        engine.close()
@@ -0,0 +1,56 @@
+import numpy as np
+
+from Portfolio import PortfolioValuation
+
+
+def random_portfolios(num_agents=50, num_coins=3, seed=0):
+    generator = np.random.default_rng(seed)
+    holdings = np.where(generator.random((num_agents, num_coins)) < 0.5,
+                        generator.integers(1, 100, (num_agents, num_coins)), 0).astype(np.float64)
+    budgets = generator.uniform(1000, 10000, num_agents)
+    prices = generator.uniform(0.1, 2, num_coins)
+    return holdings, budgets, prices
+
+
+def test_valuation_follows_price_moves():
+    holdings, budgets, prices = random_portfolios()
+    valuation = PortfolioValuation(holdings, budgets, prices)
+    ids = np.array([3, 0, 3, 41, 17])
+    np.testing.assert_allclose(valuation.values_of(ids, prices), budgets[ids] + holdings[ids] @ prices)
+
+    # One coin moving, then all of them, without a refresh
+    moved = prices.copy()
+    moved[1] *= 1.7
+    np.testing.assert_allclose(valuation.values_of(ids, moved), budgets[ids] + holdings[ids] @ moved)
+    moved = moved * 0.5
+    np.testing.assert_allclose(valuation.values_of(slice(None), moved), budgets + holdings @ moved)
+    # The cache itself is still at the prices it was refreshed at
+    np.testing.assert_array_equal(valuation.prices, prices)
+
+
+def test_valuation_revalues_traders_only():
+    holdings, budgets, prices = random_portfolios()
+    valuation = PortfolioValuation(holdings, budgets, prices)
+    untouched = valuation.values.copy()
+    traders = np.array([5, 9, 30])
+    holdings[traders, 0] += 10
+    budgets[traders] -= 10 * prices[0]
+    other = np.setdiff1d(np.flatnonzero(holdings[:, 2]), traders)[0]
+    holdings[other, 2] = 0
+    valuation.revalue(traders)
+
+    expected = budgets + holdings @ prices
+    np.testing.assert_allclose(valuation.values[traders], expected[traders])
+    # An agent changed without being revalued keeps its old value
+    assert valuation.values[other] == untouched[other] != expected[other]
+    valuation.refresh(prices)
+    np.testing.assert_allclose(valuation.values, expected)
+
+
+def test_valuation_writes_into_given_arrays():
+    holdings, budgets, prices = random_portfolios()
+    values, valued_prices = np.zeros(len(budgets)), np.zeros(len(prices))
+    valuation = PortfolioValuation(holdings, budgets, prices, values, valued_prices)
+    assert valuation.values is values and valuation.prices is valued_prices
+    np.testing.assert_allclose(values, budgets + holdings @ prices)
+    np.testing.assert_array_equal(valued_prices, prices)